@@ -0,0 +1,534 @@
+import asyncio
+import logging as log
+from functools import partial
+from time import monotonic
+from uuid import uuid4
+import zlib
+
+from quicknet import event, protocol, server, utils, worker
+from quicknet.heartbeat import Heartbeat
+from quicknet.limits import Limits
+from quicknet.metrics import Metrics
+from quicknet.outbox import OVERFLOW_POLICIES
+from quicknet.pending import PendingRequests
+from quicknet.registry import Registry
+from quicknet.store import STORE_ACCESS, RemoteStore, Store
+from quicknet.stream import CHUNK_SIZE, STREAM_COMMANDS, WINDOW, Stream, Streams
+from quicknet.sync import Replica
+
+__all__ = ["AsyncQServer", "AsyncQClient", "AsyncClientWorker", "current_client"]
+current_client = event.current_client
+
+
+def _call_later(delay: float, func, *args) -> asyncio.TimerHandle:
+    return asyncio.get_running_loop().call_later(delay, func, *args)
+
+
+class AsyncEventThreader(event.EventThreader):
+
+    THREAD_DEFAULT = False
+
+    def invoke(self, source, event, args: tuple=(), kwargs: dict=None, deadline: float=None) -> asyncio.Future:
+        kwargs = kwargs if kwargs is not None else {}
+        future = asyncio.get_running_loop().create_future()
+        try:
+            if deadline is not None and monotonic() > deadline:
+                raise TimeoutError("Deadline passed before the handler started")
+            result = self._start(source, self.responder(event, args, kwargs), args, kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if isinstance(result, asyncio.Future):
+            return result
+        future.set_result(result)
+        return future
+
+    def _start(self, source, handler: event.Handler, args: tuple, kwargs: dict, thread: bool=False):
+        if handler.coroutine:
+            # The task copies the context when it's created, so it keeps seeing source after the reset.
+            return handler.watch(event.EventThreader._run_with_ctx(source, asyncio.get_running_loop().create_task,
+                                                                   handler.func(*args, **kwargs)))
+        if thread or handler.thread:
+            target = partial(event.EventThreader._run_with_ctx, source, handler, *args, **kwargs)
+            return asyncio.get_running_loop().run_in_executor(None, target)
+        return event.EventThreader._run_with_ctx(source, handler, *args, **kwargs)
+
+
+class _Drain:
+    # Awaiting it drains the worker, not awaiting it is fine too (unlike a coroutine, nothing warns).
+
+    __slots__ = 'worker',
+
+    def __init__(self, client: 'AsyncClientWorker'):
+        self.worker = client
+
+    def __await__(self):
+        return self.worker.drain().__await__()
+
+
+class AsyncClientWorker(worker.BaseWorker):
+
+    __slots__ = 'reader', 'writer', '_loop', '_task', '_backlogged', '_seen'
+
+    def __init__(self, id: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, manager):
+        worker.BaseWorker.__init__(self, writer.get_extra_info('socket'), manager)
+
+        self.name = id                   # type: str
+        self.reader = reader             # type: asyncio.StreamReader
+        self.writer = writer             # type: asyncio.StreamWriter
+        self.addr = writer.get_extra_info('peername')
+        self._loop = asyncio.get_running_loop()
+        self._task = None                # type: asyncio.Task
+        self._backlogged = False         # type: bool
+        self._seen = None                # type: tuple
+        writer.transport.set_write_buffer_limits(manager.high_water, manager.low_water)
+        log.debug("Finished AsyncClientWorker initialization.")
+
+    @property
+    def congested(self) -> bool:
+        return self.queued > self.server.high_water
+
+    @property
+    def queued(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def _make_pending(self) -> PendingRequests:
+        return PendingRequests(self._loop.create_future, _call_later)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def _call_later(self, delay: float, func, *args):
+        # Shared data can change from executor threads too, the timer has to be set from the loop's own thread.
+        self._loop.call_soon_threadsafe(self._loop.call_later, delay, func, *args)
+
+    def _flush_later(self):
+        self._call_later(self.server.batch_interval, self.flush)
+
+    def _stream_send(self, obj: any):
+        # Chunks come from sender threads and credit from handler threads, the transport is only written on the loop.
+        if self.closed:
+            raise utils.NotRunningError("Worker is not connected to client.")
+        self._loop.call_soon_threadsafe(self._send_quietly, obj)
+
+    def _send_quietly(self, obj: any):
+        try:
+            self.send_obj(obj)
+        except utils.NotRunningError:
+            pass
+
+    def _stalled_since(self) -> float:
+        # The transport doesn't say when it last wrote, the buffer not shrinking between checks is the closest thing.
+        queued = self.queued
+        if not queued:
+            self._seen = None
+            return None
+        if self._seen is None or queued < self._seen[0]:
+            self._seen = queued, monotonic()
+        return self._seen[1]
+
+    def _abort(self):
+        self.writer.transport.abort()
+
+    def _write(self, data: bytes):
+        # The transport buffers everything, drain() is what makes writers wait for a slow client.
+        self.writer.write(data)
+        if not self._backlogged and self.congested:
+            self._backlogged = True
+            self._on_congested()
+
+    async def drain(self):
+        await self.writer.drain()
+        if self._backlogged and not self.congested:
+            self._backlogged = False
+            self._on_drained()
+
+    async def run(self):
+        log.info("Worker task started, looking for data.")
+        while not self.closed:
+            try:
+                data = await self.reader.read(self.server.buffer_size if self.server.buffer_size else 2048)
+            except (ConnectionResetError, OSError, ConnectionAbortedError):
+                data = b''
+            if not data:
+                log.info("Client Disconnected (addr {addr})".format(addr=self.addr))
+                if not self.closed:
+                    self.kill()
+                continue
+            wait = self.feed(data)
+            while wait and not self.closed:
+                await asyncio.sleep(wait)
+                wait = self.process()
+
+    def emit(self, handler, *args, **kwargs) -> '_Drain':
+        # Queued right away, so plain handlers can call it too. Coroutines await the result to wait for the drain.
+        worker.BaseWorker.emit(self, handler, *args, **kwargs)
+        return _Drain(self)
+
+    def _close(self):
+        self.writer.close()
+
+
+class AsyncQServer(AsyncEventThreader):
+
+    EVENTS = ('CONNECTION', 'CONNECTION_RESET', 'SERVER_REQUEST', 'CLIENT_DISCONNECT', 'BACKPRESSURE', 'DRAINED',
+              'RATE_LIMITED')
+    DEFAULT_READ_SIZE = 2048
+
+    def __init__(self, port: int, local_only: bool=False, buffer_size: int=None, use_ssl: bool=False,
+                 ssl_data: dict=None, compression: dict=None, binary: bool=True, high_water: int=4 * 1024 * 1024,
+                 low_water: int=1024 * 1024, overflow: str='none', sync_interval: float=0.05,
+                 store_shards: int=16, store_access: str='write', session_grace: float=30,
+                 metrics: Metrics=None, batch_interval: float=None, batch_bytes: int=16 * 1024,
+                 heartbeat: float=None, read_timeout: float=None, write_timeout: float=None,
+                 rate_limit: float or tuple=None, handler_limits: dict=None, limit_action: str='drop',
+                 max_connections: int=None):
+        AsyncEventThreader.__init__(self, metrics=metrics)
+        if store_access not in STORE_ACCESS:
+            raise ValueError("Unknown store access {access}, expected one of {levels}".format(
+                access=store_access, levels=STORE_ACCESS))
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {policy}, expected one of {policies}".format(
+                policy=overflow, policies=OVERFLOW_POLICIES))
+
+        self.local = local_only
+        self.port = port
+        self.running = False
+        self.buffer_size = buffer_size
+        self.clients = Registry(session_grace)
+        self.rooms = {}
+        self.compression = compression if compression is not None else {}
+        self.binary = binary
+        self.high_water = high_water
+        self.low_water = low_water
+        self.overflow = overflow
+        self.sync_interval = sync_interval
+        self.batch_interval = batch_interval
+        self.batch_bytes = batch_bytes
+        self.heartbeat = Heartbeat.make(heartbeat, read_timeout, write_timeout)
+        self.limits = Limits.make(rate_limit, handler_limits, limit_action, self.metrics)
+        self.max_connections = max_connections
+        self.store = Store(store_shards)
+        self.store_access = store_access
+        self._codec = protocol.Codec(binary=binary, metrics=self.metrics, **self.compression)
+        self.ssl = utils.make_ssl_context(ssl_data, server_side=True) if use_ssl else None
+        server.QServer._track(self)
+        self._server = None              # type: asyncio.AbstractServer
+        log.debug("AsyncQServer instance finished initialization.")
+
+    async def start(self, max=50):
+        host = '127.0.0.1' if self.local else '0.0.0.0'
+        self._server = await asyncio.start_server(self._accept, host, self.port, ssl=self.ssl, backlog=max)
+        self.running = True
+        log.debug("Server has binded to the computer in port {port}".format(port=self.port))
+
+    async def serve_forever(self, max=50):
+        if not self.running:
+            await self.start(max)
+        await self._server.serve_forever()
+
+    async def quit(self):
+        if not self.running:
+            log.warning("Attempt to stop server failed, server wasn't running.")
+            raise utils.NotRunningError("The server hasn't been started yet.")
+
+        self.running = False
+        for client in self.clients.values():
+            if client.closed:
+                continue
+            client.kill()
+        self.store.close()
+        self._server.close()
+        await self._server.wait_closed()
+        log.info("Server has stopped.")
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        if self.full():
+            self.reject(addr)
+            writer.transport.abort()
+            return
+        log.info("New connection {addr}".format(addr=addr))
+        client = AsyncClientWorker(str(uuid4()), reader, writer, self)
+        self.clients.add(client)
+        client.hello()
+        client.start()
+        client.watch()
+        log.debug("Worker for connection {addr} created".format(addr=addr))
+
+    full = server.QServer.full
+    reject = server.QServer.reject
+    greet = server.QServer.greet
+    join_room = server.QServer.join_room
+    leave_room = server.QServer.leave_room
+    _fan_out = server.QServer._fan_out
+
+    async def broadcast(self, handler: str, *args, **kwargs):
+        await self.multicast(list(self.clients.values()), handler, args, kwargs)
+
+    async def multicast(self, clients, handler: str, args: tuple=(), kwargs: dict=None, exclude=()):
+        sent = self._fan_out(clients, handler, args, kwargs, exclude)
+        await asyncio.gather(*(c.drain() for c in sent), return_exceptions=True)
+        log.debug("Broadcasted event to %s clients", len(sent))
+
+
+class AsyncQClient(AsyncEventThreader):
+
+    EVENTS = 'SERVER_DISCONNECTED',
+    DEFAULT_READ_SIZE = 2048
+
+    def __init__(self, ip: str, port: int, buffer_size: int=None, use_ssl: bool=False, ssl_data: dict=None,
+                 timeout: int=2, compression: dict=None, binary: bool=True, high_water: int=4 * 1024 * 1024,
+                 low_water: int=1024 * 1024, sync: bool or list=True, session: str=None, metrics: Metrics=None):
+        AsyncEventThreader.__init__(self, metrics=metrics)
+
+        self.ip = ip                                         # type: str
+        self.port = port                                     # type: int
+        self.buffer_size = buffer_size                       # type: int
+        self.running = False                                 # type: bool
+        self.timeout = timeout                               # type: int
+        self.high_water = high_water                         # type: int
+        self.low_water = low_water                           # type: int
+        self.sync = sync                                     # type: bool or list
+        self.session = session                               # type: str
+        self.cache = Replica()                               # type: Replica
+        self.store = RemoteStore(self)                       # type: RemoteStore
+        self.ssl = utils.make_ssl_context(ssl_data) if use_ssl else None
+        self.reader = None                                   # type: asyncio.StreamReader
+        self.writer = None                                   # type: asyncio.StreamWriter
+        self._reqs = PendingRequests(lambda: asyncio.get_running_loop().create_future(), _call_later)
+        self._parser = protocol.FrameParser()                # type: protocol.FrameParser
+        self._codec = protocol.Codec(binary=binary, metrics=self.metrics, **(compression or {}))
+        self._task = None                                    # type: asyncio.Task
+        self._loop = None                                    # type: asyncio.AbstractEventLoop
+        self._streams = Streams(self._stream_send, self._open_stream)
+        self.metrics.gauge('outbound_queue_bytes', lambda: self.writer.transport.get_write_buffer_size() if
+                           self.writer is not None else 0, help="Bytes waiting to be written to the server.")
+        log.debug("AsyncQClient instance finished initialization.")
+
+    def __getitem__(self, item):
+        return self._lookup(item)
+
+    def __setitem__(self, key, value):
+        self.cache.writing(self._request('SET', key, value), {key: value})
+
+    def __delitem__(self, key):
+        self.cache.writing(self._request('DEL', key), removed=[key])
+
+    async def _lookup(self, item):
+        if self.cache.covers(item):
+            return self.cache.data.get(item)
+        return await self.get(item)
+
+    def _request(self, command: str, *args) -> asyncio.Future:
+        return self._reqs.issue(self._write_obj, [command] + list(args))
+
+    async def wait(self, future: asyncio.Future):
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Server took to long to respond")
+
+    async def get(self, key):
+        return await self.wait(self._request('GET', key))
+
+    async def set(self, key, value):
+        future = self._request('SET', key, value)
+        self.cache.writing(future, {key: value})
+        return await self.wait(future)
+
+    async def delete(self, key):
+        future = self._request('DEL', key)
+        self.cache.writing(future, removed=[key])
+        return await self.wait(future)
+
+    async def get_many(self, keys) -> dict:
+        return await self.wait(self._request('GET_MANY', list(keys)))
+
+    async def set_many(self, values: dict) -> list:
+        values = dict(values)
+        future = self._request('SET_MANY', values)
+        self.cache.writing(future, values)
+        return await self.wait(future)
+
+    async def subscribe(self, keys: list=None):
+        return await self.wait(self._request('SUBSCRIBE', None if keys is None else list(keys)))
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port, ssl=self.ssl)
+        self._loop = asyncio.get_running_loop()
+        self.writer.transport.set_write_buffer_limits(self.high_water, self.low_water)
+        self.running = True
+        self._write_obj(['HELLO', self._codec.capabilities(), self.session])
+        if self.sync is not False:
+            self._request('SUBSCRIBE', None if self.sync is True else list(self.sync))
+        self._task = asyncio.get_running_loop().create_task(self.run())
+        log.info("Starting connection task (connected to server)")
+
+    async def call(self, handler: str, *args, **kwargs):
+        await self.send_obj((handler, args, kwargs))
+
+    def request(self, handler: str, *args, timeout: float=None, **kwargs) -> asyncio.Future:
+        timeout = self.timeout if timeout is None else timeout
+        return self._reqs.issue(self._write_obj, ['CALL', handler, args, kwargs, timeout], timeout)
+
+    def stream(self, handler: str, source, *args, chunk_size: int=CHUNK_SIZE, window: int=WINDOW,
+               **kwargs) -> asyncio.Future:
+        # Sends bytes, a file or an iterable of bytes in chunks, resolves to the number of bytes sent. The source is
+        # read on a thread of its own, so a slow file doesn't hold up the loop.
+        return asyncio.wrap_future(self._streams.open(handler, source, args, kwargs, chunk_size, window))
+
+    def _stream_send(self, obj: any):
+        # Chunks come from sender threads and credit from handler threads, the transport is only written on the loop.
+        if not self.running:
+            raise utils.NotRunningError("Not connected to server")
+        self._loop.call_soon_threadsafe(self._send_quietly, obj)
+
+    def _send_quietly(self, obj: any):
+        try:
+            self._write_obj(obj)
+        except utils.NotRunningError:
+            pass
+
+    def _open_stream(self, incoming: Stream, handler: str, args: tuple, kwargs: dict):
+        if handler in self.EVENTS:
+            log.info("Server streamed to event ({e}) only triggerable by client side.".format(e=handler))
+            incoming.close()
+            return
+        # Nobody would ever read it, the sender is told right away instead of waiting for credit forever.
+        if not self.spawn(self, handler, incoming, *args, **kwargs):
+            incoming.close()
+
+    async def run(self):
+        while self.running:
+            try:
+                data = await self.reader.read(self.buffer_size if self.buffer_size is not None
+                                              else self.DEFAULT_READ_SIZE)
+            except (ConnectionResetError, OSError):
+                data = b''
+            if not data:
+                if self.running:
+                    self.running = False
+                    self.writer.close()
+                    self._reqs.fail_all(utils.NotRunningError("Disconnected from server"))
+                    self._streams.close(utils.NotRunningError("Disconnected from server"))
+                    log.info("Server disconnected, ending task.")
+                    self.emit(self, "SERVER_DISCONNECT", self)
+                continue
+            self._parser.feed(data)
+            try:
+                for flags, payload in self._parser.frames():
+                    try:
+                        infos = self._codec.load_all(flags, payload)
+                    except (zlib.error, UnicodeDecodeError, utils.BadSterilization):
+                        log.info("Server sent us a malformed call.")
+                        self.emit(self, "BAD_CALL", bytes(payload))
+                    else:
+                        log.debug("Received data from server, %s bytes.", len(payload))
+                        for info in infos:
+                            self.handle(info)
+            except (utils.ProtocolError, utils.DataOverflowError) as e:
+                log.info("Server sent us an invalid frame ({e}), disconnecting.".format(e=e))
+                self.running = False
+                self.writer.close()
+                self._reqs.fail_all(utils.NotRunningError("Disconnected from server"))
+                self._streams.close(utils.NotRunningError("Disconnected from server"))
+                self.emit(self, "SERVER_DISCONNECT", self)
+
+    def handle(self, info):
+        if type(info) == tuple:
+            if len(info) != 3:
+                log.info("Server sent us either to much or too little information.")
+                self._write_obj(("BAD_CALL", (utils.describe(info),), {}))
+            elif info[0] in self.EVENTS:
+                log.info("Server sent event ({e}) only triggerable by client side.".format(e=info[0]))
+                self._write_obj(("BAD_CALL", (utils.describe(info),), {}))
+            else:
+                handler, args, kwargs = info
+                self.emit(self, handler, *args, **kwargs)
+        elif type(info) == list and info:
+            if info[0] == 'HELLO':
+                self._codec.agree(info[1] if len(info) > 1 else [])
+                log.debug("Server can read {caps}.".format(caps=info[1:]))
+            elif info[0] == 'PING':
+                self._write_obj(['PONG'])
+            elif info[0] == 'PONG':
+                pass
+            elif info[0] == 'FOUND':
+                self._reqs.resolve(info[3], info[2])
+                log.debug("Server said shared data %s was %s", info[1], info[2])
+            elif info[0] == 'CHANGED':
+                self._reqs.resolve(info[3], info[2])
+                log.debug("Server set shared data %s to %s", info[1], info[2])
+            elif info[0] == 'REMOVED':
+                self._reqs.resolve(info[2], None)
+                log.debug("Server deleted shared data %s", info[1])
+            elif info[0] in ('FOUND_MANY', 'CHANGED_MANY'):
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] == 'DENIED':
+                self._reqs.fail(info[2], utils.SharingLockedError("Server doesn't allow changing {key}".format(
+                    key=info[1])))
+            elif info[0] == 'SESSION':
+                self.session = info[1]
+                log.debug("Server gave us session {token}".format(token=info[1]))
+            elif info[0] == 'SYNC':
+                self.cache.apply(info[1], info[2], info[3], info[4])
+                log.debug("Server synced shared data to version %s", info[1])
+            elif info[0] == 'SUBSCRIBED':
+                self.cache.subscribed(info[1])
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] in STREAM_COMMANDS:
+                try:
+                    self._streams.handle(info)
+                except (IndexError, TypeError, ValueError):
+                    log.info("Server sent us a malformed stream message.")
+                    self.emit(self, "BAD_CALL", info)
+            elif info[0] == 'CALL':
+                self.answer(self, info, self._write_obj)
+            elif info[0] == 'RESULT':
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] == 'ERROR':
+                self._reqs.fail(info[2], utils.RemoteError(info[1]))
+            else:
+                log.info("Server sent us invalid information")
+                self.emit(self, "BAD_CALL", info)
+        else:
+            log.info("Server sent us unrecognized information")
+            self.emit(self, "BAD_CALL", info)
+
+    async def quit(self):
+        self.running = False
+        self._reqs.fail_all(utils.NotRunningError("Client was stopped before the server responded"))
+        self._streams.close(utils.NotRunningError("Client was stopped during the stream"))
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionResetError, OSError):
+            pass
+        log.info("Client has been stopped.")
+
+    def _write(self, data: str or bytes, flags: int=0):
+        data = data if type(data) is bytes else data.encode()
+
+        if not self.running:
+            log.warning("AsyncQClient instance isn't connected to the server, unable to send data.")
+            raise utils.NotRunningError("Not connected to server")
+
+        self.writer.write(self._codec.encode(data, flags))
+        log.debug("Sent data to server (%s bytes)", len(data))
+
+    def _write_obj(self, obj: any):
+        flags, data = self._codec.serialize(obj)
+        self._write(data, flags)
+
+    async def send(self, data: str or bytes):
+        self._write(data)
+        await self.writer.drain()
+
+    async def send_obj(self, obj: any):
+        self._write_obj(obj)
+        await self.writer.drain()
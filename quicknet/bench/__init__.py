@@ -0,0 +1,57 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+from timeit import Timer
+
+__all__ = ["timeit_ops", "percentile", "environment", "write_results", "compare"]
+
+
+def timeit_ops(func, *args, seconds: float=0.5) -> float:
+    timer = Timer(lambda: func(*args))
+    number, elapsed = timer.autorange()
+    runs = max(1, int(number * seconds / max(elapsed, 1e-9)))
+    return runs / timer.timeit(runs)
+
+
+def percentile(values: list, q: float) -> float:
+    # Nearest rank, values has to be sorted.
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_results(path: str, bench: str, params: dict, results: dict):
+    with open(path, 'w') as f:
+        json.dump({'bench': bench, 'env': environment(), 'params': params, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def compare(old: dict, new: dict, prefix: str='') -> list:
+    # [(metric, old, new, new / old)] for every number both result files have.
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key], new[key]
+        name = prefix + str(key)
+        if isinstance(a, dict) and isinstance(b, dict):
+            rows.extend(compare(a, b, name + '.'))
+        elif isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+            rows.append((name, a, b, b / a if a else None))
+    return rows
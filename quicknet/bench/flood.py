@@ -0,0 +1,94 @@
+import argparse
+import subprocess
+import sys
+import time
+
+from quicknet import protocol, sterilizer
+from quicknet.bench import write_results
+from quicknet.bench.load import _cpu
+from quicknet.server import QServer
+
+__all__ = ["run"]
+
+# Runs in a child process, so the CPU measured is only the server's. It says HELLO and then sends the same event
+# frame as fast as the socket takes it.
+FLOODER = '''
+import socket, sys
+hello, frame = bytes.fromhex(sys.argv[2]), bytes.fromhex(sys.argv[3])
+conn = socket.create_connection(('127.0.0.1', int(sys.argv[1])))
+conn.sendall(hello)
+burst = frame * 256
+for _ in range(int(sys.argv[4]) // 256):
+    conn.sendall(burst)
+# Closing with the server's replies unread would reset the connection, and the server would lose what it hasn't read.
+conn.shutdown(socket.SHUT_WR)
+while conn.recv(65536):
+    pass
+conn.close()
+'''
+
+
+def _frame(message) -> bytes:
+    return protocol.pack_frame(sterilizer.pack(message), protocol.FLAG_BINARY)
+
+
+def _measure(messages: int, port: int, engine: str, rate: float) -> dict:
+    server = QServer(port, local_only=True, engine=engine, rate_limit=rate)
+    handled = [0]
+    done = []
+
+    @server.on("SPAM", thread=False)
+    def spam(text):
+        handled[0] += 1
+
+    @server.on("CLIENT_DISCONNECT", thread=False)
+    def gone(client):
+        done.append(time.perf_counter())
+
+    server.start()
+    time.sleep(0.1)
+    hello = _frame(['HELLO', ['text', 'binary'], None])
+    frame = _frame(("SPAM", ("x" * 32,), {}))
+    cpu, began = _cpu(), time.perf_counter()
+    subprocess.run([sys.executable, '-c', FLOODER, str(port), hello.hex(), frame.hex(), str(messages)], check=True)
+    deadline = time.monotonic() + 30
+    while not done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = (done[0] if done else time.perf_counter()) - began
+    cpu = _cpu() - cpu
+    server.quit()
+    sent = messages // 256 * 256
+    return {
+        'sent': sent,
+        'handled': handled[0],
+        'seconds': elapsed,
+        'cpu_us_per_message': cpu / sent * 1e6,
+    }
+
+
+def run(messages: int=200000, port: int=5436, engine: str='selector', rate: float=100) -> dict:
+    return {'unlimited': _measure(messages, port, engine, None),
+            'limited': _measure(messages, port + 1, engine, rate)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flood a server with events, with and without a rate limit.")
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--rate', type=float, default=100, help="messages per second the limited server allows")
+    parser.add_argument('--port', type=int, default=5436, help="this one and the next")
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = {'messages': args.messages, 'rate': args.rate, 'engine': args.engine}
+    results = run(port=args.port, **params)
+    print("{:<10} {:>9} {:>9} {:>9} {:>12}".format("server", "sent", "handled", "seconds", "cpu us/msg"))
+    for name, r in results.items():
+        print("{:<10} {:>9} {:>9} {:>9.2f} {:>12.2f}".format(
+            name, r['sent'], r['handled'], r['seconds'], r['cpu_us_per_message']))
+    if args.json:
+        write_results(args.json, 'flood', params, results)
+
+
+if __name__ == '__main__':
+    main()
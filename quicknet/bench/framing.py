@@ -0,0 +1,70 @@
+import argparse
+
+from quicknet import protocol
+from quicknet.bench import timeit_ops, write_results
+from quicknet.bench.serialize import PAYLOADS
+
+__all__ = ["CODECS", "run"]
+
+CODECS = {
+    'raw': {'threshold': 1 << 62},
+    'zlib': {},
+    'zlib zdict': {'zdict': protocol.build_zdict(["MSG", "NEW_MSG"])},
+}
+
+
+def _codec(options: dict, binary: bool) -> protocol.Codec:
+    codec = protocol.Codec(binary=binary, **options)
+    codec.agree(codec.capabilities())
+    return codec
+
+
+def run(seconds: float=0.5, binary: bool=True) -> dict:
+    results = {}
+    for name, obj in PAYLOADS.items():
+        results[name] = {}
+        for codec_name, options in CODECS.items():
+            codec = _codec(options, binary)
+            flags, data = codec.serialize(obj)
+            # A deflate stream has to be read in the order it was written, the round trip gets its own pair.
+            sender, receiver = _codec(options, binary), _codec(options, binary)
+            results[name][codec_name] = {
+                'payload_size': len(data),
+                'frame_size': len(_codec(options, binary).encode(data, flags)),
+                'encode_ops': timeit_ops(codec.encode, data, flags, seconds=seconds),
+                'round_trip_ops': timeit_ops(_pipe, sender, receiver, data, flags, seconds=seconds),
+                'standalone_ops': timeit_ops(codec.encode_standalone, obj, binary, seconds=seconds),
+            }
+    return results
+
+
+def _split(frame: bytes) -> tuple:
+    _, flags, _ = protocol.HEADER.unpack_from(frame)
+    return flags, memoryview(frame)[protocol.HEADER.size:]
+
+
+def _pipe(sender: protocol.Codec, receiver: protocol.Codec, data: bytes, flags: int):
+    receiver.loads(*_split(sender.encode(data, flags)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time framing and compression on top of the sterilizer.")
+    parser.add_argument('--seconds', type=float, default=0.5, help="time spent on each measurement")
+    parser.add_argument('--text', action='store_true', help="use the text format instead of the binary one")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.seconds, not args.text)
+    print("{:<12} {:<11} {:>10} {:>10} {:>12} {:>12} {:>12}".format(
+        "payload", "codec", "payload B", "frame B", "encode/s", "round trip/s", "standalone/s"))
+    for name, codecs in results.items():
+        for codec_name, r in codecs.items():
+            print("{:<12} {:<11} {:>10} {:>10} {:>12.0f} {:>12.0f} {:>12.0f}".format(
+                name, codec_name, r['payload_size'], r['frame_size'], r['encode_ops'], r['round_trip_ops'],
+                r['standalone_ops']))
+    if args.json:
+        write_results(args.json, 'framing', {'seconds': args.seconds, 'binary': not args.text}, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import socket
+import ssl
+import time
+from threading import Lock, Thread
+
+from quicknet import utils
+from quicknet.bench import percentile, write_results
+from quicknet.server import QServer
+
+__all__ = ["run"]
+
+
+def _handshake(port: int, context: ssl.SSLContext, session: ssl.SSLSession=None) -> tuple:
+    raw = socket.create_connection(('127.0.0.1', port))
+    began = time.perf_counter()
+    sock = context.wrap_socket(raw, session=session)
+    elapsed = time.perf_counter() - began
+    try:
+        # TLS 1.3 tickets come after the handshake, reading the server's HELLO makes sure we have one.
+        sock.settimeout(2)
+        sock.recv(4096)
+        return elapsed, sock.session_reused, sock.session
+    finally:
+        sock.close()
+
+
+def _connector(port: int, context: ssl.SSLContext, resume: bool, stop: float, timings: list, lock: Lock):
+    session = None
+    mine = []
+    while time.perf_counter() < stop:
+        try:
+            elapsed, reused, new_session = _handshake(port, context, session if resume else None)
+        except (OSError, ssl.SSLError):
+            continue
+        mine.append((elapsed, reused))
+        if resume:
+            session = new_session
+    with lock:
+        timings.extend(mine)
+
+
+def _measure(port: int, concurrency: int, duration: float, resume: bool) -> dict:
+    context = utils.make_ssl_context()
+    timings, lock = [], Lock()
+    stop = time.perf_counter() + duration
+    threads = [Thread(target=_connector, args=(port, context, resume, stop, timings, lock), daemon=True)
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = sorted(elapsed for elapsed, _ in timings)
+    return {
+        'handshakes': len(timings),
+        'per_second': len(timings) / duration,
+        'resumed': sum(1 for _, reused in timings if reused),
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+def run(certfile: str, keyfile: str, concurrency: int=8, duration: float=3, port: int=5432,
+        engine: str='selector') -> dict:
+    server = QServer(port, local_only=True, engine=engine, use_ssl=True,
+                     ssl_data={'certfile': certfile, 'keyfile': keyfile})
+    server.start()
+    time.sleep(0.1)
+    try:
+        return {'full': _measure(port, concurrency, duration, False),
+                'resumed': _measure(port, concurrency, duration, True)}
+    finally:
+        server.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count TLS handshakes per second, with and without resumption.")
+    parser.add_argument('--certfile', default='selfsigned.crt')
+    parser.add_argument('--keyfile', default='selfsigned.key')
+    parser.add_argument('--concurrency', type=int, default=8, help="clients connecting at the same time")
+    parser.add_argument('--duration', type=float, default=3, help="seconds spent on each mode")
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = {'concurrency': args.concurrency, 'duration': args.duration, 'engine': args.engine}
+    results = run(args.certfile, args.keyfile, port=args.port, **params)
+    print("{:<8} {:>10} {:>10} {:>9} {:>9} {:>9}".format(
+        "mode", "handshakes", "per s", "resumed", "p50 ms", "p99 ms"))
+    for mode, r in results.items():
+        print("{:<8} {:>10} {:>10.0f} {:>9} {:>9.3f} {:>9.3f}".format(
+            mode, r['handshakes'], r['per_second'], r['resumed'], r['p50_ms'] or 0, r['p99_ms'] or 0))
+    if args.json:
+        write_results(args.json, 'handshake', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from quicknet import protocol, sterilizer
+from quicknet.bench import write_results
+from quicknet.server import QServer
+
+__all__ = ["run"]
+
+# Runs in a child process, so only the server's side of every connection is measured. Each connection says HELLO
+# like a QClient would and then stays quiet.
+HOLDER = '''
+import socket, sys
+frame = bytes.fromhex(sys.argv[3])
+conns = []
+for _ in range(int(sys.argv[2])):
+    conn = socket.create_connection(('127.0.0.1', int(sys.argv[1])))
+    conn.sendall(frame)
+    conns.append(conn)
+print('ready', flush=True)
+sys.stdin.read()
+'''
+
+
+def _rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * 4096
+    except OSError:
+        return 0
+
+
+def run(connections: int=1000, port: int=5435, engine: str='selector', settle: float=1,
+        read_timeout: float=None) -> dict:
+    # With a read_timeout the holder plays dead afterwards (it never answers), and the server has to reap every
+    # connection on its own.
+    server = QServer(port, local_only=True, engine=engine, read_timeout=read_timeout)
+    server.start()
+    time.sleep(0.1)
+
+    hello = protocol.pack_frame(sterilizer.pack(['HELLO', ['text', 'binary', 'batch'], None]), protocol.FLAG_BINARY)
+    tracemalloc.start()
+    before, rss = tracemalloc.get_traced_memory()[0], _rss()
+    holder = subprocess.Popen([sys.executable, '-c', HOLDER, str(port), str(connections), hello.hex()],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        holder.stdout.readline()
+        deadline = time.monotonic() + 10 + connections / 1000
+        while sum(client.greeted for client in server.clients.values()) < connections:
+            if time.monotonic() > deadline:
+                raise TimeoutError("The server didn't greet every connection in time")
+            time.sleep(0.05)
+        greeted = time.monotonic()
+        time.sleep(settle)
+        traced = tracemalloc.get_traced_memory()[0] - before
+        rss = _rss() - rss
+        reaped = None
+        if read_timeout is not None:
+            deadline = time.monotonic() + read_timeout * 2 + connections / 1000
+            while any(not client.closed for client in server.clients.values()) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            if not any(not client.closed for client in server.clients.values()):
+                reaped = time.monotonic() - greeted
+    finally:
+        tracemalloc.stop()
+        holder.stdin.close()
+        holder.wait()
+        server.quit()
+    return {
+        'connections': connections,
+        'bytes_per_connection': traced / connections,
+        'rss_bytes_per_connection': rss / connections,
+        'reaped_after': reaped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure what an idle connection costs the server.")
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5435)
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--read-timeout', type=float, help="then time how long the server takes to drop them all")
+    parser.add_argument('--budget', type=int, help="exit with an error if a connection costs more bytes than this")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = {'connections': args.connections, 'engine': args.engine, 'read_timeout': args.read_timeout}
+    results = run(port=args.port, **params)
+    print("{connections} idle connections, {bytes:.0f} bytes each ({rss:.0f} bytes of RSS)".format(
+        connections=results['connections'], bytes=results['bytes_per_connection'],
+        rss=results['rss_bytes_per_connection']))
+    if args.read_timeout is not None:
+        reaped = results['reaped_after']
+        print("reaped after {reaped}".format(reaped="never" if reaped is None else "{:.2f}s".format(reaped)))
+    if args.json:
+        write_results(args.json, 'idle', dict(params, budget=args.budget), results)
+    if args.budget is not None and results['bytes_per_connection'] > args.budget:
+        print("Over the budget of {budget} bytes per connection.".format(budget=args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from os import urandom
+from threading import Event, Lock, Thread
+
+from quicknet.bench import compare, percentile, write_results
+from quicknet.client import QClient
+from quicknet.executor import EventExecutor
+from quicknet.server import QServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+__all__ = ["MIXES", "OPERATIONS", "parse_mix", "run"]
+
+MIXES = {
+    'calls': {'call': 1},
+    'shared': {'get': 1, 'set': 1},
+    'broadcast': {'broadcast': 1},
+    'large': {'large': 1},
+    'mixed': {'call': 4, 'get': 2, 'set': 2, 'broadcast': 1, 'large': 1},
+}
+# More than deflate's 32 KiB window, so large payloads don't compress to back references of the last one.
+LARGE = [urandom(4000) for _ in range(16)]
+
+
+def _call(client: QClient, rng: random.Random):
+    return client.wait(client.request("ECHO", "Hello dude!"))
+
+
+def _get(client: QClient, rng: random.Random):
+    return client.wait(client.get("k{n}".format(n=rng.randrange(16))))
+
+
+def _set(client: QClient, rng: random.Random):
+    return client.wait(client.set("k{n}".format(n=rng.randrange(16)), rng.random()))
+
+
+def _broadcast(client: QClient, rng: random.Random):
+    return client.wait(client.request("SHOUT", "How are you?"))
+
+
+def _large(client: QClient, rng: random.Random):
+    return client.wait(client.request("ECHO", rng.choice(LARGE)))
+
+
+OPERATIONS = {'call': _call, 'get': _get, 'set': _set, 'broadcast': _broadcast, 'large': _large}
+
+
+def parse_mix(text: str) -> dict:
+    # A named mix, or weights like "call=4,get=1".
+    if text in MIXES:
+        return dict(MIXES[text])
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise ValueError("Unknown operation {op}, expected one of {ops}".format(op=name, ops=list(OPERATIONS)))
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _cpu() -> float:
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _serve(port: int, engine: str, loops: int, handlers: str) -> QServer:
+    executor = EventExecutor(max_workers=8, ordered=True) if handlers == 'pool' else None
+    server = QServer(port, local_only=True, engine=engine, loops=loops, executor=executor)
+    thread = handlers != 'inline'
+
+    @server.on("ECHO", thread=thread)
+    def echo(value):
+        return value
+
+    @server.on("SHOUT", thread=thread)
+    def shout(value):
+        server.broadcast("HEARD", value)
+        return value
+
+    server.start()
+    return server
+
+
+def _connect(port: int, n: int, timeout: float) -> list:
+    clients = []
+    for _ in range(n):
+        client = QClient('127.0.0.1', port, timeout=timeout, sync=False)
+        client.heard = 0
+
+        @client.on("HEARD", thread=False)
+        def heard(value, client=client):
+            client.heard += 1
+
+        client.start()
+        clients.append(client)
+    deadline = time.monotonic() + timeout + n * 0.01
+    while any(client.session is None for client in clients):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Clients didn't get a session from the server in time")
+        time.sleep(0.01)
+    return clients
+
+
+def _drive(client: QClient, mix: dict, seed: int, start: float, stop: float, samples: dict, errors: dict,
+           lock: Lock, done: Event):
+    # A closed loop, every client waits for each reply before sending the next operation.
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    latencies = {name: [] for name in names}
+    failed = {}
+    while not done.is_set():
+        name = rng.choices(names, weights)[0]
+        began = time.perf_counter()
+        try:
+            OPERATIONS[name](client, rng)
+        except Exception as e:
+            failed[type(e).__name__] = failed.get(type(e).__name__, 0) + 1
+            continue
+        finished = time.perf_counter()
+        if finished >= stop:
+            break
+        if began >= start:
+            latencies[name].append(finished - began)
+    with lock:
+        for name, values in latencies.items():
+            samples.setdefault(name, []).extend(values)
+        for name, count in failed.items():
+            errors[name] = errors.get(name, 0) + count
+
+
+def run(clients: int=10, mix: dict=None, duration: float=5, warmup: float=1, port: int=5431,
+        engine: str='selector', loops: int=1, handlers: str='inline', seed: int=0, timeout: float=5) -> dict:
+    mix = mix if mix is not None else dict(MIXES['mixed'])
+    server = _serve(port, engine, loops, handlers)
+    time.sleep(0.1)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    connections = _connect(port, clients, timeout)
+    time.sleep(0.1)
+    # Client and server both live in this process, so this is what one connection costs on both ends together.
+    memory = (tracemalloc.get_traced_memory()[0] - before) / clients
+    tracemalloc.stop()
+
+    samples, errors, lock, done = {}, {}, Lock(), Event()
+    start = time.perf_counter() + warmup
+    stop = start + duration
+    drivers = [Thread(target=_drive, args=(client, mix, seed + i, start, stop, samples, errors, lock, done),
+                      daemon=True) for i, client in enumerate(connections)]
+    for driver in drivers:
+        driver.start()
+    time.sleep(warmup)
+    cpu_start, heard_start = _cpu(), sum(client.heard for client in connections)
+    time.sleep(duration)
+    cpu = _cpu() - cpu_start
+    heard = sum(client.heard for client in connections) - heard_start
+    done.set()
+    for driver in drivers:
+        driver.join(timeout + 1)
+
+    metrics = server.metrics.export()
+    for client in connections:
+        client.quit()
+    server.quit()
+
+    operations = {}
+    for name, values in sorted(samples.items()):
+        values.sort()
+        operations[name] = {
+            'count': len(values),
+            'throughput': len(values) / duration,
+            'p50_ms': percentile(values, 50) * 1000 if values else None,
+            'p99_ms': percentile(values, 99) * 1000 if values else None,
+            'mean_ms': sum(values) / len(values) * 1000 if values else None,
+        }
+    total = sum(op['count'] for op in operations.values())
+    every = sorted(value for values in samples.values() for value in values)
+    return {
+        'operations': operations,
+        'total': {
+            'count': total,
+            'throughput': total / duration,
+            'p50_ms': percentile(every, 50) * 1000 if every else None,
+            'p99_ms': percentile(every, 99) * 1000 if every else None,
+            'errors': sum(errors.values()),
+        },
+        'errors': errors,
+        'broadcasts_delivered_per_second': heard / duration,
+        'cpu': {
+            'percent': cpu / duration * 100,
+            'ms_per_operation': cpu / total * 1000 if total else None,
+            'ms_per_connection_second': cpu / clients / duration * 1000,
+        },
+        'memory': {
+            'bytes_per_connection': memory,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+        },
+        'server_bytes_sent': {sample['labels']['stage']: sample['value']
+                              for sample in metrics.get('quicknet_bytes_sent_total', [])},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a local QServer with simulated QClients.")
+    parser.add_argument('--clients', type=int, default=10, help="number of simulated clients")
+    parser.add_argument('--mix', default='mixed', help="one of {mixes}, or weights like call=4,get=1".format(
+        mixes=', '.join(MIXES)))
+    parser.add_argument('--duration', type=float, default=5, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds run before measuring")
+    parser.add_argument('--port', type=int, default=5431)
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--loops', type=int, default=1, help="selector loops")
+    parser.add_argument('--handlers', default='inline', choices=('inline', 'thread', 'pool'),
+                        help="run handlers in the receiving thread, a thread each, or an executor")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--compare', help="results file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    params = {'clients': args.clients, 'mix': parse_mix(args.mix), 'duration': args.duration,
+              'warmup': args.warmup, 'engine': args.engine, 'loops': args.loops, 'handlers': args.handlers,
+              'seed': args.seed}
+    results = run(port=args.port, **params)
+
+    print("{:<10} {:>8} {:>10} {:>9} {:>9}".format("operation", "count", "ops/s", "p50 ms", "p99 ms"))
+    for name, op in list(results['operations'].items()) + [('total', results['total'])]:
+        print("{:<10} {:>8} {:>10.0f} {:>9.3f} {:>9.3f}".format(
+            name, op['count'], op['throughput'], op['p50_ms'] or 0, op['p99_ms'] or 0))
+    print("cpu {cpu:.0f}%, {mem:.0f} bytes per connection, {errors} errors".format(
+        cpu=results['cpu']['percent'], mem=results['memory']['bytes_per_connection'],
+        errors=results['total']['errors']))
+    if args.json:
+        write_results(args.json, 'load', params, results)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("\n{:<40} {:>12} {:>12} {:>8}".format("metric", "before", "after", "ratio"))
+        for name, a, b, ratio in compare(old['results'], results):
+            ratio = '-' if ratio is None else '{:.2f}'.format(ratio)
+            print("{:<40} {:>12.4g} {:>12.4g} {:>8}".format(name, a, b, ratio))
+
+
+if __name__ == '__main__':
+    main()
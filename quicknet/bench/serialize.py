@@ -0,0 +1,53 @@
+import argparse
+from os import urandom
+
+from quicknet import sterilizer
+from quicknet.bench import timeit_ops, write_results
+
+__all__ = ["PAYLOADS", "run"]
+
+PAYLOADS = {
+    'call': ("NEW_MSG", ("Hello dude!", "Joe"), {}),
+    'nested list': [[i, [str(i), [i * 1.5, None, True]]] for i in range(100)],
+    'nested dict': {"player{i}".format(i=i): {'x': i, 'y': -i, 'tags': ['a', 'b'], 'meta': {'hp': 100}}
+                    for i in range(100)},
+    'bytes 4k': ("MSG", (urandom(4000),), {}),
+    'bytes 1M': ("MSG", (urandom(1024 * 1024),), {}),
+}
+
+
+def run(seconds: float=0.5) -> dict:
+    results = {}
+    for name, obj in PAYLOADS.items():
+        text = sterilizer.dirty(obj)
+        binary = sterilizer.pack(obj)
+        results[name] = {
+            'text_size': len(text.encode()),
+            'binary_size': len(binary),
+            'dirty_ops': timeit_ops(sterilizer.dirty, obj, seconds=seconds),
+            'clean_ops': timeit_ops(sterilizer.clean, text, seconds=seconds),
+            'pack_ops': timeit_ops(sterilizer.pack, obj, seconds=seconds),
+            'unpack_ops': timeit_ops(sterilizer.unpack, binary, seconds=seconds),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the text and binary sterilizer formats.")
+    parser.add_argument('--seconds', type=float, default=0.5, help="time spent on each measurement")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.seconds)
+    print("{:<12} {:>10} {:>10} {:>12} {:>12} {:>9} {:>9}".format(
+        "payload", "text B", "binary B", "dirty/s", "pack/s", "encode x", "decode x"))
+    for name, r in results.items():
+        print("{:<12} {:>10} {:>10} {:>12.0f} {:>12.0f} {:>9.1f} {:>9.1f}".format(
+            name, r['text_size'], r['binary_size'], r['dirty_ops'], r['pack_ops'],
+            r['pack_ops'] / r['dirty_ops'], r['unpack_ops'] / r['clean_ops']))
+    if args.json:
+        write_results(args.json, 'serialize', {'seconds': args.seconds}, results)
+
+
+if __name__ == '__main__':
+    main()
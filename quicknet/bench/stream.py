@@ -0,0 +1,101 @@
+import argparse
+import os
+from threading import Event
+import time
+import tracemalloc
+
+from quicknet.bench import percentile, write_results
+from quicknet.client import QClient
+from quicknet.server import QServer
+
+__all__ = ["run"]
+
+
+def _serve(port: int, engine: str, received: Event) -> QServer:
+    server = QServer(port, local_only=True, engine=engine)
+
+    @server.on("BLOB")
+    def blob(data):
+        return len(data)
+
+    @server.on("STREAM")
+    def stream(incoming):
+        for _ in incoming:
+            pass
+        received.set()
+
+    @server.on("PING", thread=False)
+    def ping():
+        return True
+
+    server.start()
+    return server
+
+
+def _measure(port: int, engine: str, size: int, streamed: bool) -> dict:
+    received = Event()
+    server = _serve(port, engine, received)
+    time.sleep(0.1)
+    client = QClient('127.0.0.1', port, sync=False, timeout=60)
+    client.start()
+    while client.session is None:
+        time.sleep(0.01)
+
+    data = os.urandom(size)
+    # Client and server share this process, the peak covers both ends of the transfer.
+    tracemalloc.start()
+    began = time.perf_counter()
+    if streamed:
+        transfer = client.stream("STREAM", data)
+    else:
+        transfer = client.request("BLOB", data, timeout=60)
+    pings = []
+    while not transfer.done():
+        sent = time.perf_counter()
+        client.wait(client.request("PING"))
+        pings.append(time.perf_counter() - sent)
+    transfer.result()
+    # The sender is done once END is out, the server may still be reading the last chunks.
+    if streamed:
+        received.wait(60)
+    elapsed = time.perf_counter() - began
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    client.quit()
+    server.quit()
+
+    pings.sort()
+    return {
+        'mb_per_second': size / elapsed / 1e6,
+        'peak_memory_mb': peak / 1e6,
+        'pings_during_transfer': len(pings),
+        'ping_p99_ms': percentile(pings, 99) * 1000 if pings else None,
+    }
+
+
+def run(size: int=32 * 1024 * 1024, port: int=5434, engine: str='selector') -> dict:
+    # Every mode gets its own port, the last server's can still be in TIME_WAIT.
+    return {'message': _measure(port, engine, size, False),
+            'stream': _measure(port + 1, engine, size, True)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send one large payload as a single message and as a stream.")
+    parser.add_argument('--mb', type=float, default=32, help="payload size in MB")
+    parser.add_argument('--port', type=int, default=5434)
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = {'size': int(args.mb * 1024 * 1024), 'engine': args.engine}
+    results = run(port=args.port, **params)
+    print("{:<8} {:>8} {:>10} {:>7} {:>12}".format("mode", "MB/s", "peak MB", "pings", "ping p99 ms"))
+    for mode, r in results.items():
+        print("{:<8} {:>8.1f} {:>10.1f} {:>7} {:>12.2f}".format(
+            mode, r['mb_per_second'], r['peak_memory_mb'], r['pings_during_transfer'], r['ping_p99_ms'] or 0))
+    if args.json:
+        write_results(args.json, 'stream', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import time
+from threading import Event, Thread
+
+from quicknet.bench import write_results
+from quicknet.bench.load import _cpu
+from quicknet.client import QClient
+from quicknet.server import QServer
+
+__all__ = ["run"]
+
+
+def _sent(server: QServer) -> tuple:
+    metrics = server.metrics.export()
+    frames = sum(sample['value'] for sample in metrics.get('quicknet_frames_sent_total', []))
+    wire = sum(sample['value'] for sample in metrics.get('quicknet_bytes_sent_total', [])
+               if sample['labels']['stage'] == 'wire')
+    return frames, wire
+
+
+def _game(server: QServer, events: int, rate: float, done: Event):
+    # Every frame, each player hears about every move and one shared world update.
+    frame = 0
+    next_frame = time.perf_counter()
+    while not done.is_set():
+        for client in list(server.clients.values()):
+            for i in range(events):
+                try:
+                    client.emit("MOVE", frame, i, 1.5, -2.25)
+                except Exception:
+                    break
+        server.broadcast("WORLD", frame)
+        frame += 1
+        next_frame += 1 / rate
+        delay = next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _measure(clients: int, events: int, rate: float, duration: float, port: int, engine: str,
+             batch_interval: float) -> dict:
+    server = QServer(port, local_only=True, engine=engine, batch_interval=batch_interval)
+    server.start()
+    time.sleep(0.1)
+    connections = []
+    for _ in range(clients):
+        client = QClient('127.0.0.1', port, sync=False)
+        client.heard = 0
+
+        @client.on("MOVE", thread=False)
+        def move(frame, i, x, y, client=client):
+            client.heard += 1
+
+        @client.on("WORLD", thread=False)
+        def world(frame, client=client):
+            client.heard += 1
+
+        client.start()
+        connections.append(client)
+    deadline = time.monotonic() + 5 + clients * 0.01
+    while any(client.session is None for client in connections):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Clients didn't get a session from the server in time")
+        time.sleep(0.01)
+
+    done = Event()
+    game = Thread(target=_game, args=(server, events, rate, done), daemon=True)
+    game.start()
+    time.sleep(0.5)
+    frames, wire = _sent(server)
+    heard, cpu = sum(client.heard for client in connections), _cpu()
+    time.sleep(duration)
+    cpu = _cpu() - cpu
+    heard = sum(client.heard for client in connections) - heard
+    frames, wire = [after - before for before, after in zip((frames, wire), _sent(server))]
+    done.set()
+    game.join()
+    for client in connections:
+        client.quit()
+    server.quit()
+    return {
+        'events_per_second': heard / duration,
+        'frames_per_second': frames / duration,
+        'events_per_frame': heard / frames if frames else None,
+        'wire_bytes_per_event': wire / heard if heard else None,
+        'cpu_percent': cpu / duration * 100,
+    }
+
+
+def run(clients: int=20, events: int=10, rate: float=60, duration: float=3, port: int=5433, engine: str='selector',
+        batch_interval: float=1 / 60) -> dict:
+    # The first server's port can still be in TIME_WAIT, the second one listens on the next port.
+    return {'unbatched': _measure(clients, events, rate, duration, port, engine, None),
+            'batched': _measure(clients, events, rate, duration, port + 1, engine, batch_interval)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send game-style bursts of small events, with and without batching.")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--events', type=int, default=10, help="events sent to each client every frame")
+    parser.add_argument('--rate', type=float, default=60, help="frames per second")
+    parser.add_argument('--duration', type=float, default=3, help="measured seconds for each mode")
+    parser.add_argument('--port', type=int, default=5433)
+    parser.add_argument('--engine', default='selector', choices=('thread', 'selector'))
+    parser.add_argument('--batch-interval', type=float, default=1 / 60)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = {'clients': args.clients, 'events': args.events, 'rate': args.rate, 'duration': args.duration,
+              'engine': args.engine, 'batch_interval': args.batch_interval}
+    results = run(port=args.port, **params)
+    print("{:<10} {:>10} {:>10} {:>12} {:>10} {:>6}".format("mode", "events/s", "frames/s", "events/frame",
+                                                            "B/event", "cpu %"))
+    for mode, r in results.items():
+        print("{:<10} {:>10.0f} {:>10.0f} {:>12.1f} {:>10.1f} {:>6.0f}".format(
+            mode, r['events_per_second'], r['frames_per_second'], r['events_per_frame'] or 0,
+            r['wire_bytes_per_event'] or 0, r['cpu_percent']))
+    if args.json:
+        write_results(args.json, 'ticks', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,41 @@
 import logging as log
-from time import time
-from threading import Thread
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from threading import Thread, RLock
+from time import monotonic
 from traceback import print_exception
 import ssl
 import socket
 import sys
 import zlib
 
-from quicknet import event, utils, sterilizer
+from quicknet import event, protocol, utils
+from quicknet.pending import PendingRequests
+from quicknet.stream import CHUNK_SIZE, STREAM_COMMANDS, WINDOW, Stream, Streams
+from quicknet.executor import EventExecutor
+from quicknet.heartbeat import Heartbeat
+from quicknet.metrics import Metrics
+from quicknet.outbox import OVERFLOW_POLICIES, Outbox, send_some
+from quicknet.store import RemoteStore
+from quicknet.sync import Replica
+from quicknet.timer import TimerWheel, wheel
 
 __all__ = ["QClient"]
 
 
 class QClient(event.EventThreader, Thread):
 
-    EVENTS = 'SERVER_DISCONNECTED',
+    EVENTS = 'SERVER_DISCONNECTED', 'BACKPRESSURE', 'DRAINED'
     DEFAULT_READ_SIZE = 2048
 
     def __init__(self, ip: str, port: int, buffer_size: int=None, family: int=socket.AF_INET,
-                 type: int=socket.SOCK_STREAM, use_ssl: bool=False, ssl_data: dict=None, timeout: int=2):
+                 type: int=socket.SOCK_STREAM, use_ssl: bool=False, ssl_data: dict=None, timeout: int=2,
+                 executor: EventExecutor=None, compression: dict=None, binary: bool=True,
+                 high_water: int=4 * 1024 * 1024, low_water: int=1024 * 1024, overflow: str='none',
+                 sync: bool or list=True, session: str=None, metrics: Metrics=None,
+                 tls_session: ssl.SSLSession=None, batch_interval: float=None, batch_bytes: int=16 * 1024,
+                 heartbeat: float=None, read_timeout: float=None, write_timeout: float=None):
         Thread.__init__(self)
-        event.EventThreader.__init__(self)
+        event.EventThreader.__init__(self, executor, metrics)
 
         self.sock = socket.socket(family=family, type=type)  # type: socket.socket
         self.buffer_size = buffer_size                       # type: int
@@ -28,39 +43,92 @@ class QClient(event.EventThreader, Thread):
         self.port = port                                     # type: int
         self.running = False                                 # type: bool
         self.ssl = use_ssl                                   # type: bool
-        self._reqs = {}                                      # type: dict
+        self._reqs = PendingRequests()                       # type: PendingRequests
+        self.sync = sync                                     # type: bool or list
+        self.session = session                               # type: str
+        self.cache = Replica()                               # type: Replica
+        self.store = RemoteStore(self)                       # type: RemoteStore
         self.timeout = timeout                               # type: int
-        self._buffer = bytearray()                           # type: bytearray
+        self._parser = protocol.FrameParser()                # type: protocol.FrameParser
+        self._codec = protocol.Codec(binary=binary, metrics=self.metrics, **(compression or {}))
+        self._send_lock = RLock()
+        self.batch_interval = batch_interval                 # type: float
+        self.batch_bytes = batch_bytes                       # type: int
+        self.ticker = TimerWheel(batch_interval) if batch_interval else None
+        self._batch = protocol.Batch() if batch_interval else None
+        self._batch_pending = False
+        # The server is pinged after heartbeat seconds of silence, and given up on after read_timeout.
+        self.heartbeat = Heartbeat.make(heartbeat, read_timeout, write_timeout)
+        self._last_read = 0.0                                # type: float
+        self._outbox = Outbox(high_water, low_water, self._on_congested, self._on_drained)
+        self._streams = Streams(self.send_obj, self._open_stream)
+        self.metrics.gauge('outbound_queue_bytes', lambda: self._outbox.size, help="Bytes waiting to be written to "
+                           "the server.")
+        self._writer = Thread(target=self._drain, name="quicknet-client-writer", daemon=True)
+        self.overflow = overflow                             # type: str
         self.error_handler()
 
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {policy}, expected one of {policies}".format(
+                policy=overflow, policies=OVERFLOW_POLICIES))
+
+        self.ssl_context = utils.make_ssl_context(ssl_data) if use_ssl else None
         if use_ssl:
-            if ssl_data is None:
-                ssl_data = {}
-            self.sock = ssl.wrap_socket(self.sock, ssl_data.get('keyfile'), ssl_data.get('certfile'), False,
-                                        ssl_data.get('cert_reqs', ssl.CERT_NONE),
-                                        ssl_data.get('ssl_version', ssl.PROTOCOL_SSLv23), ssl_data.get('ca_certs'),
-                                        ssl_data.get('do_handshake_on_connect', True),
-                                        ssl_data.get('suppress_ragged_eofs', True), ssl_data.get('ciphers'))
+            hostname = ip if self.ssl_context.check_hostname else None
+            self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=hostname, session=tls_session)
             log.debug("Added SSL to QClient instance.")
         log.debug("QClient instance finished initialization.")
 
+    @property
+    def tls_session(self) -> ssl.SSLSession:
+        # Pass it, and the same ssl_context, to the next QClient to skip the full handshake when reconnecting.
+        return self.sock.session if self.ssl_context is not None else None
+
     def __getitem__(self, item):
-        self._reqs[('GET', item)] = '__waiting'
-        self.send(sterilizer.dirty(['GET', item]))
-        start = time()
-        while self._reqs[('GET', item)] == '__waiting':
-            if self.timeout is not None:
-                if time() - start > self.timeout:
-                    raise TimeoutError("Server took to long to respond")
-        return self._reqs[('GET', item)]
+        if self.cache.covers(item):
+            return self.cache.data.get(item)
+        return self.wait(self.get(item))
 
     def __setitem__(self, key, value):
-        req = sterilizer.dirty(['SET', key, value])
-        self.send(req)
+        self.set(key, value)
 
     def __delitem__(self, key):
-        req = sterilizer.dirty(['DEL', key])
-        self.send(req)
+        self.delete(key)
+
+    def _request(self, command: str, *args) -> Future:
+        return self._reqs.issue(self.send_obj, [command] + list(args))
+
+    def wait(self, future: Future):
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError("Server took to long to respond")
+
+    def get(self, key) -> Future:
+        return self._request('GET', key)
+
+    def set(self, key, value) -> Future:
+        future = self._request('SET', key, value)
+        self.cache.writing(future, {key: value})
+        return future
+
+    def delete(self, key) -> Future:
+        future = self._request('DEL', key)
+        self.cache.writing(future, removed=[key])
+        return future
+
+    def get_many(self, keys) -> Future:
+        return self._request('GET_MANY', list(keys))
+
+    def set_many(self, values: dict) -> Future:
+        values = dict(values)
+        future = self._request('SET_MANY', values)
+        self.cache.writing(future, values)
+        return future
+
+    def subscribe(self, keys: list=None) -> Future:
+        return self._request('SUBSCRIBE', None if keys is None else list(keys))
 
     @staticmethod
     def error_handler(callback=None):
@@ -71,80 +139,230 @@ class QClient(event.EventThreader, Thread):
         log.info("Exception hook changed to: {handler}.".format(handler=sys.excepthook))
 
     def call(self, handler: str, *args, **kwargs):
-        data = sterilizer.dirty((handler, args, kwargs))
-        self.send(data)
+        self.send_obj((handler, args, kwargs))
+
+    def request(self, handler: str, *args, timeout: float=None, **kwargs) -> Future:
+        timeout = self.timeout if timeout is None else timeout
+        return self._reqs.issue(self.send_obj, ['CALL', handler, args, kwargs, timeout], timeout)
+
+    def stream(self, handler: str, source, *args, chunk_size: int=CHUNK_SIZE, window: int=WINDOW,
+               **kwargs) -> Future:
+        # Sends bytes, a file or an iterable of bytes in chunks, the server's handler gets a Stream to read them
+        # from. The future resolves to the number of bytes sent.
+        return self._streams.open(handler, source, args, kwargs, chunk_size, window)
+
+    def _open_stream(self, incoming: Stream, handler: str, args: tuple, kwargs: dict):
+        if handler in self.EVENTS:
+            log.info("Server streamed to event ({e}) only triggerable by client side.".format(e=handler))
+            incoming.close()
+            return
+        # Nobody would ever read it, the sender is told right away instead of waiting for credit forever.
+        if not self.spawn(self, handler, incoming, *args, **kwargs):
+            incoming.close()
 
     def run(self):
         self.sock.connect((self.ip, self.port))
+        utils.no_delay(self.sock)
         self.running = True
+        self._last_read = monotonic()
+        self._writer.start()
+        if self.heartbeat is not None:
+            wheel.call_later(self.heartbeat.check(self._last_read, self._last_read)[1], self._check_idle)
+        self.send_obj(['HELLO', self._codec.capabilities(), self.session])
+        if self.sync is not False:
+            self.subscribe(None if self.sync is True else self.sync)
         log.info("Starting connection loop (connected to server)")
         while self.running:
             try:
-                data = self.sock.recv(self.buffer_size if self.buffer_size is not None else self.DEFAULT_READ_SIZE)
-            except ConnectionResetError:
+                received = self._parser.recv_into(self.sock, self.buffer_size or self.DEFAULT_READ_SIZE)
+            except (ConnectionResetError, OSError):
+                received = 0
+            if not received:
+                if self.running:
+                    self.quit()
+                    log.info("Server disconnected, ending loop.")
+                    self.emit(self, "SERVER_DISCONNECT", self)
+                continue
+            self._last_read = monotonic()
+            try:
+                for flags, payload in self._parser.frames():
+                    try:
+                        infos = self._codec.load_all(flags, payload)
+                    except (zlib.error, UnicodeDecodeError, utils.BadSterilization):
+                        log.info("Server sent us a malformed call.")
+                        self.emit(self, "BAD_CALL", bytes(payload))
+                    else:
+                        log.debug("Received data from server, %s bytes.", len(payload))
+                        for info in infos:
+                            self.handle(info)
+            except (utils.ProtocolError, utils.DataOverflowError) as e:
+                log.info("Server sent us an invalid frame ({e}), disconnecting.".format(e=e))
                 self.quit()
-                log.info("Server disconnected, ending loop.")
                 self.emit(self, "SERVER_DISCONNECT", self)
-                continue
-            if data:
+
+    def handle(self, info):
+        if type(info) == tuple:
+            if len(info) < 3 or len(info) > 3:
+                log.info("Server sent us either to much or too little information.")
+                self.call("BAD_CALL", utils.describe(info))
+            elif info[0] in self.EVENTS:
+                log.info("Server sent event ({e}) only triggerable by client side.".format(e=info[0]))
+                self.call("BAD_CALL", utils.describe(info))
+            else:
+                handler, args, kwargs = info
+                self.emit(self, handler, *args, **kwargs)
+        elif type(info) == list and info:
+            if info[0] == 'HELLO':
+                self._codec.agree(info[1] if len(info) > 1 else [])
+                log.debug("Server can read {caps}.".format(caps=info[1:]))
+            elif info[0] == 'PING':
+                self.send_obj(['PONG'])
+            elif info[0] == 'PONG':
+                pass
+            elif info[0] == 'FOUND':
+                self._reqs.resolve(info[3], info[2])
+                log.debug("Server said shared data %s was %s", info[1], info[2])
+            elif info[0] == 'CHANGED':
+                self._reqs.resolve(info[3], info[2])
+                log.debug("Server set shared data %s to %s", info[1], info[2])
+            elif info[0] == 'REMOVED':
+                self._reqs.resolve(info[2], None)
+                log.debug("Server deleted shared data %s", info[1])
+            elif info[0] in ('FOUND_MANY', 'CHANGED_MANY'):
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] == 'DENIED':
+                self._reqs.fail(info[2], utils.SharingLockedError("Server doesn't allow changing {key}".format(
+                    key=info[1])))
+            elif info[0] == 'SESSION':
+                self.session = info[1]
+                log.debug("Server gave us session {token}".format(token=info[1]))
+            elif info[0] == 'SYNC':
+                self.cache.apply(info[1], info[2], info[3], info[4])
+                log.debug("Server synced shared data to version %s", info[1])
+            elif info[0] == 'SUBSCRIBED':
+                self.cache.subscribed(info[1])
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] in STREAM_COMMANDS:
                 try:
-                    self._buffer.extend(data)
-                    if len(data) < 4 or data[-4:] != b'\x00\x00\xff\xff':
-                        continue
-                    inflator = zlib.decompressobj()
-                    inflated_data = inflator.decompress(self._buffer) + inflator.flush(zlib.Z_SYNC_FLUSH)
-                    self._buffer = bytearray()
-                    info = sterilizer.clean(inflated_data.decode())
-                except zlib.error as ERROR:
-                    print(ERROR)
-                    log.info("Server sent us a malformed call.")
-                    self.emit("BAD_CALL", data)
-                else:
-                    log.debug("Received data from server, {len} bytes.".format(len=len(data)))
-                    if type(info) == tuple:
-                        if len(info) < 3 or len(info) > 3:
-                            log.info("Server sent us either to much or too little information.")
-                            self.call("BAD_CALL", info)
-                        elif info[0] in self.EVENTS:
-                            log.info("Server sent event ({e}) only triggerable by client side.".format(e=info[0]))
-                            self.call("BAD_CALL", info)
-                        else:
-                            handler, args, kwargs = info
-                            self.emit(self, handler, *args, **kwargs)
-                    elif type(info) == list:
-                        if info[0] == 'FOUND':
-                            self._reqs[('GET', info[1])] = info[2]
-                            log.debug("Server said shared data {key} was {val}".format(key=info[1], val=info[2]))
-                        elif info[0] == 'CHANGED':
-                            log.debug("Server set shared data {key} to {val}".format(key=info[1], val=info[2]))
-                        elif info[0] == 'REMOVED':
-                            log.debug("Server deleted shared data {key}".format(key=info[1]))
-                        else:
-                            log.info("Server sent us invalid information")
-                            self.emit("BAD_CALL", info)
-                    else:
-                        log.info("Server sent us unrecognized information")
-                        self.emit("BAD_CALL", info)
+                    self._streams.handle(info)
+                except (IndexError, TypeError, ValueError):
+                    log.info("Server sent us a malformed stream message.")
+                    self.emit(self, "BAD_CALL", info)
+            elif info[0] == 'CALL':
+                self.answer(self, info, self.send_obj)
+            elif info[0] == 'RESULT':
+                self._reqs.resolve(info[2], info[1])
+            elif info[0] == 'ERROR':
+                self._reqs.fail(info[2], utils.RemoteError(info[1]))
+            else:
+                log.info("Server sent us invalid information")
+                self.emit(self, "BAD_CALL", info)
+        else:
+            log.info("Server sent us unrecognized information")
+            self.emit(self, "BAD_CALL", info)
 
     def quit(self):
+        # Data that was already sent is still written out, the writer closes the socket after it.
+        if self._batch is not None:
+            self.flush()
+            self.ticker.stop()
         self.running = False
-        self.sock.close()
+        flushing = self._outbox and self._writer.is_alive()
+        try:
+            self.sock.shutdown(socket.SHUT_RD if flushing else socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._outbox.close()
+        if not flushing:
+            self.sock.close()
+        self._reqs.fail_all(utils.NotRunningError("Disconnected from server"))
+        self._streams.close(utils.NotRunningError("Disconnected from server"))
         log.info("Client has been stopped.")
 
+    def _check_idle(self):
+        if not self.running:
+            return
+        action, delay = self.heartbeat.check(monotonic(), self._last_read, self._outbox.stalled_since())
+        if action in ('read', 'write'):
+            log.info("Server timed out {doing}, disconnecting.".format(
+                doing="without sending anything" if action == 'read' else "with writes stuck"))
+            self._outbox.clear()
+            self.quit()
+            self.emit(self, "SERVER_DISCONNECT", self)
+            return
+        if action == 'ping' and self._codec.peer_ping:
+            try:
+                self.send_obj(['PING'])
+            except utils.NotRunningError:
+                return
+        wheel.call_later(delay, self._check_idle)
+
+    def _drain(self):
+        try:
+            while True:
+                buffers = self._outbox.wait()
+                if not buffers:
+                    return
+                self._outbox.consume(send_some(self.sock, buffers))
+        except OSError:
+            log.info("Couldn't write to the server, dropping queued data.")
+            self._outbox.clear()
+        finally:
+            if not self.running:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock.close()
+
+    def _on_congested(self):
+        self.emit(self, 'BACKPRESSURE', self)
+        if self.overflow == 'disconnect' and self.running:
+            log.info("Server couldn't keep up, disconnecting.")
+            self._outbox.clear()
+            self.quit()
+
+    def _on_drained(self):
+        self.emit(self, 'DRAINED', self)
+
     def send(self, data: str or bytes):
         data = data if type(data) is bytes else data.encode()
+        self._transmit(data, 0)
+
+    def send_obj(self, obj: any):
+        flags, data = self._codec.serialize(obj)
+        # Events wait for the next tick when batching, everything else goes out right away (after the batch).
+        if type(obj) == tuple and self._batch is not None and self._codec.peer_batch:
+            self._transmit(data, flags, batched=True)
+        else:
+            self._transmit(data, flags)
 
+    def _transmit(self, data: bytes, flags: int, batched: bool=False):
         if not self.running:
             log.warning("QClient instance isn't connected to the server, unable to send data.")
             raise utils.NotRunningError("Not connected to server")
 
-        deflator = zlib.compressobj()
-        deflated_data = deflator.compress(data) + deflator.flush(zlib.Z_SYNC_FLUSH)
+        with self._send_lock:
+            if self._outbox.congested and self.overflow == 'drop':
+                log.debug("Server is too far behind, dropping message.")
+                return
+            if not batched:
+                self._flush_batch()
+                self._outbox.put(self._codec.encode(data, flags))
+            else:
+                if not self._batch_pending:
+                    self._batch_pending = True
+                    self.ticker.call_later(self.batch_interval, self.flush)
+                if self._batch.add(flags, data) >= self.batch_bytes or len(self._batch) >= protocol.MAX_BATCH_ENTRIES:
+                    self._flush_batch()
+        log.debug("Sent data to server (%s bytes)", len(data))
 
-        while len(deflated_data) > self.DEFAULT_READ_SIZE:
-            to_send = deflated_data[:self.DEFAULT_READ_SIZE]
-            self.sock.sendall(to_send)
-            deflated_data = deflated_data[self.DEFAULT_READ_SIZE:]
+    def _flush_batch(self):
+        if self._batch:
+            self._outbox.put(self._codec.encode(self._batch.take(), protocol.FLAG_BATCH))
 
-        self.sock.sendall(deflated_data)
-        log.debug("Sent data to server ({len} bytes)".format(len=len(data)))
+    def flush(self):
+        with self._send_lock:
+            self._batch_pending = False
+            if self.running:
+                self._flush_batch()
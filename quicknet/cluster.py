@@ -0,0 +1,223 @@
+import logging as log
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from threading import Event, Lock, Thread
+import time
+
+from quicknet import protocol, sterilizer
+
+__all__ = ["Cluster", "Hub", "Link"]
+
+
+def _frame(message: list) -> bytes:
+    return protocol.pack_frame(sterilizer.pack(message), protocol.FLAG_BINARY)
+
+
+def _read_frames(sock: socket.socket, on_frame):
+    # Calls on_frame(raw frame, payload) until the other end hangs up.
+    parser = protocol.FrameParser()
+    while True:
+        try:
+            if not parser.recv_into(sock, 65536):
+                return
+        except OSError:
+            return
+        for flags, payload in parser.frames():
+            on_frame(protocol.pack_frame(bytes(payload), flags), payload)
+
+
+class Hub:
+    # Runs in the supervisor. Every frame a worker process sends is relayed to all the other workers.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        self._peers = []
+        self._lock = Lock()
+        Thread(target=self._accept, name="quicknet-hub", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                peer, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._peers.append(peer)
+            Thread(target=self._relay, args=(peer,), name="quicknet-hub-peer", daemon=True).start()
+
+    def _relay(self, peer: socket.socket):
+        _read_frames(peer, lambda frame, payload: self._send(frame, skip=peer))
+        with self._lock:
+            if peer in self._peers:
+                self._peers.remove(peer)
+        peer.close()
+
+    def _send(self, frame: bytes, skip: socket.socket=None):
+        with self._lock:
+            peers = [peer for peer in self._peers if peer is not skip]
+        for peer in peers:
+            try:
+                peer.sendall(frame)
+            except OSError:
+                log.info("Worker process left the cluster bus.")
+
+    def publish(self, message: list):
+        self._send(_frame(message))
+
+    def close(self):
+        self.sock.close()
+        with self._lock:
+            peers, self._peers = self._peers, []
+        for peer in peers:
+            peer.close()
+
+    def detach(self):
+        # In a freshly forked worker: drop the hub's sockets without touching its lock, which another thread of
+        # the supervisor might have held at the time of the fork.
+        self.sock.close()
+        for peer in list(self._peers):
+            peer.close()
+
+
+class Link:
+    # A worker process' connection to the hub.
+
+    def __init__(self, path: str, on_message):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.on_message = on_message
+        self._lock = Lock()
+        Thread(target=_read_frames, args=(self.sock, self._receive), name="quicknet-link", daemon=True).start()
+
+    def _receive(self, frame: bytes, payload: memoryview):
+        try:
+            self.on_message(sterilizer.unpack(bytes(payload)))
+        except Exception:
+            log.exception("Couldn't deliver a message from another worker process.")
+
+    def publish(self, message: list):
+        with self._lock:
+            self.sock.sendall(_frame(message))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Cluster:
+    # Forks the worker processes of a QServer and keeps them running. Every worker opens its own listening socket
+    # with SO_REUSEPORT, so the kernel spreads new connections over them.
+
+    MIN_UPTIME = 1
+
+    def __init__(self, server, processes: int):
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("Running a server in several processes needs fork() and SO_REUSEPORT.")
+        if processes < 1:
+            raise ValueError("A cluster needs at least one process.")
+
+        self.server = server
+        self.processes = processes            # type: int
+        self.pids = {}                        # type: dict
+        self.supervisor = True                # type: bool
+        self._dir = tempfile.mkdtemp(prefix='quicknet-')
+        self._stopped = Event()
+        self.hub = Hub(os.path.join(self._dir, 'bus'))
+        self.link = None                      # type: Link
+
+    def fork(self, max: int=50):
+        for _ in range(self.processes):
+            self._spawn(max)
+
+    def _spawn(self, max: int):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.monotonic()
+            return
+        # The worker never returns to the code that started the server.
+        code = 0
+        try:
+            self.supervisor = False
+            self.hub.detach()
+            self.link = Link(self.hub.path, self.server.deliver)
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.server.running and self.server.quit())
+            self.server.run(max)
+        except BaseException:
+            log.exception("Worker process {pid} crashed.".format(pid=os.getpid()))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def publish(self, message: list):
+        if self.supervisor:
+            self.hub.publish(message)
+        else:
+            self.link.publish(message)
+
+    def supervise(self, max: int=50):
+        # Workers that die while the server is running are replaced, unless they die right after starting.
+        while not self._stopped.wait(0.2):
+            for pid, started in list(self.pids.items()):
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done, status = pid, 0
+                if not done:
+                    continue
+                del self.pids[pid]
+                if self._stopped.is_set():
+                    continue
+                if time.monotonic() - started < self.MIN_UPTIME:
+                    log.error("Worker process {pid} exited ({status}) right after starting, not replacing it.".format(
+                        pid=pid, status=status))
+                else:
+                    log.warning("Worker process {pid} exited ({status}), starting another.".format(
+                        pid=pid, status=status))
+                    self._spawn(max)
+
+    def stop(self, timeout: float=5):
+        if not self.supervisor:
+            self.link.close()
+            return
+
+        self._stopped.set()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.pids:
+            if not self._reap(pid, timeout):
+                log.warning("Worker process {pid} didn't stop, killing it.".format(pid=pid))
+                os.kill(pid, signal.SIGKILL)
+                self._reap(pid, None)
+        self.pids = {}
+        self.hub.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    @staticmethod
+    def _reap(pid: int, timeout: float) -> bool:
+        if timeout is None:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            return True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    return True
+            except ChildProcessError:
+                return True
+            time.sleep(0.05)
+        return False
@@ -0,0 +1,295 @@
+import logging as log
+from collections import deque
+from itertools import cycle
+from threading import Thread, Lock, get_ident
+import selectors
+import socket
+import ssl
+
+from quicknet import utils, worker
+from quicknet.outbox import send_some
+from quicknet.timer import wheel
+
+__all__ = ["SelectorWorker", "EventLoop", "SelectorEngine"]
+
+
+class SelectorWorker(worker.BaseWorker):
+
+    __slots__ = 'loop', '_out_lock', 'handshaking'
+
+    def __init__(self, id: str, conn: socket.socket, manager, loop):
+        worker.BaseWorker.__init__(self, conn, manager)
+
+        self.name = id                   # type: str
+        self.loop = loop                 # type: EventLoop
+        self._out_lock = Lock()
+        self.handshaking = isinstance(conn, ssl.SSLSocket)
+        conn.setblocking(False)
+        log.debug("Finished SelectorWorker initialization.")
+
+    def is_alive(self):
+        return not self.closed
+
+    def start(self):
+        self.loop.call_soon(self.loop.register, self)
+        if self.handshaking:
+            wheel.call_later(self.server.handshake_timeout, self._handshake_expired)
+
+    def _write(self, data: bytes):
+        with self._out_lock:
+            waiting = bool(self._outbox) or self.handshaking
+            self._outbox.put(data)
+            if waiting:
+                return
+            try:
+                self._flush()
+            except OSError as e:
+                lost = e
+                self._outbox.clear()
+            else:
+                lost = None
+                if self._outbox:
+                    self.loop.call_soon(self.loop.want_write, self, True)
+        if lost is not None:
+            # Same as a failed write on the loop: the connection is gone. Events still batched go with it, so
+            # kill() has nothing left to write.
+            log.info("Couldn't write to {addr} ({e}), dropping connection.".format(addr=self.addr, e=lost))
+            if self._batch:
+                self._batch.take()
+            if not self.closed:
+                self.kill()
+            raise utils.NotRunningError("Connection to the client was lost.")
+
+    def _flush(self):
+        try:
+            self._outbox.consume(send_some(self.conn, self._outbox.peek()))
+        except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            pass
+
+    def _handshake(self):
+        # Non-blocking, the loop calls this again whenever the socket is ready for whatever TLS is waiting on.
+        try:
+            self.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.loop.selector.modify(self.conn, selectors.EVENT_READ, self.on_ready)
+            return
+        except ssl.SSLWantWriteError:
+            self.loop.selector.modify(self.conn, selectors.EVENT_WRITE, self.on_ready)
+            return
+        except (ssl.SSLError, OSError) as e:
+            log.info("TLS handshake with {addr} failed ({e}).".format(addr=self.addr, e=e))
+            if not self.closed:
+                self.kill()
+            return
+        with self._out_lock:
+            self.handshaking = False
+        self.loop.want_write(self, bool(self._outbox))
+        self.on_readable()
+
+    def _handshake_expired(self):
+        if self.handshaking and not self.closed:
+            log.info("TLS handshake with {addr} took too long.".format(addr=self.addr))
+            self.kill()
+
+    def on_ready(self, mask: int):
+        if self.handshaking:
+            self._handshake()
+            return
+        if mask & selectors.EVENT_READ:
+            self.on_readable()
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self.on_writable()
+
+    def on_readable(self):
+        # TLS can hold decrypted bytes the socket won't signal for again, keep reading while it has some pending.
+        while True:
+            try:
+                received = self._parser.recv_into(self.conn, self.server.buffer_size or 2048)
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except (ConnectionResetError, OSError, ConnectionAbortedError):
+                received = 0
+            if not received:
+                log.info("Client Disconnected (addr {addr})".format(addr=self.addr))
+                if not self.closed:
+                    self.kill()
+                return
+            wait = self.process()
+            if wait:
+                self._pause(wait)
+                return
+            if self.closed or not isinstance(self.conn, ssl.SSLSocket) or not self.conn.pending():
+                return
+
+    def _pause(self, wait: float):
+        # Over a rate limit with action 'delay': the socket isn't watched (or read) until the client may go on.
+        self.loop.mute(self)
+        wheel.call_later(wait, self.loop.call_soon, self._resume)
+
+    def _resume(self):
+        if self.closed:
+            return
+        wait = self.process()
+        if wait:
+            self._pause(wait)
+            return
+        self.loop.register(self)
+        # TLS may have decrypted bytes waiting that the selector won't report.
+        self.on_readable()
+
+    def on_writable(self):
+        with self._out_lock:
+            try:
+                self._flush()
+            except OSError:
+                self._outbox.clear()
+            if not self._outbox:
+                self.loop.want_write(self, False)
+
+    def _close(self):
+        self.loop.call_soon(self.loop.unregister, self)
+
+
+class EventLoop(Thread):
+
+    SELECT_TIMEOUT = 1
+
+    def __init__(self, engine, index: int):
+        Thread.__init__(self, name="quicknet-loop-{i}".format(i=index), daemon=True)
+
+        self.engine = engine
+        self.selector = None                  # type: selectors.BaseSelector
+        self.running = False
+        self._calls = deque()
+        self._waker = self._wakee = None      # type: socket.socket
+
+    def __len__(self):
+        return len(self.selector.get_map()) - 1 if self.selector is not None else 0
+
+    def open(self):
+        # Made when serving starts rather than with the server, which a cluster forks: worker processes sharing one
+        # epoll instance and waker would get each other's events.
+        self.selector = selectors.DefaultSelector()
+        self._waker, self._wakee = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakee.setblocking(False)
+        self.selector.register(self._wakee, selectors.EVENT_READ, self._drain_waker)
+
+    def call_soon(self, func, *args):
+        self._calls.append((func, args))
+        if self._waker is not None and get_ident() != self.ident:
+            try:
+                self._waker.send(b'\x00')
+            except (BlockingIOError, OSError):
+                pass
+
+    def _drain_waker(self, mask: int):
+        try:
+            while self._wakee.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def register(self, client: SelectorWorker):
+        if client.closed:
+            client.conn.close()
+            return
+        self.selector.register(client.conn, selectors.EVENT_READ, client.on_ready)
+        if client._outbox:
+            self.want_write(client, True)
+
+    def mute(self, client: SelectorWorker):
+        # Stops watching the connection without closing it, register() picks it up again.
+        try:
+            self.selector.unregister(client.conn)
+        except (KeyError, ValueError):
+            pass
+
+    def unregister(self, client: SelectorWorker):
+        try:
+            self.selector.unregister(client.conn)
+        except (KeyError, ValueError):
+            pass
+        client.conn.close()
+
+    def want_write(self, client: SelectorWorker, enable: bool):
+        mask = selectors.EVENT_READ | selectors.EVENT_WRITE if enable else selectors.EVENT_READ
+        try:
+            self.selector.modify(client.conn, mask, client.on_ready)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        self.running = True
+        while self.running:
+            while self._calls:
+                func, args = self._calls.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    self._failed(func, args)
+            for key, mask in self.selector.select(self.SELECT_TIMEOUT):
+                try:
+                    key.data(mask)
+                except Exception:
+                    self._failed(key.data, ())
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not self._wakee:
+                key.fileobj.close()
+        self.selector.close()
+        self._waker.close()
+        self._wakee.close()
+        log.debug("{name} has stopped.".format(name=self.name))
+
+    def _failed(self, func, args: tuple):
+        # Only the connection the callback was for goes down, the loop (and every other connection on it) carries on.
+        log.exception("{name} callback {func} raised an exception.".format(name=self.name, func=func))
+        for target in (getattr(func, '__self__', None),) + args:
+            if isinstance(target, SelectorWorker):
+                if not target.closed:
+                    try:
+                        target.kill()
+                    except Exception:
+                        log.exception("Couldn't close {client} after it failed.".format(client=target))
+                return
+
+    def stop(self):
+        self.running = False
+        self.call_soon(lambda: None)
+
+
+class SelectorEngine:
+
+    def __init__(self, server, loops: int=1):
+        if loops < 1:
+            raise ValueError("A selector engine needs at least one loop.")
+
+        self.server = server
+        self.loops = [EventLoop(self, i) for i in range(loops)]
+        self._next_loop = cycle(self.loops)
+
+    def make_worker(self, id: str, conn: socket.socket) -> SelectorWorker:
+        return SelectorWorker(id, conn, self.server, next(self._next_loop))
+
+    def _on_accept(self, mask: int):
+        try:
+            conn, addr = self.server.sock.accept()
+        except (BlockingIOError, ssl.SSLError, OSError):
+            return
+        log.info("New connection {addr}".format(addr=addr))
+        self.server.accept(conn, addr)
+
+    def serve(self):
+        self.server.sock.setblocking(False)
+        for loop in self.loops:
+            loop.open()
+        main = self.loops[0]
+        main.selector.register(self.server.sock, selectors.EVENT_READ, self._on_accept)
+        for loop in self.loops[1:]:
+            loop.start()
+        log.debug("Selector engine serving with {n} loop(s).".format(n=len(self.loops)))
+        main.run()
+
+    def stop(self):
+        for loop in self.loops:
+            loop.stop()
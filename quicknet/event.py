@@ -1,77 +1,216 @@
 import logging as log
-from threading import Thread, local
+from concurrent.futures import Future
+from contextvars import ContextVar
+from functools import partial
+from inspect import iscoroutinefunction
+from threading import Thread
+from time import monotonic, perf_counter
 
-from quicknet.utils import check_annotations
+from quicknet import utils
+from quicknet.metrics import DISABLED, Metrics
+from quicknet.utils import compile_annotations
 
-__all__ = ["EventThreader", "ClientWorker"]
-ClientWorker = local()
+__all__ = ["EventThreader", "Handler", "ClientWorker", "current_client"]
+_current_client = ContextVar("quicknet_current_client", default=None)
+
+
+def current_client():
+    return _current_client.get()
+
+
+class _CurrentClient:
+    # Looks up the connection the running handler was called for, nothing is copied per event.
+
+    __slots__ = ()
+
+    def __getattr__(self, item):
+        client = _current_client.get()
+        if client is None:
+            raise AttributeError("No connection is being handled, ClientWorker has no {item}".format(item=item))
+        return getattr(client, item)
+
+    def __setattr__(self, key, value):
+        client = _current_client.get()
+        if client is None:
+            raise AttributeError("No connection is being handled, can't set {key}".format(key=key))
+        setattr(client, key, value)
+
+    def __bool__(self):
+        return _current_client.get() is not None
+
+    def __repr__(self):
+        return "<ClientWorker proxy for {client!r}>".format(client=_current_client.get())
+
+
+ClientWorker = _CurrentClient()
+
+
+class Handler:
+
+    __slots__ = 'func', 'options', 'thread', 'coroutine', 'validate', 'calls', 'latency', 'timed'
+
+    def __init__(self, func, options: dict, thread: bool, event: str=None, metrics: Metrics=None):
+        metrics = metrics if metrics is not None else DISABLED
+        self.func = func
+        self.options = options
+        self.thread = options.get("thread", thread)
+        self.coroutine = iscoroutinefunction(func)
+        self.validate = compile_annotations(func) if options.get("enforce_annotations", False) else None
+        self.calls = metrics.counter('messages_total', help="Events dispatched to each handler.", handler=event)
+        self.latency = metrics.histogram('handler_seconds', help="Time spent in each handler.", handler=event)
+        self.timed = metrics.enabled
+
+    def __call__(self, *args, **kwargs):
+        self.calls.inc()
+        if not self.timed:
+            return self.func(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.latency.observe(perf_counter() - start)
+
+    def watch(self, task):
+        # Coroutine handlers are timed until their task is done, not just until the coroutine is created.
+        self.calls.inc()
+        if self.timed:
+            start = perf_counter()
+            task.add_done_callback(lambda done: self.latency.observe(perf_counter() - start))
+        return task
 
 
 class EventThreader:
 
-    def __init__(self):
+    THREAD_DEFAULT = True
+
+    def __init__(self, executor=None, metrics: Metrics=None):
         self.listeners = {}
+        self.executor = executor
+        self.metrics = metrics if metrics is not None else Metrics()
 
     def on(self, event, **options):
         def wrapper(func):
-            if event in self.listeners:
-                if type(self.listeners[event]) == tuple:
-                    other_event = self.listeners[event]
-                    self.listeners[event] = []
-                    self.listeners[event].append((func, options))
-                    self.listeners[event].append(other_event)
-                else:
-                    self.listeners[event].append((func, options))
-            else:
-                self.listeners[event] = (func, options)
+            # The table is replaced rather than changed, emit can read it from any thread without a lock.
+            handler = Handler(func, options, self.THREAD_DEFAULT, event, self.metrics)
+            listeners = dict(self.listeners)
+            listeners[event] = listeners.get(event, ()) + (handler,)
+            self.listeners = listeners
             log.debug("Event handler for {event} added.".format(event=event))
+            return func
         return wrapper
 
-    def emit(self, source, event, *args, **kwargs):
-        if event not in self.listeners:
+    def emit(self, source, event, *args, **kwargs) -> list:
+        started = []
+        for handler in self.listeners.get(event, ()):
+            if handler.validate is not None and not handler.validate(args, kwargs):
+                log.warning("Invalid values were passed when matching annotations, not calling.")
+                continue
+            started.append(self._start(source, handler, args, kwargs))
+        return started
+
+    def spawn(self, source, event, *args, **kwargs) -> list:
+        # Like emit, but handlers always run off the connection's thread (coroutines as tasks), for handlers that wait
+        # on more data from the connection that called them, like stream readers.
+        started = []
+        for handler in self.listeners.get(event, ()):
+            if handler.validate is not None and not handler.validate(args, kwargs):
+                log.warning("Invalid values were passed when matching annotations, not calling.")
+                continue
+            started.append(self._start(source, handler, args, kwargs, True))
+        return started
+
+    def _start(self, source, handler: Handler, args: tuple, kwargs: dict, thread: bool=False):
+        if not (thread or handler.thread):
+            return self._run_with_ctx(source, handler, *args, **kwargs)
+        if self.executor is not None:
+            return self._submit(source, self._run_with_ctx, source, handler, *args, **kwargs)
+        t = Thread(target=self._run_with_ctx, args=(source, handler) + args, kwargs=kwargs)
+        t.start()
+        return t
+
+    def _submit(self, source, func, *args, **kwargs) -> Future:
+        # A full executor with policy 'raise' drops the call here, raising would kill the connection's reader.
+        try:
+            return self.executor.submit(source, func, *args, **kwargs)
+        except utils.BackpressureError as e:
+            log.warning("{e} Dropping a call from {source}.".format(e=e, source=source))
+            future = Future()
+            future.cancel()
+            return future
+
+    def responder(self, event, args: tuple, kwargs: dict) -> Handler:
+        # A request is answered by the first handler registered for it.
+        handlers = self.listeners.get(event)
+        if not handlers or event in getattr(self, 'EVENTS', ()):
+            raise LookupError("No handler for {event}".format(event=event))
+
+        handler = handlers[0]
+        if handler.validate is not None and not handler.validate(args, kwargs):
+            raise TypeError("Invalid values were passed when matching annotations")
+        return handler
+
+    def invoke(self, source, event, args: tuple=(), kwargs: dict=None, deadline: float=None) -> Future:
+        kwargs = kwargs if kwargs is not None else {}
+        future = Future()
+        try:
+            handler = self.responder(event, args, kwargs)
+        except (LookupError, TypeError) as e:
+            future.set_exception(e)
+            return future
+
+        if handler.thread:
+            if self.executor is not None:
+                return self._submit(source, self._call_by, deadline, source, handler, args, kwargs)
+            Thread(target=self._resolve, args=(future, deadline, source, handler, args, kwargs)).start()
+        else:
+            self._resolve(future, deadline, source, handler, args, kwargs)
+        log.debug("Request %s from %s invoked.", event, source)
+        return future
+
+    @classmethod
+    def _call_by(cls, deadline: float, ctx, target, args: tuple, kwargs: dict):
+        if deadline is not None and monotonic() > deadline:
+            raise TimeoutError("Deadline passed before the handler started")
+        return cls._run_with_ctx(ctx, target, *args, **kwargs)
+
+    @classmethod
+    def _resolve(cls, future: Future, deadline: float, ctx, target, args: tuple, kwargs: dict):
+        if not future.set_running_or_notify_cancel():
             return
+        try:
+            result = cls._call_by(deadline, ctx, target, args, kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def answer(self, source, call: list, send):
+        # ['CALL', handler, args, kwargs, timeout, rid], answered with ['RESULT', value, rid] or ['ERROR', why, rid]
+        handler, args, kwargs, timeout, rid = call[1:6]
+        deadline = monotonic() + timeout if timeout is not None else None
+        future = self.invoke(source, handler, tuple(args), dict(kwargs), deadline)
+        future.add_done_callback(partial(self._send_answer, send, rid))
 
-        callbacks = self.listeners[event]
-        if type(callbacks) == tuple:
-            if callbacks[1].get("enforce_annotations", False):
-                if not check_annotations(callbacks[0], args, kwargs):
-                    log.warning("Invalid values were passed when matching annotations, not calling.")
-                    return
-
-            if callbacks[1].get("thread", True):
-                args = list(args)
-                args.insert(0, source)
-                args.insert(1, callbacks[0])
-                t = Thread(target=self._run_with_ctx, args=args, kwargs=kwargs)
-                t.start()
-                log.debug("Threaded event {event} from {source} started.".format(event=event, source=source))
-                return t
+    @staticmethod
+    def _send_answer(send, rid: int, future):
+        try:
+            if future.cancelled():
+                send(['ERROR', "Request was dropped", rid])
+            elif future.exception() is not None:
+                error = future.exception()
+                send(['ERROR', "{name}: {error}".format(name=type(error).__name__, error=error), rid])
             else:
-                log.debug("Non-threaded event {event} from {source} started.".format(event=event, source=source))
-                return self._run_with_ctx(*args, **kwargs)
-        else:
-            for callback in callbacks:
-                if callback[1].get("enforce_annotations", False):
-                    if not check_annotations(callback[0], args, kwargs):
-                        log.warning("Invalid values were passed when matching annotations.")
-                        return
-
-                if callback[1].get("thread", True):
-                    args = list(args)
-                    args.insert(0, source)
-                    args.insert(1, callback[0])
-                    t = Thread(target=self._run_with_ctx, args=args, kwargs=kwargs)
-                    t.start()
-                    log.debug("Threaded event {event} from {source} started.".format(event=event, source=source))
-                    return t
-                else:
-                    log.debug("Non-threaded event {event} from {source} started.".format(event=event, source=source))
-                    return self._run_with_ctx(*args, **kwargs)
+                try:
+                    send(['RESULT', future.result(), rid])
+                except utils.UnSterilizable as e:
+                    send(['ERROR', "UnSterilizable: {error}".format(error=e), rid])
+        except (utils.NotRunningError, OSError):
+            log.info("Connection closed before request {rid} was answered.".format(rid=rid))
 
     @staticmethod
     def _run_with_ctx(ctx, target, *args, **kwargs):
-        for key in dir(ctx):
-            if not hasattr(ClientWorker, key):
-                setattr(ClientWorker, key, getattr(ctx, key))
-        log.debug("{ctx} copied to proxy ClientWorker".format(ctx=ctx))
-        target(*args, **kwargs)
+        token = _current_client.set(ctx)
+        try:
+            return target(*args, **kwargs)
+        finally:
+            _current_client.reset(token)
@@ -0,0 +1,137 @@
+import logging as log
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Condition, Lock
+
+from quicknet import utils
+
+__all__ = ["EventExecutor"]
+
+
+class EventExecutor:
+
+    POLICIES = 'block', 'drop', 'caller_runs', 'raise'
+
+    def __init__(self, max_workers: int=8, max_queue: int=1024, policy: str='block', ordered: bool=False,
+                 idle_timeout: float=60):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown backpressure policy {policy}, expected one of {policies}".format(
+                policy=policy, policies=self.POLICIES))
+        if max_workers < 1:
+            raise ValueError("An executor needs at least one worker.")
+
+        self.max_workers = max_workers        # type: int
+        self.max_queue = max_queue            # type: int
+        self.policy = policy                  # type: str
+        self.ordered = ordered                # type: bool
+        self.idle_timeout = idle_timeout      # type: float
+        self.running = True                   # type: bool
+        self._tasks = deque()                 # type: deque
+        self._keyed = {}                      # type: dict
+        self._pending = 0                     # type: int
+        self._workers = 0                     # type: int
+        self._idle = 0                        # type: int
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+
+    def __len__(self):
+        return self._pending
+
+    def submit(self, key, func, *args, **kwargs) -> Future:
+        if not self.running:
+            raise utils.NotRunningError("Executor has been shut down.")
+
+        future = Future()
+        item = (future, key, func, args, kwargs)
+        with self._cond:
+            if self.max_queue is not None and self._pending >= self.max_queue:
+                if self.policy == 'drop':
+                    log.warning("Executor queue is full, dropping call to {func}.".format(func=func))
+                    future.cancel()
+                    return future
+                elif self.policy == 'raise':
+                    raise utils.BackpressureError("Executor queue is full ({n} pending).".format(n=self._pending))
+                elif self.policy == 'caller_runs' and not (self.ordered and key in self._keyed):
+                    item = None
+                    if self.ordered:
+                        # Later calls for the key queue behind this one until it's done.
+                        self._keyed[key] = deque()
+                else:
+                    # With ordered=True a key that still has calls waiting can't run in the caller, it waits its turn.
+                    while self._pending >= self.max_queue and self.running:
+                        self._not_full.wait()
+
+            if item is not None:
+                self._pending += 1
+                if self.ordered and key in self._keyed:
+                    self._keyed[key].append(item)
+                else:
+                    if self.ordered:
+                        self._keyed[key] = deque()
+                    self._schedule(item)
+
+        if item is None:
+            log.debug("Executor queue is full, running {func} in the calling thread.".format(func=func))
+            self._run(future, func, args, kwargs)
+            if self.ordered:
+                self._release(key)
+        return future
+
+    def _schedule(self, item: tuple):
+        # Called holding the lock.
+        self._tasks.append(item)
+        self._cond.notify()
+        if len(self._tasks) > self._idle and self._workers < self.max_workers:
+            self._workers += 1
+            Thread(target=self._work, name="quicknet-executor", daemon=True).start()
+
+    def _release(self, key):
+        # The key's last call is done, the next one waiting for it (if any) can go.
+        with self._cond:
+            waiting = self._keyed[key]
+            if waiting:
+                self._schedule(waiting.popleft())
+            else:
+                del self._keyed[key]
+
+    @staticmethod
+    def _run(future: Future, func, args: tuple, kwargs: dict):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            log.exception("Handler {func} raised an exception.".format(func=func))
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._tasks and self.running:
+                    self._idle += 1
+                    timed_out = not self._cond.wait(self.idle_timeout)
+                    self._idle -= 1
+                    if timed_out and not self._tasks:
+                        self._workers -= 1
+                        return
+                if not self._tasks:
+                    self._workers -= 1
+                    return
+                future, key, func, args, kwargs = self._tasks.popleft()
+                self._pending -= 1
+                self._not_full.notify()
+
+            self._run(future, func, args, kwargs)
+
+            if self.ordered:
+                self._release(key)
+
+    def shutdown(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+            self._not_full.notify_all()
+        log.debug("Executor has been shut down.")
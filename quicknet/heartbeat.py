@@ -0,0 +1,58 @@
+__all__ = ["Heartbeat"]
+
+
+class Heartbeat:
+    # The idle limits of a server or client. A connection doesn't get a new timer every time it reads, it has one
+    # timer on the wheel that wakes up at its next deadline, looks at when the connection last read and whether its
+    # writes are stuck, and then either acts or sleeps until the next deadline.
+
+    __slots__ = 'interval', 'read_timeout', 'write_timeout'
+
+    def __init__(self, interval: float=None, read_timeout: float=None, write_timeout: float=None):
+        if any(limit is not None and limit <= 0 for limit in (interval, read_timeout, write_timeout)):
+            raise ValueError("Heartbeats and idle timeouts have to be positive.")
+        # Without its own read timeout, a peer that hasn't answered the last ping is given up on.
+        if interval is not None and read_timeout is None:
+            read_timeout = 2 * interval
+        # And without pings a quiet but healthy peer would be reaped, it's pinged twice per read timeout.
+        if interval is None and read_timeout is not None:
+            interval = read_timeout / 2
+        if interval is not None and read_timeout <= interval:
+            raise ValueError("The read timeout has to be longer than the heartbeat, or live peers get dropped.")
+
+        self.interval = interval              # type: float
+        self.read_timeout = read_timeout      # type: float
+        self.write_timeout = write_timeout    # type: float
+
+    def __repr__(self):
+        return "<Heartbeat every {interval}s, read timeout {read}s, write timeout {write}s>".format(
+            interval=self.interval, read=self.read_timeout, write=self.write_timeout)
+
+    @classmethod
+    def make(cls, interval: float=None, read_timeout: float=None, write_timeout: float=None):
+        # None when everything is off, so connections that don't need one never touch the wheel.
+        if interval is None and read_timeout is None and write_timeout is None:
+            return None
+        return cls(interval, read_timeout, write_timeout)
+
+    def check(self, now: float, last_read: float, stalled: float=None) -> tuple:
+        # Returns what to do ('read' or 'write' when that side timed out, 'ping', or None) and the seconds until the
+        # next check. stalled is when queued data last moved, None when nothing is queued.
+        idle = now - last_read
+        if self.read_timeout is not None and idle >= self.read_timeout:
+            return 'read', None
+        if self.write_timeout is not None and stalled is not None and now - stalled >= self.write_timeout:
+            return 'write', None
+
+        action, delays = None, []
+        if self.interval is not None:
+            if idle >= self.interval:
+                action = 'ping'
+                delays.append(self.interval)
+            else:
+                delays.append(self.interval - idle)
+        if self.read_timeout is not None:
+            delays.append(self.read_timeout - idle)
+        if self.write_timeout is not None:
+            delays.append(self.write_timeout if stalled is None else stalled + self.write_timeout - now)
+        return action, min(delays)
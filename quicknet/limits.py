@@ -0,0 +1,82 @@
+from time import monotonic
+
+from quicknet.metrics import DISABLED, Metrics
+
+__all__ = ["LIMIT_ACTIONS", "TokenBucket", "Limits"]
+# What happens to a message over the limit: it's thrown away, the connection stops being read until it's allowed,
+# the client is kicked, or it's thrown away and RATE_LIMITED fires.
+LIMIT_ACTIONS = 'drop', 'delay', 'disconnect', 'event'
+
+
+class TokenBucket:
+
+    __slots__ = 'rate', 'burst', 'tokens', 'stamp', 'limited'
+
+    def __init__(self, rate: float, burst: float=None):
+        burst = rate if burst is None else burst
+        if rate <= 0 or burst < 1:
+            raise ValueError("A rate limit needs a positive rate and room for at least one message.")
+
+        self.rate = rate                      # type: float
+        self.burst = burst                    # type: float
+        self.tokens = burst                   # type: float
+        self.stamp = monotonic()              # type: float
+        # Set from the first message over the limit until one gets through again.
+        self.limited = False                  # type: bool
+
+    def __repr__(self):
+        return "<TokenBucket {rate}/s, {tokens:.1f} of {burst} left>".format(rate=self.rate, tokens=self.tokens,
+                                                                             burst=self.burst)
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self) -> float:
+        # 0 when the message may go, otherwise the seconds until it may.
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.limited = False
+            return 0.0
+        self.limited = True
+        return (1 - self.tokens) / self.rate
+
+    def charge(self, n: int):
+        # A negative n gives tokens back, for a message that was let in but then had to wait anyway.
+        self.tokens = min(self.burst, self.tokens - n)
+
+
+class Limits:
+
+    __slots__ = 'rate', 'handlers', 'action', 'limited'
+
+    def __init__(self, rate: float or tuple=None, handlers: dict=None, action: str='drop', metrics: Metrics=None):
+        if action not in LIMIT_ACTIONS:
+            raise ValueError("Unknown limit action {action}, expected one of {actions}".format(
+                action=action, actions=LIMIT_ACTIONS))
+
+        # A rate in messages per second, or (rate, burst). The burst defaults to one second's worth.
+        self.rate = self._limit(rate) if rate is not None else None  # type: tuple
+        self.handlers = {name: self._limit(limit) for name, limit in (handlers or {}).items()}
+        self.action = action                  # type: str
+        metrics = metrics if metrics is not None else DISABLED
+        self.limited = metrics.counter('rate_limited_total', help="Messages over a rate limit.", action=action)
+
+    @staticmethod
+    def _limit(limit: float or tuple) -> tuple:
+        limit = tuple(limit) if isinstance(limit, (tuple, list)) else (limit, None)
+        # Bad limits fail here, not on some client's first message.
+        TokenBucket(*limit)
+        return limit
+
+    @classmethod
+    def make(cls, rate: float or tuple=None, handlers: dict=None, action: str='drop', metrics: Metrics=None):
+        # None when nothing is limited, connections then never make a bucket.
+        limits = cls(rate, handlers, action, metrics)
+        return limits if rate is not None or limits.handlers else None
+
+    def bucket(self, handler: str=None) -> TokenBucket:
+        # The client's own bucket for handler None, one for that handler otherwise.
+        return TokenBucket(*(self.rate if handler is None else self.handlers[handler]))
@@ -0,0 +1,221 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+__all__ = ["Metrics", "Counter", "Gauge", "Histogram", "PrometheusExporter", "snapshot", "prometheus",
+           "LATENCY_BUCKETS", "DISABLED"]
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Counter:
+
+    __slots__ = 'value', '_lock'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: int=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+
+    __slots__ = 'value', 'func'
+
+    def __init__(self, func=None):
+        # With func, the value is read when the metrics are collected instead of being kept up to date.
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        return self.func() if self.func is not None else self.value
+
+
+class Histogram:
+
+    __slots__ = 'buckets', 'counts', 'sum', 'count', '_lock'
+
+    def __init__(self, buckets: tuple=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def sample(self) -> dict:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+class _Null:
+    # Handed out by a disabled Metrics, every call is a no-op.
+
+    __slots__ = ()
+    value = 0
+
+    def inc(self, amount: int=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def sample(self):
+        return 0
+
+
+NULL = _Null()
+
+
+class Metrics:
+
+    def __init__(self, enabled: bool=True, prefix: str='quicknet_'):
+        self.enabled = enabled                # type: bool
+        self.prefix = prefix                  # type: str
+        self._metrics = {}                    # type: dict
+        self._kinds = {}                      # type: dict
+        self._help = {}                       # type: dict
+        self._lock = Lock()
+
+    def _get(self, kind, name: str, help: str, labels: dict, *args):
+        # Look a metric up once and keep the object, the hot path should only ever call inc/observe on it.
+        if not self.enabled:
+            return NULL
+        name = self.prefix + name
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                if self._kinds.setdefault(name, kind) is not kind:
+                    raise ValueError("{name} is already registered as another kind of metric".format(name=name))
+                if help:
+                    self._help[name] = help
+                metric = self._metrics[key] = kind(*args)
+        return metric
+
+    def counter(self, name: str, help: str='', **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, func=None, help: str='', **labels) -> Gauge:
+        gauge = self._get(Gauge, name, help, labels)
+        if func is not None and gauge is not NULL:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name: str, buckets: tuple=LATENCY_BUCKETS, help: str='', **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def collect(self) -> list:
+        # [(name, kind, help, labels, value)], sorted so exporters print a metric's samples together.
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda item: item[0])
+            kinds, helps = dict(self._kinds), dict(self._help)
+        return [(name, kinds[name].__name__.lower(), helps.get(name, ''), dict(labels), metric.sample())
+                for (name, labels), metric in items]
+
+    def export(self, exporter=None):
+        # Any callable that takes a Metrics works as an exporter.
+        return (exporter or snapshot)(self)
+
+
+DISABLED = Metrics(enabled=False)
+
+
+def snapshot(metrics: Metrics) -> dict:
+    out = {}
+    for name, kind, _, labels, value in metrics.collect():
+        if kind == 'histogram':
+            value = dict(value, buckets=[[bound, n] for bound, n in value['buckets']])
+        out.setdefault(name, []).append({'labels': labels, 'value': value})
+    return out
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    pairs = ('{k}="{v}"'.format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in sorted(labels.items()))
+    return '{' + ','.join(pairs) + '}'
+
+
+def prometheus(metrics: Metrics) -> str:
+    lines = []
+    seen = set()
+    for name, kind, help, labels, value in metrics.collect():
+        if name not in seen:
+            seen.add(name)
+            if help:
+                lines.append('# HELP {name} {help}'.format(name=name, help=help))
+            lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+        if kind == 'histogram':
+            for bound, n in value['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{name}_bucket{labels} {n}'.format(name=name, labels=_labels(labels, le=le), n=n))
+            lines.append('{name}_sum{labels} {v}'.format(name=name, labels=_labels(labels), v=value['sum']))
+            lines.append('{name}_count{labels} {v}'.format(name=name, labels=_labels(labels), v=value['count']))
+        else:
+            lines.append('{name}{labels} {v}'.format(name=name, labels=_labels(labels), v=value))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter:
+
+    def __init__(self, metrics: Metrics, port: int=9100, host: str='127.0.0.1'):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = prometheus(metrics).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._httpd.server_address[1]
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
@@ -0,0 +1,122 @@
+import logging as log
+from collections import deque
+from threading import Condition, Lock
+from time import monotonic
+import socket
+import ssl
+
+__all__ = ["Outbox", "send_some", "OVERFLOW_POLICIES"]
+OVERFLOW_POLICIES = 'none', 'drop', 'disconnect'
+
+
+def send_some(sock: socket.socket, buffers: list) -> int:
+    # One writev for every queued frame. SSL sockets (and platforms without sendmsg) get one joined buffer instead.
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+        return sock.send(b''.join(buffers))
+    return sock.sendmsg(buffers)
+
+
+class Outbox:
+
+    __slots__ = ('high_water', 'low_water', 'on_congested', 'on_drained', 'size', 'congested', 'closed', 'moved',
+                 '_frames', '_offset', '_lock', '_cond')
+
+    IOV_MAX = 512
+
+    def __init__(self, high_water: int=4 * 1024 * 1024, low_water: int=1024 * 1024, on_congested=None,
+                 on_drained=None):
+        if low_water > high_water:
+            raise ValueError("The low watermark can't be above the high watermark.")
+
+        self.high_water = high_water          # type: int
+        self.low_water = low_water            # type: int
+        self.on_congested = on_congested      # type: callable
+        self.on_drained = on_drained          # type: callable
+        self.size = 0                         # type: int
+        self.congested = False                # type: bool
+        self.closed = False                   # type: bool
+        # When queued bytes last went out (or started waiting), write timeouts go by it.
+        self.moved = 0.0                      # type: float
+        self._frames = deque()                # type: deque
+        self._offset = 0                      # type: int
+        self._lock = Lock()
+        # Only the thread engine's writers block on the outbox, the condition is made when one first waits.
+        self._cond = None                     # type: Condition
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def put(self, frame: bytes):
+        with self._lock:
+            if not self._frames:
+                self.moved = monotonic()
+            self._frames.append(frame)
+            self.size += len(frame)
+            crossed = not self.congested and self.size > self.high_water
+            if crossed:
+                self.congested = True
+            if self._cond is not None:
+                self._cond.notify()
+        if crossed:
+            log.info("Outbound queue passed {high} bytes.".format(high=self.high_water))
+            if self.on_congested is not None:
+                self.on_congested()
+
+    def peek(self, limit: int=IOV_MAX) -> list:
+        with self._lock:
+            if not self._frames:
+                return []
+            buffers = [memoryview(self._frames[0])[self._offset:]]
+            for i in range(1, min(limit, len(self._frames))):
+                buffers.append(self._frames[i])
+            return buffers
+
+    def wait(self, limit: int=IOV_MAX) -> list:
+        # Blocks until there's something to write, an empty list means the outbox was closed and fully written.
+        with self._lock:
+            if self._cond is None:
+                self._cond = Condition(self._lock)
+            while not self._frames and not self.closed:
+                self._cond.wait()
+        return self.peek(limit)
+
+    def consume(self, sent: int):
+        with self._lock:
+            # Frames that were cleared while the writer was sending them are already gone.
+            sent = min(sent, self.size)
+            if sent:
+                self.moved = monotonic()
+            self.size -= sent
+            sent += self._offset
+            while self._frames and sent >= len(self._frames[0]):
+                sent -= len(self._frames.popleft())
+            self._offset = sent
+            crossed = self.congested and self.size <= self.low_water
+            if crossed:
+                self.congested = False
+        if crossed:
+            log.info("Outbound queue drained below {low} bytes.".format(low=self.low_water))
+            if self.on_drained is not None:
+                self.on_drained()
+
+    def stalled_since(self) -> float:
+        # None when nothing is waiting to be written.
+        return self.moved if self.size else None
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._offset = 0
+            self.size = 0
+            self.congested = False
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            if self._cond is not None:
+                self._cond.notify_all()
@@ -0,0 +1,71 @@
+import logging as log
+from concurrent.futures import Future
+from itertools import count
+from threading import Lock
+
+from quicknet import timer
+
+__all__ = ["PendingRequests"]
+
+
+class PendingRequests:
+
+    def __init__(self, factory=Future, call_later=None):
+        self.factory = factory               # type: callable
+        self.call_later = call_later or timer.wheel.call_later
+        self._ids = count(1)
+        self._pending = {}                   # type: dict
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def new(self) -> tuple:
+        future = self.factory()
+        with self._lock:
+            rid = next(self._ids)
+            self._pending[rid] = future
+        return rid, future
+
+    def issue(self, send, message: list, timeout: float=None):
+        rid, future = self.new()
+        try:
+            send(message + [rid])
+        except Exception:
+            self.pop(rid)
+            raise
+        if timeout is not None:
+            self.expire(rid, future, timeout)
+        return future
+
+    def expire(self, rid: int, future, timeout: float):
+        error = TimeoutError("No reply to request {rid} within {timeout}s".format(rid=rid, timeout=timeout))
+        handle = self.call_later(timeout, self.fail, rid, error)
+        future.add_done_callback(lambda _: handle.cancel())
+
+    def pop(self, rid: int):
+        with self._lock:
+            return self._pending.pop(rid, None)
+
+    def resolve(self, rid: int, value: any) -> bool:
+        future = self.pop(rid)
+        if future is None or future.done():
+            log.debug("Reply to unknown or finished request %s.", rid)
+            return False
+        future.set_result(value)
+        return True
+
+    def fail(self, rid: int, error: Exception) -> bool:
+        future = self.pop(rid)
+        if future is None or future.done():
+            return False
+        future.set_exception(error)
+        return True
+
+    def fail_all(self, error: Exception):
+        with self._lock:
+            futures = list(self._pending.values())
+            self._pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,322 @@
+from collections import deque
+import socket
+import struct
+from time import perf_counter
+import zlib
+
+from quicknet import sterilizer
+from quicknet.metrics import DISABLED, Metrics
+from quicknet.utils import BadSterilization, DataOverflowError, ProtocolError
+
+__all__ = ["VERSION", "HEADER", "ENTRY", "FLAG_COMPRESSED", "FLAG_BINARY", "FLAG_STANDALONE", "FLAG_BATCH",
+           "MAX_FRAME_SIZE", "MAX_BATCH_ENTRIES", "pack_frame", "BufferPool", "buffers", "FrameParser", "Batch",
+           "Codec", "build_zdict"]
+
+# Every frame is a 6 byte header followed by the payload:
+#   version (1 byte) | flags (1 byte) | payload length (4 bytes, big endian)
+VERSION = 1
+HEADER = struct.Struct('!BBI')
+FLAG_COMPRESSED = 0x01
+FLAG_BINARY = 0x02
+# Compressed on its own instead of on the connection's deflate stream, so one frame can go to many connections.
+FLAG_STANDALONE = 0x04
+# The payload is a run of messages, each one an entry header followed by the message:
+#   flags (1 byte, FLAG_BINARY or 0) | message length (4 bytes, big endian)
+FLAG_BATCH = 0x08
+ENTRY = struct.Struct('!BI')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Senders flush a batch before it gets this long, receivers drop connections that send a longer one.
+MAX_BATCH_ENTRIES = 4096
+COMMANDS = ('BAD_CALL', 'HELLO', 'SESSION', 'DENIED', 'GET_MANY', 'SET_MANY', 'FOUND_MANY', 'CHANGED_MANY',
+            'SUBSCRIBE', 'SUBSCRIBED', 'SYNC', 'SGET', 'SSET', 'SDEL', 'INCR', 'CAS', 'CALL', 'RESULT', 'ERROR', 'GET',
+            'SET', 'DEL', 'FOUND', 'CHANGED', 'REMOVED')
+
+
+def pack_frame(payload: bytes, flags: int=0) -> bytes:
+    return HEADER.pack(VERSION, flags, len(payload)) + payload
+
+
+class BufferPool:
+    # Receive buffers are only held while a connection has unparsed bytes, idle connections give theirs back.
+
+    def __init__(self, size: int=8192, limit: int=64):
+        self.size = size                      # type: int
+        self.limit = limit                    # type: int
+        self._free = deque()                  # type: deque
+
+    def __len__(self):
+        return len(self._free)
+
+    def get(self, size: int=0) -> bytearray:
+        if size > self.size:
+            return bytearray(size)
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buf: bytearray):
+        # Buffers that grew for a big frame are dropped, they'd pin that much memory for every pooled buffer.
+        if len(buf) == self.size and len(self._free) < self.limit:
+            self._free.append(buf)
+
+
+buffers = BufferPool()
+
+
+class FrameParser:
+
+    __slots__ = 'max_size', '_pool', '_buf', '_start', '_end'
+
+    def __init__(self, max_size: int=MAX_FRAME_SIZE, pool: BufferPool=None):
+        self.max_size = max_size              # type: int
+        self._pool = pool if pool is not None else buffers
+        self._buf = None                      # type: bytearray
+        self._start = 0                       # type: int
+        self._end = 0                         # type: int
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size: int) -> memoryview:
+        if self._buf is None:
+            self._buf = self._pool.get(size)
+        if len(self._buf) - self._end < size:
+            unread = self._end - self._start
+            if self._start and len(self._buf) - unread >= size:
+                self._buf[:unread] = self._buf[self._start:self._end]
+            else:
+                grown = bytearray(max(len(self._buf) * 2, unread + size))
+                grown[:unread] = self._buf[self._start:self._end]
+                self._buf = grown
+            self._start, self._end = 0, unread
+        return memoryview(self._buf)[self._end:self._end + size]
+
+    def recv_into(self, sock: socket.socket, size: int) -> int:
+        with self._reserve(size) as view:
+            received = sock.recv_into(view, size)
+        self._end += received
+        return received
+
+    def feed(self, data: bytes):
+        with self._reserve(len(data)) as view:
+            view[:] = data
+        self._end += len(data)
+
+    def frames(self):
+        # Payloads are views into the receive buffer, they're only valid until the next frame is requested.
+        header_size = HEADER.size
+        while self._end - self._start >= header_size:
+            version, flags, length = HEADER.unpack_from(self._buf, self._start)
+            if version != VERSION:
+                raise ProtocolError("Unsupported frame version {v}".format(v=version))
+            if length > self.max_size:
+                raise DataOverflowError("Frame of {len} bytes is over the {max} byte limit".format(
+                    len=length, max=self.max_size))
+            begin = self._start + header_size
+            if self._end - begin < length:
+                if begin + length > len(self._buf):
+                    self._reserve(header_size + length - (self._end - self._start)).release()
+                break
+            self._start = begin + length
+            with memoryview(self._buf)[begin:begin + length] as payload:
+                yield flags, payload
+        if self._start == self._end:
+            self._start = self._end = 0
+            self.release()
+
+    def push_back(self, payload: memoryview):
+        # Puts back the frame frames() just yielded, the next call starts with it again. Stop iterating right after.
+        self._start -= HEADER.size + len(payload)
+
+    def release(self):
+        # Only while nothing is buffered, and no payload view is still in use.
+        if self._buf is not None and self._start == self._end:
+            self._pool.put(self._buf)
+            self._buf = None
+
+
+class Batch:
+    # Messages waiting for the next tick. They go out as one FLAG_BATCH frame, compressed and flushed only once.
+
+    __slots__ = '_parts', 'size'
+
+    def __init__(self):
+        self._parts = []                      # type: list
+        self.size = 0                         # type: int
+
+    def __len__(self):
+        return len(self._parts) // 2
+
+    def __bool__(self):
+        return bool(self._parts)
+
+    def add(self, flags: int, data: bytes) -> int:
+        self._parts.append(ENTRY.pack(flags, len(data)))
+        self._parts.append(data)
+        self.size += ENTRY.size + len(data)
+        return self.size
+
+    def take(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        self.size = 0
+        return data
+
+
+def build_zdict(handlers: list=()) -> bytes:
+    # zlib looks for matches from the end of the dictionary, so the caller's handlers go last.
+    samples = [sterilizer.dirty([command, '']) for command in COMMANDS]
+    samples.extend(sterilizer.dirty((handler, (), {})) for handler in handlers)
+    return ''.join(samples).encode()
+
+
+class Codec:
+
+    __slots__ = ('level', 'threshold', 'max_size', 'binary', 'peer_binary', 'peer_batch', 'peer_ping', 'zdict',
+                 'mem_level', '_deflator', '_inflator', '_timed', '_raw_out', '_wire_out', '_raw_in', '_wire_in',
+                 '_frames_out', '_frames_in', '_pack_time', '_unpack_time')
+
+    def __init__(self, level: int=zlib.Z_DEFAULT_COMPRESSION, threshold: int=64, zdict: bytes=None,
+                 max_size: int=MAX_FRAME_SIZE, binary: bool=True, metrics: Metrics=None,
+                 mem_level: int=zlib.DEF_MEM_LEVEL):
+        self.level = level                    # type: int
+        self.threshold = threshold            # type: int
+        self.max_size = max_size              # type: int
+        self.binary = binary                  # type: bool
+        self.peer_binary = False              # type: bool
+        self.peer_batch = False               # type: bool
+        self.peer_ping = False                # type: bool
+        self.zdict = zdict                    # type: bytes
+        self.mem_level = mem_level            # type: int
+        # A deflate stream costs about 256 KiB with the default mem_level, they're only made for connections that
+        # send something over the threshold.
+        self._deflator = None
+        self._inflator = None
+
+        metrics = metrics if metrics is not None else DISABLED
+        self._timed = metrics.enabled
+        self._raw_out = metrics.counter('bytes_sent_total', stage='raw', help="Payload bytes before and after "
+                                        "compression (wire bytes include frame headers).")
+        self._wire_out = metrics.counter('bytes_sent_total', stage='wire')
+        self._raw_in = metrics.counter('bytes_received_total', stage='raw', help="Payload bytes before and after "
+                                       "decompression (wire bytes include frame headers).")
+        self._wire_in = metrics.counter('bytes_received_total', stage='wire')
+        self._frames_out = metrics.counter('frames_sent_total')
+        self._frames_in = metrics.counter('frames_received_total')
+        self._pack_time = metrics.histogram('serialize_seconds', op='serialize', help="Time spent turning "
+                                            "messages into bytes and back.")
+        self._unpack_time = metrics.histogram('serialize_seconds', op='deserialize')
+
+    def capabilities(self) -> list:
+        return ['text', 'binary', 'batch', 'ping'] if self.binary else ['text', 'batch', 'ping']
+
+    def agree(self, capabilities: list):
+        self.peer_binary = self.binary and 'binary' in capabilities
+        self.peer_batch = 'batch' in capabilities
+        # Peers from before heartbeats would answer a PING with BAD_CALL.
+        self.peer_ping = 'ping' in capabilities
+
+    def _serialize(self, obj: any, binary: bool) -> tuple:
+        if not self._timed:
+            return (FLAG_BINARY, sterilizer.pack(obj)) if binary else (0, sterilizer.dirty(obj).encode())
+        start = perf_counter()
+        flags, data = (FLAG_BINARY, sterilizer.pack(obj)) if binary else (0, sterilizer.dirty(obj).encode())
+        self._pack_time.observe(perf_counter() - start)
+        return flags, data
+
+    def serialize(self, obj: any, binary: bool=None) -> tuple:
+        return self._serialize(obj, self.peer_binary if binary is None else binary)
+
+    def sent(self, frame: bytes) -> bytes:
+        # Counts a frame going out on this connection, including shared frames that weren't encoded here.
+        self._frames_out.inc()
+        self._wire_out.inc(len(frame))
+        return frame
+
+    def _compressor(self):
+        if self.zdict is None:
+            return zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, self.mem_level)
+        return zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, self.mem_level, zdict=self.zdict)
+
+    def _decompressor(self):
+        return zlib.decompressobj() if self.zdict is None else zlib.decompressobj(zdict=self.zdict)
+
+    def encode(self, data: bytes, flags: int=0) -> bytes:
+        # The deflate stream lasts as long as the connection, frames have to be written in the order they're encoded.
+        self._raw_out.inc(len(data))
+        if len(data) < self.threshold:
+            return self.sent(pack_frame(data, flags))
+        if self._deflator is None:
+            self._deflator = self._compressor()
+        return self.sent(pack_frame(self._deflator.compress(data) + self._deflator.flush(zlib.Z_SYNC_FLUSH),
+                                    flags | FLAG_COMPRESSED))
+
+    def encode_standalone(self, obj: any, binary: bool) -> bytes:
+        # The payload is counted once, every connection the frame is pushed to counts the frame with sent().
+        flags, data = self._serialize(obj, binary)
+        self._raw_out.inc(len(data))
+        if len(data) < self.threshold:
+            return pack_frame(data, flags)
+        deflator = self._compressor()
+        return pack_frame(deflator.compress(data) + deflator.flush(), flags | FLAG_COMPRESSED | FLAG_STANDALONE)
+
+    def decode(self, flags: int, payload: memoryview) -> bytes:
+        if not flags & FLAG_COMPRESSED:
+            return bytes(payload)
+        if flags & FLAG_STANDALONE:
+            inflator = self._decompressor()
+            data = inflator.decompress(payload, self.max_size)
+        else:
+            if self._inflator is None:
+                self._inflator = self._decompressor()
+            inflator = self._inflator
+            try:
+                data = inflator.decompress(payload, self.max_size)
+            except zlib.error as e:
+                # Every later frame depends on this one, the connection can't recover from it.
+                raise ProtocolError("Deflate stream is corrupt ({e})".format(e=e))
+        if inflator.unconsumed_tail:
+            raise DataOverflowError("Inflated frame is over the {max} byte limit".format(max=self.max_size))
+        return data
+
+    def unpack(self, flags: int, data: bytes):
+        start = perf_counter() if self._timed else None
+        obj = sterilizer.unpack(data) if flags & FLAG_BINARY else sterilizer.clean(data)
+        if start is not None:
+            self._unpack_time.observe(perf_counter() - start)
+        return obj
+
+    def loads(self, flags: int, payload: memoryview):
+        self._frames_in.inc()
+        self._wire_in.inc(HEADER.size + len(payload))
+        data = self.decode(flags, payload)
+        self._raw_in.inc(len(data))
+        return self.unpack(flags, data)
+
+    def messages(self, flags: int, payload: memoryview) -> list:
+        # Every message in the frame as (flags, bytes), decompressed but not unpacked yet, so a receiver can decide
+        # about each one before paying for it. One for ordinary frames and any number for batches.
+        self._frames_in.inc()
+        self._wire_in.inc(HEADER.size + len(payload))
+        data = self.decode(flags, payload)
+        self._raw_in.inc(len(data))
+        if not flags & FLAG_BATCH:
+            return [(flags, data)]
+        messages = []
+        offset, end = 0, len(data)
+        while offset < end:
+            if len(messages) == MAX_BATCH_ENTRIES:
+                raise DataOverflowError("Batch has more than {max} entries".format(max=MAX_BATCH_ENTRIES))
+            if end - offset < ENTRY.size:
+                raise BadSterilization("Batch ends in the middle of an entry header")
+            entry_flags, length = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            if end - offset < length:
+                raise BadSterilization("Batch entry runs past the end of its frame")
+            messages.append((entry_flags, data[offset:offset + length]))
+            offset += length
+        return messages
+
+    def load_all(self, flags: int, payload: memoryview) -> list:
+        return [self.unpack(entry_flags, data) for entry_flags, data in self.messages(flags, payload)]
@@ -0,0 +1,96 @@
+import logging as log
+from collections.abc import Mapping
+from secrets import token_urlsafe
+from threading import Lock
+
+from quicknet.timer import wheel
+
+__all__ = ["Registry"]
+
+
+class Registry(Mapping):
+
+    def __init__(self, grace: float=30):
+        self.grace = grace                    # type: float
+        # Connections that are still open, the closed ones waiting out their grace period don't count.
+        self.connected = 0                    # type: int
+        self._by_id = {}                      # type: dict
+        self._by_addr = {}                    # type: dict
+        self._by_token = {}                   # type: dict
+        self._tokens = {}                     # type: dict
+        self._lock = Lock()
+
+    def __repr__(self):
+        return repr(self._by_id)
+
+    def __getitem__(self, id: str):
+        return self._by_id[id]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._by_id)
+
+    def values(self) -> list:
+        with self._lock:
+            return list(self._by_id.values())
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._by_id.items())
+
+    def add(self, client):
+        with self._lock:
+            self._by_id[client.name] = client
+            self._by_addr[client.addr] = client
+            self.connected += 1
+
+    def by_addr(self, addr: tuple):
+        return self._by_addr.get(addr)
+
+    def by_token(self, token: str):
+        with self._lock:
+            return self._by_id.get(self._by_token.get(token))
+
+    def new_session(self, client) -> str:
+        # Tokens are swapped on every (re)connect, an old token can't be used to take over a session twice.
+        token = token_urlsafe(16)
+        with self._lock:
+            self._by_token.pop(self._tokens.get(client.name), None)
+            self._tokens[client.name] = token
+            self._by_token[token] = client.name
+        return token
+
+    def adopt(self, client, previous):
+        with self._lock:
+            if self._by_id.get(client.name) is client:
+                del self._by_id[client.name]
+            if self._by_addr.get(previous.addr) is previous:
+                del self._by_addr[previous.addr]
+            client.name = previous.name
+            self._by_id[client.name] = client
+            self._by_addr[client.addr] = client
+
+    def release(self, client):
+        with self._lock:
+            self.connected -= 1
+            if self._by_addr.get(client.addr) is client:
+                del self._by_addr[client.addr]
+        if self.grace is not None:
+            wheel.call_later(self.grace, self.evict, client)
+
+    def evict(self, client):
+        with self._lock:
+            if self._by_id.get(client.name) is not client or not client.closed:
+                return
+            del self._by_id[client.name]
+            self._by_token.pop(self._tokens.pop(client.name, None), None)
+        log.debug("Evicted {client}, its session wasn't resumed in time.".format(client=client))
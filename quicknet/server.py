@@ -1,47 +1,105 @@
 import logging as log
 from traceback import print_exception
 from threading import Thread
-import ssl
 import sys
 import socket
 from uuid import uuid4
 
-from quicknet import event, utils, worker
+from quicknet import engine as engines, event, protocol, utils, worker
+from quicknet.cluster import Cluster
+from quicknet.executor import EventExecutor
+from quicknet.heartbeat import Heartbeat
+from quicknet.limits import Limits
+from quicknet.metrics import Metrics
+from quicknet.outbox import OVERFLOW_POLICIES
+from quicknet.registry import Registry
+from quicknet.store import STORE_ACCESS, Store
+from quicknet.timer import TimerWheel
 
 __all__ = ['QServer']
 
 
 class QServer(event.EventThreader, Thread):
 
-    EVENTS = 'CONNECTION', 'CONNECTION_RESET', 'SERVER_REQUEST', 'CLIENT_DISCONNECT'
+    EVENTS = ('CONNECTION', 'CONNECTION_RESET', 'SERVER_REQUEST', 'CLIENT_DISCONNECT', 'BACKPRESSURE', 'DRAINED',
+              'RATE_LIMITED')
     DEFAULT_READ_SIZE = 2048
 
     def __init__(self, port: int, local_only: bool=False, buffer_size: int=None, family: int=socket.AF_INET,
-                 type: int=socket.SOCK_STREAM, use_ssl: bool=False, ssl_data: dict=None):
+                 type: int=socket.SOCK_STREAM, use_ssl: bool=False, ssl_data: dict=None, engine: str="thread",
+                 loops: int=1, executor: EventExecutor=None, compression: dict=None,
+                 binary: bool=True, high_water: int=4 * 1024 * 1024, low_water: int=1024 * 1024,
+                 overflow: str='none', sync_interval: float=0.05, store_shards: int=16,
+                 store_access: str='write', session_grace: float=30, metrics: Metrics=None, processes: int=1,
+                 handshake_timeout: float=10, batch_interval: float=None, batch_bytes: int=16 * 1024,
+                 heartbeat: float=None, read_timeout: float=None, write_timeout: float=None,
+                 rate_limit: float or tuple=None, handler_limits: dict=None, limit_action: str='drop',
+                 max_connections: int=None):
 
-        event.EventThreader.__init__(self)
+        event.EventThreader.__init__(self, executor, metrics)
         Thread.__init__(self)
 
-        self.sock = socket.socket(family, type)
         self.local = local_only
         self.port = port
         self.running = True
         self.buffer_size = buffer_size
-        self.clients = {}
+        self.clients = Registry(session_grace)
         self.error_handler()
         self.ssl = use_ssl
+        self.compression = compression if compression is not None else {}
+        self.binary = binary
+        self.high_water = high_water
+        self.low_water = low_water
+        self.overflow = overflow
+        self.sync_interval = sync_interval
+        self.store = Store(store_shards)
+        self.store_access = store_access
+        self.rooms = {}
+        self.processes = processes
+        self.cluster = None              # type: Cluster
+        # With a batch_interval, events are held back and sent once per tick, many to a frame.
+        self.batch_interval = batch_interval
+        self.batch_bytes = batch_bytes
+        self.ticker = TimerWheel(batch_interval) if batch_interval else None
+        # Clients that go quiet are pinged after heartbeat seconds and dropped after read_timeout, ones that stop
+        # reading after write_timeout.
+        self.heartbeat = Heartbeat.make(heartbeat, read_timeout, write_timeout)
+        # Messages per second from each client, overall and per handler, and what happens to the ones over it.
+        self.limits = Limits.make(rate_limit, handler_limits, limit_action, self.metrics)
+        self.max_connections = max_connections
+        self._codec = protocol.Codec(binary=binary, metrics=self.metrics, **self.compression)
+        self._track()
 
+        if store_access not in STORE_ACCESS:
+            raise ValueError("Unknown store access {access}, expected one of {levels}".format(
+                access=store_access, levels=STORE_ACCESS))
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {policy}, expected one of {policies}".format(
+                policy=overflow, policies=OVERFLOW_POLICIES))
+
+        if engine == "thread":
+            self.engine = None
+        elif engine == "selector":
+            self.engine = engines.SelectorEngine(self, loops)
+        else:
+            raise ValueError("Unknown engine {engine}, expected 'thread' or 'selector'.".format(engine=engine))
+
+        self._family, self._type = family, type
+        self.sock = self._listen_socket()
+        # Connections are wrapped after accept() and shake hands on their own worker or selector loop, so a slow
+        # handshake never holds up the accept loop.
+        self.ssl_context = utils.make_ssl_context(ssl_data, server_side=True) if use_ssl else None
+        self.handshake_timeout = handshake_timeout
         if use_ssl:
-            if ssl_data is None:
-                ssl_data = {}
-            self.sock = ssl.wrap_socket(self.sock, ssl_data.get('keyfile'), ssl_data.get('certfile'), True,
-                                        ssl_data.get('cert_reqs', ssl.CERT_NONE),
-                                        ssl_data.get('ssl_version', ssl.PROTOCOL_SSLv23), ssl_data.get('ca_certs'),
-                                        ssl_data.get('do_handshake_on_connect', True),
-                                        ssl_data.get('suppress_ragged_eofs', True), ssl_data.get('ciphers'))
             log.debug("SSL Added to QServer instance.")
         log.debug("QServer instance finished initialization.")
 
+    def _listen_socket(self, reuse_port: bool=False) -> socket.socket:
+        sock = socket.socket(self._family, self._type)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
+
     @staticmethod
     def error_handler(callback=None):
         if callback is None:
@@ -56,14 +114,44 @@ class QServer(event.EventThreader, Thread):
             raise utils.NotRunningError("The server hasn't been started yet.")
 
         self.running = False
+        if self.cluster is not None:
+            self.cluster.stop()
+            if self.cluster.supervisor:
+                log.info("Server has stopped.")
+                return
         for client in self.clients.values():
             if client.closed:
                 continue
             client.kill()
+        self.store.close()
+        try:
+            # Wakes up an accept() that's blocked in the server thread, close() alone doesn't.
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
+        if self.engine is not None:
+            self.engine.stop()
+        if self.ticker is not None:
+            self.ticker.stop()
         log.info("Server has stopped.")
 
+    def start(self):
+        # With processes > 1 this process becomes a supervisor, the forked workers never return from here.
+        if self.processes > 1 and self.cluster is None:
+            self.sock.close()
+            self.cluster = Cluster(self, self.processes)
+            self.cluster.fork()
+        Thread.start(self)
+
     def run(self, max=50):
+        if self.cluster is not None:
+            if self.cluster.supervisor:
+                self.running = True
+                self.cluster.supervise(max)
+                return
+            self.sock = self._listen_socket(reuse_port=True)
+
         if self.local:
             self.sock.bind(('127.0.0.1', self.port))
         else:
@@ -73,6 +161,11 @@ class QServer(event.EventThreader, Thread):
         self.running = True
         self.sock.listen(max)
 
+        if self.engine is not None:
+            log.debug("Handing connections to the selector engine.")
+            self.engine.serve()
+            return
+
         log.debug("Starting connection loop.")
         while self.running:
             try:
@@ -80,28 +173,132 @@ class QServer(event.EventThreader, Thread):
                 log.info("New connection {addr}".format(addr=addr))
             except OSError:
                 continue
-            if conn.getpeername()[0] not in [c.addr[0] for c in self.clients.values()]:
-                id = str(uuid4())
-                client = worker.ClientWorker(id, conn, self)
-                self.clients[id] = client
-                client.start()
-                self.emit(client, 'CONNECTION', conn, addr)
-                log.debug("Worker for connection {addr} created".format(addr=addr))
-            else:
-                # Ug, already have worker as a variable :p
-                employee = [c for c in self.clients.values() if c.addr[0] == conn.getpeername()[0]][0]
-                if employee.is_alive():
-                    employee.kill()
-                client = worker.ClientWorker(employee.name, conn, self)
-                client.info = employee.info.copy()
-                self.clients[client.name] = client
-                client.start()
-                self.emit(client, 'CONNECTION_RESET', conn, addr)
-                log.debug("Client {addr} that disconnected reconnected, supplying worker for it".format(addr=addr))
+            self.accept(conn, addr)
+
+    def _make_worker(self, id: str, conn: socket.socket):
+        if self.engine is not None:
+            return self.engine.make_worker(id, conn)
+        return worker.ClientWorker(id, conn, self)
+
+    def full(self) -> bool:
+        return self.max_connections is not None and self.clients.connected >= self.max_connections
+
+    def reject(self, addr: tuple):
+        # Turned away before a worker is made or a single byte is read.
+        log.debug("Server is full, turning %s away.", addr)
+        self.metrics.counter('rejected_connections_total', help="Connections closed because the server was "
+                             "full.").inc()
+
+    def accept(self, conn: socket.socket, addr: tuple):
+        if self.full():
+            self.reject(addr)
+            conn.close()
+            return
+        utils.no_delay(conn)
+        if self.ssl_context is not None:
+            conn = self.ssl_context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+        client = self._make_worker(str(uuid4()), conn)
+        self.clients.add(client)
+        client.hello()
+        client.start()
+        client.watch()
+        log.debug("Worker for connection {addr} created".format(addr=addr))
+
+    def _track(self):
+        # Gauges are read when the metrics are collected, nothing on the hot path keeps them up to date.
+        self.metrics.gauge('connections', lambda: sum(not client.closed for client in self.clients.values()),
+                           help="Connected clients.")
+        self.metrics.gauge('outbound_queue_bytes', lambda: sum(client.queued for client in self.clients.values()),
+                           help="Bytes waiting to be written to clients.")
+        if self.executor is not None:
+            self.metrics.gauge('executor_pending', lambda: len(self.executor),
+                               help="Events waiting for a handler thread.")
+
+    def greet(self, client: worker.BaseWorker, token: str=None):
+        # Called with the client's first message. A known session token resumes that session, anything else is new.
+        previous = self.clients.by_token(token) if token is not None else None
+        if previous is not None and previous is not client:
+            if not previous.closed:
+                previous.kill()
+            self.clients.adopt(client, previous)
+            client.resume(previous)
+            client.send_obj(['SESSION', self.clients.new_session(client)])
+            self.emit(client, 'CONNECTION_RESET', client.conn, client.addr)
+            log.debug("Client {addr} resumed its session, supplying worker for it".format(addr=client.addr))
+        else:
+            client.send_obj(['SESSION', self.clients.new_session(client)])
+            self.emit(client, 'CONNECTION', client.conn, client.addr)
+
+    def join_room(self, room: str, client: worker.BaseWorker):
+        self.rooms.setdefault(room, set()).add(client.name)
+
+    def leave_room(self, room: str, client: worker.BaseWorker):
+        members = self.rooms.get(room, set())
+        members.discard(client.name)
+        if not members:
+            self.rooms.pop(room, None)
 
     def broadcast(self, handler: str, *args, **kwargs):
-        for client in self.clients.values():
-            if not client.closed:
-                client.emit(handler, *args, **kwargs)
-        log.info("Broadcasted event to {clients}".format(
-            clients=[c for c in self.clients.values() if not client.closed]))
+        self.multicast(list(self.clients.values()), handler, args, kwargs)
+        if self.cluster is not None:
+            self.cluster.publish(['BROADCAST', None, handler, args, kwargs, []])
+
+    def multicast(self, clients, handler: str, args: tuple=(), kwargs: dict=None, exclude=()):
+        # Rooms span every worker process, lists of clients only hold this process' connections.
+        sent = self._fan_out(clients, handler, args, kwargs, exclude)
+        if self.cluster is not None and type(clients) == str:
+            exclude = (exclude,) if isinstance(exclude, worker.BaseWorker) else exclude
+            self.cluster.publish(['BROADCAST', clients, handler, args, kwargs if kwargs is not None else {},
+                                  [client.name for client in exclude]])
+        log.debug("Broadcasted event to %s clients", len(sent))
+
+    def emit_to(self, name: str, handler: str, *args, **kwargs):
+        # Reaches a client by id, whichever worker process it's connected to.
+        client = self.clients.get(name)
+        if client is not None and not client.closed:
+            client.emit(handler, *args, **kwargs)
+        elif self.cluster is not None:
+            self.cluster.publish(['EMIT', name, handler, args, kwargs])
+        else:
+            raise KeyError(name)
+
+    def deliver(self, message: list):
+        # A broadcast or emit_to from another worker process.
+        if message[0] == 'BROADCAST':
+            target, handler, args, kwargs, exclude = message[1:6]
+            clients = target if target is not None else list(self.clients.values())
+            exclude = [self.clients[name] for name in exclude if name in self.clients]
+            self._fan_out(clients, handler, args, kwargs, exclude)
+        elif message[0] == 'EMIT':
+            client = self.clients.get(message[1])
+            if client is not None and not client.closed:
+                client.emit(message[2], *message[3], **message[4])
+
+    def _fan_out(self, clients, handler: str, args: tuple, kwargs: dict, exclude) -> list:
+        # Serialized and compressed once per format, every connection gets the same frame. Connections that batch
+        # get the serialized message instead, it's compressed along with the rest of their batch.
+        if type(clients) == str:
+            clients = [self.clients[name] for name in self.rooms.get(clients, ()) if name in self.clients]
+        if isinstance(exclude, worker.BaseWorker):
+            exclude = (exclude,)
+
+        message = (handler, tuple(args), kwargs if kwargs is not None else {})
+        frames, payloads = {}, {}
+        sent = []
+        for client in clients:
+            if client.closed or client in exclude:
+                continue
+            binary = client._codec.peer_binary
+            try:
+                if client.batching:
+                    if binary not in payloads:
+                        payloads[binary] = self._codec.serialize(message, binary)
+                    client.queue(*payloads[binary])
+                else:
+                    if binary not in frames:
+                        frames[binary] = self._codec.encode_standalone(message, binary)
+                    client.push(frames[binary])
+            except (utils.NotRunningError, OSError):
+                continue
+            sent.append(client)
+        return sent
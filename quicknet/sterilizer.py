@@ -1,16 +1,19 @@
 import builtins
-from urllib.parse import quote, unquote
+import re
+import struct
+from urllib.parse import quote, unquote_to_bytes
 from types import BuiltinFunctionType, BuiltinMethodType
 
 from quicknet.utils import UnSterilizable, BadSterilization
 
-__all__ = ["dirty", "clean"]
+__all__ = ["dirty", "clean", "pack", "unpack"]
+
+simple = {bool: "B", int: "I", float: "F"}
+byt = {bytearray: "Y", bytes: "y"}
+multi = {list: "L", tuple: "T", set: "E"}
 
 
 def dirty(obj: any) -> str:
-    simple = {bool: "B", int: "I", float: "F"}
-    byt = {bytearray: "Y", bytes: "y"}
-    multi = {list: "L", tuple: "T", set: "E"}
     if type(obj) in simple:
         return "{n}{data}".format(n=simple[type(obj)], data=obj)
     elif type(obj) in byt:
@@ -33,36 +36,291 @@ def dirty(obj: any) -> str:
     elif isinstance(obj, BuiltinFunctionType) or isinstance(obj, BuiltinMethodType):
         return quote("b{obj}".format(obj=obj.__name__))
     else:
-        print(obj, type(obj))
         raise UnSterilizable("Can't sterilize type: {typ}".format(typ=type(obj)))
 
 
-def clean(text: str):
-    simple = {'S': unquote, 'B': bool, 'I': int, 'F': float, 'N': lambda x: None}
-    byt = {'Y': bytearray, 'y': bytes}
-    multi = {'L': list, 'T': tuple, 'E': set}
+MAX_DEPTH = 256
+_PERCENT, _COMMA, _COLON, _CARET = b'%,:^'
+_S, _B, _I, _F, _N, _Y, _y, _b, _D = b'SBIFNYybD'
+_clean_multi = {ord('L'): list, ord('T'): tuple, ord('E'): set, _D: dict}
+_separator_cache = {}
+_nested_escape_cache = {}
+
+
+def _read_char(raw: bytes, pos: int, cap: int) -> tuple:
+    # A character quoted by n containers is "%" followed by n - 1 "25" pairs and its own hex pair.
+    # Returns the character, how many quoting layers it was under and the position after it.
+    char = raw[pos]
+    if char != _PERCENT or cap == 0:
+        return char, 0, pos + 1
+    level = 0
+    pos += 1
+    while True:
+        if pos + 2 > len(raw):
+            raise BadSterilization("Escape sequence runs past the end of the data")
+        char = int(raw[pos:pos + 2], 16)
+        pos += 2
+        level += 1
+        if char != _PERCENT or level == cap:
+            return char, level, pos
+
+
+def _separators(layer: int):
+    # Finds the next "," or ":" quoted at most `layer` times, the end of any scalar at that layer.
     try:
-        typ, data = text[:1], text[1:]
-        if typ in simple:
-            return simple[typ](data)
-        elif typ in multi:
-            data = unquote(data)
-            if data == '^':
-                return multi[typ]()
-            return multi[typ](map(clean, data.split(',')))
-        elif typ in byt:
-            return byt[typ].fromhex(unquote(data))
-        elif typ == 'D':
-            data = unquote(data)
-            if data == '^':
-                return {}
-            items = data.split(',')
-            new = dict(map(lambda s: map(clean, s.split(':')), items))
-            return new
-        elif typ == 'b':
-            return getattr(builtins, unquote(data))
-        else:
-            print(typ, text)
-            raise Exception("Unable to find type for {d}".format(d=typ))
+        return _separator_cache[layer]
+    except KeyError:
+        pattern = re.compile('%(?:25){{0,{n}}}(?:2C|3A)'.format(n=layer - 1).encode(), re.IGNORECASE)
+        return _separator_cache.setdefault(layer, pattern)
+
+
+def _unquote(data: bytes, cap: int) -> bytes:
+    if b'%' not in data:
+        return data
+    if cap > 1:
+        if cap not in _nested_escape_cache:
+            _nested_escape_cache[cap] = re.compile('%(?:25){{1,{n}}}'.format(n=cap - 1).encode())
+        data = _nested_escape_cache[cap].sub(b'%', data)
+    return unquote_to_bytes(data)
+
+
+def _scalar(typ: int, data: bytes):
+    if typ == _S:
+        return data.decode()
+    elif typ == _I:
+        return int(data)
+    elif typ == _F:
+        return float(data)
+    elif typ == _B:
+        return data == b'True'
+    elif typ == _N:
+        return None
+    elif typ == _y:
+        return bytes.fromhex(data.decode())
+    elif typ == _Y:
+        return bytearray.fromhex(data.decode())
+    elif typ == _b:
+        return getattr(builtins, data.decode())
+    raise BadSterilization("Unable to find type for {d}".format(d=chr(typ)))
+
+
+def clean(text: str or bytes, max_depth: int=MAX_DEPTH, max_size: int=None):
+    # Single pass over the text. Everything inside a container is quoted once more than the container itself,
+    # so the separators of a container at depth n are the only "," and ":" that were quoted exactly n times.
+    raw = text.encode() if type(text) is str else bytes(text) if type(text) is memoryview else text
+    if max_size is not None and len(raw) > max_size:
+        raise BadSterilization("Data is over the {max} byte limit".format(max=max_size))
+    end = len(raw)
+    pos = layer = 0
+    # Each open container is [type, layer of its items, collected items]
+    stack = []
+    try:
+        while True:
+            typ = raw[pos]
+            pos += 1
+            if typ in _clean_multi:
+                if pos < end and (raw[pos] == _PERCENT or raw[pos] == _CARET):
+                    char, level, pos = _read_char(raw, pos, layer)
+                    if char != _CARET:
+                        raise BadSterilization("Expected an empty container")
+                    value = _clean_multi[typ]()
+                else:
+                    if len(stack) >= max_depth:
+                        raise BadSterilization("Data is nested deeper than {max}".format(max=max_depth))
+                    layer += 1
+                    stack.append([typ, layer, []])
+                    continue
+            else:
+                match = _separators(layer).search(raw, pos) if layer else None
+                stop = match.start() if match is not None else end
+                value = _scalar(typ, _unquote(raw[pos:stop], layer + 1 if typ == _S or typ == _b else layer))
+                pos = stop
+                if match is not None:
+                    after = match.end()
+                    char = _COMMA if raw[after - 1] in b'Cc' else _COLON
+                    level = (after - stop - 1) // 2
+
+            if pos < end and typ in _clean_multi:
+                char, level, after = _read_char(raw, pos, layer)
+            while stack:
+                top = stack[-1]
+                items = top[2]
+                items.append(value)
+                if pos < end:
+                    if level == top[1]:
+                        expected = _COLON if top[0] == _D and len(items) % 2 else _COMMA
+                        if char != expected:
+                            raise BadSterilization("Unexpected {c!r} in container".format(c=chr(char)))
+                        pos = after
+                        break
+                    elif level > top[1]:
+                        raise BadSterilization("Unexpected {c!r} in container".format(c=chr(char)))
+                stack.pop()
+                if top[0] == _D:
+                    if len(items) % 2:
+                        raise BadSterilization("Dictionary key without a value")
+                    value = dict(zip(items[::2], items[1::2]))
+                else:
+                    value = _clean_multi[top[0]](items)
+            else:
+                if pos != end:
+                    raise BadSterilization("Trailing data after the end of the value")
+                return value
+            layer = stack[-1][1]
+    except BadSterilization:
+        raise
+    except Exception as e:
+        raise BadSterilization(e)
+
+
+# Binary format, every value starts with a one byte tag. Integers and lengths are (zigzag) LEB128 varints,
+# floats are 8 byte doubles, str/bytes/builtins are a length followed by the raw bytes, and containers are an
+# item count followed by their items (dicts alternate key, value).
+NONE, TRUE, FALSE, INT, FLOAT, STR, BYTES, BYTEARRAY, LIST, TUPLE, SET, DICT, BUILTIN = range(13)
+_double = struct.Struct('!d')
+_containers = {list: LIST, tuple: TUPLE, set: SET}
+_builders = {LIST: list, TUPLE: tuple, SET: set}
+# Varints are decoded one byte at a time with a growing shift, so they're capped: lengths and counts at 10 bytes,
+# ints at what a MAX_INT_BITS int takes after zigzag.
+MAX_INT_BITS = 1024
+_LENGTH_SHIFT = 7 * 10
+_INT_SHIFT = 7 * ((MAX_INT_BITS + 7) // 7)
+
+
+def _varint(n: int, out: bytearray):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _pack(obj: any, out: bytearray):
+    typ = type(obj)
+    if typ is str:
+        data = obj.encode()
+        out.append(STR)
+        _varint(len(data), out)
+        out += data
+    elif typ is int:
+        if obj.bit_length() > MAX_INT_BITS:
+            raise UnSterilizable("Ints can't be longer than {max} bits".format(max=MAX_INT_BITS))
+        out.append(INT)
+        _varint(obj << 1 if obj >= 0 else (-obj << 1) - 1, out)
+    elif typ is bool:
+        out.append(TRUE if obj else FALSE)
+    elif obj is None:
+        out.append(NONE)
+    elif typ is float:
+        out.append(FLOAT)
+        out += _double.pack(obj)
+    elif typ is bytes or typ is bytearray:
+        out.append(BYTES if typ is bytes else BYTEARRAY)
+        _varint(len(obj), out)
+        out += obj
+    elif typ in _containers:
+        out.append(_containers[typ])
+        _varint(len(obj), out)
+        for item in obj:
+            _pack(item, out)
+    elif typ is dict:
+        out.append(DICT)
+        _varint(len(obj), out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    elif isinstance(obj, BuiltinFunctionType) or isinstance(obj, BuiltinMethodType):
+        data = obj.__name__.encode()
+        out.append(BUILTIN)
+        _varint(len(data), out)
+        out += data
+    else:
+        raise UnSterilizable("Can't sterilize type: {typ}".format(typ=typ))
+
+
+def pack(obj: any) -> bytes:
+    out = bytearray()
+    try:
+        _pack(obj, out)
+    except RecursionError:
+        raise UnSterilizable("Object is nested too deeply to sterilize")
+    return bytes(out)
+
+
+def unpack(data: bytes, max_depth: int=MAX_DEPTH):
+    view = memoryview(data)
+    end = len(view)
+    pos = 0
+    # Each open container is [tag, items left, collected items]
+    stack = []
+    try:
+        while True:
+            tag = view[pos]
+            pos += 1
+            if tag == INT or tag == STR or tag == BYTES or tag == BYTEARRAY or tag == BUILTIN or LIST <= tag <= DICT:
+                n = shift = 0
+                limit = _INT_SHIFT if tag == INT else _LENGTH_SHIFT
+                while True:
+                    b = view[pos]
+                    pos += 1
+                    n |= (b & 0x7f) << shift
+                    if b < 0x80:
+                        break
+                    shift += 7
+                    if shift >= limit:
+                        raise BadSterilization("Varint is longer than {n} bytes".format(n=limit // 7))
+
+            if tag == INT:
+                value = n >> 1 if not n & 1 else -((n + 1) >> 1)
+            elif tag == STR:
+                if pos + n > end:
+                    raise BadSterilization("String runs past the end of the data")
+                value = str(view[pos:pos + n], 'utf-8')
+                pos += n
+            elif tag == NONE:
+                value = None
+            elif tag == TRUE or tag == FALSE:
+                value = tag == TRUE
+            elif tag == FLOAT:
+                value = _double.unpack_from(view, pos)[0]
+                pos += 8
+            elif tag == BYTES or tag == BYTEARRAY:
+                if pos + n > end:
+                    raise BadSterilization("Bytes run past the end of the data")
+                value = view[pos:pos + n].tobytes() if tag == BYTES else bytearray(view[pos:pos + n])
+                pos += n
+            elif tag == BUILTIN:
+                value = getattr(builtins, str(view[pos:pos + n], 'utf-8'))
+                pos += n
+            elif tag <= DICT:
+                if len(stack) >= max_depth:
+                    raise BadSterilization("Data is nested deeper than {max}".format(max=max_depth))
+                if n > end - pos:
+                    raise BadSterilization("Container claims more items than there is data")
+                count = n * 2 if tag == DICT else n
+                if count:
+                    stack.append([tag, count, []])
+                    continue
+                value = {} if tag == DICT else _builders[tag]()
+            else:
+                raise BadSterilization("Unknown type tag {tag}".format(tag=tag))
+
+            while stack:
+                top = stack[-1]
+                top[2].append(value)
+                top[1] -= 1
+                if top[1]:
+                    break
+                stack.pop()
+                items = top[2]
+                if top[0] == DICT:
+                    value = dict(zip(items[::2], items[1::2]))
+                else:
+                    value = _builders[top[0]](items)
+            else:
+                if pos != end:
+                    raise BadSterilization("Trailing data after the end of the value")
+                return value
+    except BadSterilization:
+        raise
     except Exception as e:
         raise BadSterilization(e)
@@ -0,0 +1,246 @@
+import logging as log
+from threading import Lock
+from time import monotonic
+
+from quicknet.timer import wheel
+
+__all__ = ["Store", "Namespace", "RemoteStore", "STORE_ACCESS"]
+STORE_ACCESS = 'none', 'read', 'write'
+_MISSING = object()
+
+
+class Shard:
+
+    __slots__ = 'lock', 'data', 'expires'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = {}
+        self.expires = {}
+
+    def alive(self, key, now: float) -> bool:
+        # Call with the lock held. Expired keys are removed the first time anyone looks at them.
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= now:
+            del self.data[key]
+            del self.expires[key]
+            return False
+        return key in self.data
+
+    def put(self, key, value, ttl: float):
+        self.data[key] = value
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = monotonic() + ttl
+
+
+class Store:
+
+    def __init__(self, shards: int=16, sweep_interval: float=1):
+        if shards < 1:
+            raise ValueError("A store needs at least one shard.")
+
+        self.sweep_interval = sweep_interval  # type: float
+        self._shards = [Shard() for _ in range(shards)]
+        self._sweeping = False
+        self._closed = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def _shard(self, key, namespace: str) -> tuple:
+        key = (namespace, key)
+        return key, self._shards[hash(key) % len(self._shards)]
+
+    def namespace(self, name: str) -> 'Namespace':
+        return Namespace(self, name)
+
+    def get(self, key, default=None, namespace: str=''):
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            if shard.alive(key, monotonic()):
+                return shard.data[key]
+        return default
+
+    def set(self, key, value, ttl: float=None, namespace: str=''):
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            shard.put(key, value, ttl)
+        if ttl is not None:
+            self._sweep_later()
+
+    def delete(self, key, namespace: str='') -> bool:
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            if not shard.alive(key, monotonic()):
+                return False
+            del shard.data[key]
+            shard.expires.pop(key, None)
+            return True
+
+    def incr(self, key, amount: int=1, namespace: str=''):
+        return self.update(key, lambda value: value + amount, 0, namespace=namespace)
+
+    def compare_and_set(self, key, expected, value, ttl: float=None, namespace: str='') -> bool:
+        # A missing key compares equal to None.
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            current = shard.data[key] if shard.alive(key, monotonic()) else None
+            if current != expected:
+                return False
+            shard.put(key, value, ttl)
+        if ttl is not None:
+            self._sweep_later()
+        return True
+
+    def update(self, key, func, default=None, namespace: str=''):
+        # func runs with the shard locked, keep it short and don't touch the store from inside it.
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            alive = shard.alive(key, monotonic())
+            value = func(shard.data[key] if alive else default)
+            shard.data[key] = value
+        return value
+
+    def expire(self, key, ttl: float=None, namespace: str='') -> bool:
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            if not shard.alive(key, monotonic()):
+                return False
+            shard.put(key, shard.data[key], ttl)
+        if ttl is not None:
+            self._sweep_later()
+        return True
+
+    def ttl(self, key, namespace: str=''):
+        key, shard = self._shard(key, namespace)
+        with shard.lock:
+            now = monotonic()
+            if not shard.alive(key, now):
+                return None
+            deadline = shard.expires.get(key)
+        return None if deadline is None else deadline - now
+
+    def keys(self, namespace: str='') -> list:
+        now = monotonic()
+        keys = []
+        for shard in self._shards:
+            with shard.lock:
+                keys.extend(key[1] for key in list(shard.data) if key[0] == namespace and shard.alive(key, now))
+        return keys
+
+    def sweep(self) -> int:
+        now = monotonic()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                expired = [key for key, deadline in shard.expires.items() if deadline <= now]
+                for key in expired:
+                    del shard.data[key]
+                    del shard.expires[key]
+            removed += len(expired)
+        if removed:
+            log.debug("Store sweep removed {n} expired keys.".format(n=removed))
+        return removed
+
+    def _sweep_later(self):
+        with self._lock:
+            if self._sweeping or self._closed:
+                return
+            self._sweeping = True
+        wheel.call_later(self.sweep_interval, self._sweep_tick)
+
+    def _sweep_tick(self):
+        self.sweep()
+        with self._lock:
+            self._sweeping = False
+        if any(shard.expires for shard in self._shards):
+            self._sweep_later()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+
+class Namespace:
+
+    def __init__(self, store: Store, name: str):
+        self.store = store
+        self.name = name
+
+    def __getattr__(self, item):
+        # Every Store method, with namespace= filled in.
+        method = getattr(self.store, item)
+
+        def bound(*args, **kwargs):
+            kwargs.setdefault('namespace', self.name)
+            return method(*args, **kwargs)
+        return bound
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+
+class RemoteStore:
+
+    def __init__(self, client, namespace: str=''):
+        self.client = client
+        self.name = namespace
+
+    def __getitem__(self, key):
+        return self.client.wait(self.get(key))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def namespace(self, name: str) -> 'RemoteStore':
+        return RemoteStore(self.client, name)
+
+    def get(self, key):
+        return self.client._request('SGET', key, self.name)
+
+    def set(self, key, value, ttl: float=None):
+        return self.client._request('SSET', key, value, self.name, ttl)
+
+    def delete(self, key):
+        return self.client._request('SDEL', key, self.name)
+
+    def incr(self, key, amount: int=1):
+        return self.client._request('INCR', key, amount, self.name)
+
+    def compare_and_set(self, key, expected, value, ttl: float=None):
+        return self.client._request('CAS', key, expected, value, self.name, ttl)
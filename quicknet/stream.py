@@ -0,0 +1,330 @@
+import asyncio
+import logging as log
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from threading import Condition, Lock, Thread
+
+from quicknet.utils import NotRunningError, ProtocolError, RemoteError
+
+__all__ = ["STREAM_COMMANDS", "CHUNK_SIZE", "WINDOW", "MAX_WINDOW", "MAX_BUFFERED", "MAX_STREAMS", "chunks",
+           "Stream", "Sender", "Streams"]
+
+# A stream is opened with ['STREAM', id, handler, args, kwargs, window, chunk_size], sent as ['CHUNK', id, data]
+# messages and finished with ['END', id, error]. The receiver hands out credit with ['STREAM_ACK', id, n] and can
+# ['STREAM_CANCEL', id].
+STREAM_COMMANDS = 'STREAM', 'CHUNK', 'END', 'STREAM_ACK', 'STREAM_CANCEL'
+CHUNK_SIZE = 64 * 1024
+# Chunks the sender may have in flight before the receiver has to take one.
+WINDOW = 8
+# The most chunks a receiver will hold for one stream, and the most bytes (window times chunk size). Streams asking
+# for more are refused.
+MAX_WINDOW = 64
+MAX_BUFFERED = 16 * 1024 * 1024
+# Incoming streams open at once on one connection, each has a handler thread. Any past this are refused.
+MAX_STREAMS = 8
+
+
+def chunks(source, size: int=CHUNK_SIZE):
+    # Bytes are sliced, files are read size bytes at a time and anything else is iterated for bytes.
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        with memoryview(source) as view:
+            for start in range(0, len(view), size):
+                yield bytes(view[start:start + size])
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(size)
+            if not chunk:
+                return
+            yield bytes(chunk)
+    else:
+        for piece in source:
+            if len(piece) > size:
+                yield from chunks(piece, size)
+            elif piece:
+                yield bytes(piece)
+
+
+class Stream:
+    # The receiving end. Iterating it blocks until the next chunk arrives, every chunk taken gives the sender credit
+    # for another one, so a slow reader never has more than window chunks waiting. Coroutines use async for, which
+    # waits without blocking the loop.
+
+    def __init__(self, id: int, ack, cancel, window: int=WINDOW, chunk_size: int=CHUNK_SIZE):
+        self.id = id                          # type: int
+        self.window = window                  # type: int
+        self.chunk_size = chunk_size          # type: int
+        self.received = 0                     # type: int
+        self.done = False                     # type: bool
+        self._ack = ack
+        self._cancel = cancel
+        self._chunks = deque()                # type: deque
+        self._error = None                    # type: Exception
+        self._cond = Condition()
+        self._waiter = None                   # type: asyncio.Future
+
+    def __repr__(self):
+        return "<Stream {id} ({received} bytes{done})>".format(id=self.id, received=self.received,
+                                                               done=", done" if self.done else "")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        with self._cond:
+            while not self._chunks and not self.done:
+                self._cond.wait()
+            if not self._chunks:
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            chunk = self._chunks.popleft()
+            finished = self.done
+        if not finished:
+            self._ack(self.id)
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        while True:
+            with self._cond:
+                if self._chunks or self.done:
+                    break
+                if self._waiter is None:
+                    self._waiter = asyncio.get_running_loop().create_future()
+                waiter = self._waiter
+            await waiter
+        try:
+            return next(self)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def read(self) -> bytes:
+        return b''.join(self)
+
+    def save(self, file) -> int:
+        # A path or a file opened for binary writing, returns how many bytes were written.
+        if isinstance(file, str):
+            with open(file, 'wb') as f:
+                return self.save(f)
+        written = 0
+        for chunk in self:
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+    def close(self):
+        # Stops the sender, chunks that are still on their way are thrown away.
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self._chunks.clear()
+            self._cond.notify_all()
+            self._wake()
+        self._cancel(self.id)
+
+    def _feed(self, data: bytes) -> bool:
+        # False when the sender went over its window or chunk size, the stream then ends with an error and its chunks
+        # are dropped.
+        with self._cond:
+            if self.done:
+                return True
+            if len(self._chunks) >= self.window or len(data) > self.chunk_size:
+                self.done = True
+                self._chunks.clear()
+                self._error = ProtocolError("Sender went over the window or chunk size of stream {id}".format(
+                    id=self.id))
+                self._cond.notify_all()
+                self._wake()
+                return False
+            self._chunks.append(data)
+            self.received += len(data)
+            self._cond.notify()
+            self._wake()
+        return True
+
+    def _end(self, error: Exception=None):
+        with self._cond:
+            self.done = True
+            self._error = error
+            self._cond.notify_all()
+            self._wake()
+
+    def _wake(self):
+        # Called holding the condition. Chunks can arrive on any thread, the waiting coroutine is woken on its loop.
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.get_loop().call_soon_threadsafe(_release, waiter)
+
+
+def _release(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Sender(Thread):
+    # Reads the source one chunk at a time and only while it has credit, so the whole payload is never in memory.
+
+    def __init__(self, id: int, send_obj, source, chunk_size: int, window: int, on_done):
+        Thread.__init__(self, name="quicknet-stream-{id}".format(id=id), daemon=True)
+
+        self.id = id                          # type: int
+        self.source = source
+        self.chunk_size = chunk_size          # type: int
+        self.future = Future()                # type: Future
+        self._send_obj = send_obj
+        self._on_done = on_done
+        self._credit = window                 # type: int
+        self._error = None                    # type: Exception
+        self._cond = Condition()
+
+    def acked(self, n: int):
+        with self._cond:
+            self._credit += n
+            self._cond.notify()
+
+    def stop(self, error: Exception):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify()
+
+    def _take_credit(self):
+        with self._cond:
+            while not self._credit and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            self._credit -= 1
+
+    def run(self):
+        sent = 0
+        try:
+            for chunk in chunks(self.source, self.chunk_size):
+                self._take_credit()
+                self._send_obj(['CHUNK', self.id, chunk])
+                sent += len(chunk)
+        except (NotRunningError, RemoteError) as e:
+            self.future.set_exception(e)
+        except Exception as e:
+            log.info("Stream {id} couldn't read its source ({e}).".format(id=self.id, e=e))
+            self.future.set_exception(e)
+            try:
+                self._send_obj(['END', self.id, "{name}: {e}".format(name=type(e).__name__, e=e)])
+            except NotRunningError:
+                pass
+        else:
+            try:
+                self._send_obj(['END', self.id, None])
+            except NotRunningError as e:
+                self.future.set_exception(e)
+            else:
+                self.future.set_result(sent)
+        finally:
+            self._on_done(self.id)
+
+
+def _allowed(window: int, chunk_size: int) -> bool:
+    return 1 <= window <= MAX_WINDOW and chunk_size >= 1 and window * chunk_size <= MAX_BUFFERED
+
+
+class Streams:
+    # Every stream going either way on one connection. Chunks are ordinary frames, so events and replies get
+    # through in between them instead of waiting for the whole transfer.
+
+    def __init__(self, send_obj, on_open):
+        self._send_obj = send_obj
+        self._on_open = on_open               # type: callable
+        self._ids = count(1)
+        self._lock = Lock()
+        self.incoming = {}                    # type: dict
+        self.outgoing = {}                    # type: dict
+
+    def open(self, handler: str, source, args: tuple, kwargs: dict, chunk_size: int=CHUNK_SIZE,
+             window: int=WINDOW) -> Future:
+        if not _allowed(window, chunk_size):
+            raise ValueError("Streams need a positive chunk size and a window of 1 to {max} chunks, {bytes} bytes "
+                             "at most.".format(max=MAX_WINDOW, bytes=MAX_BUFFERED))
+        with self._lock:
+            sid = next(self._ids)
+            sender = self.outgoing[sid] = Sender(sid, self._send_obj, source, chunk_size, window, self._finished)
+        try:
+            self._send_obj(['STREAM', sid, handler, args, kwargs, window, chunk_size])
+        except Exception:
+            self._finished(sid)
+            raise
+        sender.start()
+        return sender.future
+
+    def _finished(self, sid: int):
+        with self._lock:
+            self.outgoing.pop(sid, None)
+
+    def _ack(self, sid: int):
+        try:
+            self._send_obj(['STREAM_ACK', sid, 1])
+        except (NotRunningError, OSError):
+            pass
+
+    def _cancel(self, sid: int):
+        with self._lock:
+            self.incoming.pop(sid, None)
+        try:
+            self._send_obj(['STREAM_CANCEL', sid])
+        except (NotRunningError, OSError):
+            pass
+
+    def handle(self, info: list):
+        command, sid = info[0], info[1]
+        if command == 'CHUNK':
+            if type(info[2]) is not bytes:
+                raise TypeError("Stream chunks have to be bytes")
+            stream = self.incoming.get(sid)
+            if stream is not None and not stream._feed(info[2]):
+                log.info("Stream {id} went over its window or chunk size, cancelling it.".format(id=sid))
+                self._cancel(sid)
+        elif command == 'END':
+            with self._lock:
+                stream = self.incoming.pop(sid, None)
+            if stream is not None:
+                stream._end(None if info[2] is None else RemoteError(info[2]))
+        elif command == 'STREAM':
+            handler, args, kwargs = info[2], tuple(info[3]), dict(info[4])
+            window = int(info[5]) if len(info) > 5 else WINDOW
+            chunk_size = int(info[6]) if len(info) > 6 else CHUNK_SIZE
+            if not _allowed(window, chunk_size):
+                log.info("Stream {id} asked for a window of {window} chunks of {size} bytes, refusing it.".format(
+                    id=sid, window=window, size=chunk_size))
+                self._cancel(sid)
+                return
+            stream = Stream(sid, self._ack, self._cancel, window, chunk_size)
+            with self._lock:
+                full = len(self.incoming) >= MAX_STREAMS
+                if not full:
+                    self.incoming[sid] = stream
+            if full:
+                log.info("Stream {id} is over {max} open streams, refusing it.".format(id=sid, max=MAX_STREAMS))
+                self._cancel(sid)
+                return
+            self._on_open(stream, handler, args, kwargs)
+        elif command == 'STREAM_ACK':
+            sender = self.outgoing.get(sid)
+            if sender is not None:
+                sender.acked(int(info[2]))
+        elif command == 'STREAM_CANCEL':
+            sender = self.outgoing.get(sid)
+            if sender is not None:
+                sender.stop(RemoteError("The receiver closed stream {id}".format(id=sid)))
+
+    def close(self, error: Exception):
+        # The connection is gone, readers get the error and senders stop.
+        with self._lock:
+            incoming, self.incoming = self.incoming, {}
+            outgoing = list(self.outgoing.values())
+        for stream in incoming.values():
+            stream._end(error)
+        for sender in outgoing:
+            sender.stop(error)
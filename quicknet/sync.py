@@ -0,0 +1,109 @@
+from threading import Lock
+
+__all__ = ["SharedState", "Replica"]
+
+
+class SharedState(dict):
+
+    def __init__(self, *args, on_change=None, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.on_change = on_change            # type: callable
+        self.dirty = set()                    # type: set
+        self._lock = Lock()
+
+    def _touch(self, keys):
+        with self._lock:
+            self.dirty.update(keys)
+        if self.on_change is not None:
+            self.on_change()
+
+    def take(self) -> set:
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch((key,))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch((key,))
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        self._touch((key,))
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._touch((key,))
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        dict.update(self, changes)
+        self._touch(changes)
+
+    def clear(self):
+        keys = list(self)
+        dict.clear(self)
+        self._touch(keys)
+
+
+class Replica:
+
+    def __init__(self):
+        self.data = {}                        # type: dict
+        self.version = 0                      # type: int
+        self.keys = None                      # type: frozenset
+        self._writing = {}                    # type: dict
+        self._lock = Lock()
+
+    def covers(self, key) -> bool:
+        # Keys with a write in flight are read from the server, so a client always sees its own writes.
+        with self._lock:
+            if self.keys is None or self._writing.get(key):
+                return False
+            return self.keys is True or key in self.keys
+
+    def subscribed(self, keys):
+        with self._lock:
+            self.keys = True if keys is None else frozenset(keys)
+
+    def apply(self, version: int, changes: dict, removed: list, full: bool):
+        with self._lock:
+            if full:
+                self.data.clear()
+            elif version <= self.version:
+                return
+            self.version = version
+            self.data.update(changes)
+            for key in removed:
+                self.data.pop(key, None)
+
+    def writing(self, future, changes: dict=None, removed: list=()):
+        # The cache takes the write once the server confirms it, until then reads of those keys skip the cache.
+        changes = changes if changes is not None else {}
+        keys = list(changes) + list(removed)
+        with self._lock:
+            for key in keys:
+                self._writing[key] = self._writing.get(key, 0) + 1
+        future.add_done_callback(lambda done: self._written(done, keys, changes, removed))
+
+    def _written(self, future, keys: list, changes: dict, removed: list):
+        with self._lock:
+            if not future.cancelled() and future.exception() is None:
+                self.data.update(changes)
+                for key in removed:
+                    self.data.pop(key, None)
+            for key in keys:
+                self._writing[key] -= 1
+                if not self._writing[key]:
+                    del self._writing[key]
@@ -0,0 +1,118 @@
+import logging as log
+from math import ceil
+import os
+from threading import Thread, Condition
+from time import monotonic
+from weakref import WeakSet
+
+__all__ = ["Timer", "TimerWheel", "wheel"]
+_wheels = WeakSet()
+
+
+class Timer:
+
+    __slots__ = 'func', 'args', 'rounds', 'cancelled'
+
+    def __init__(self, func, args: tuple, rounds: int):
+        self.func = func
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+
+    def __init__(self, tick: float=0.05, slots: int=512):
+        if tick <= 0 or slots < 1:
+            raise ValueError("A timer wheel needs a positive tick and at least one slot.")
+
+        self.tick = tick                      # type: float
+        self.slots = slots                    # type: int
+        self.running = True                   # type: bool
+        self._wheel = [[] for _ in range(slots)]
+        self._cursor = 0                      # type: int
+        self._count = 0                       # type: int
+        self._thread = None                   # type: Thread
+        self._cond = Condition()
+        _wheels.add(self)
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay: float, func, *args) -> Timer:
+        # Timers fire on the tick after their delay runs out, so they're late by up to one tick, never early.
+        ticks = max(1, ceil(delay / self.tick))
+        timer = Timer(func, args, (ticks - 1) // self.slots)
+        with self._cond:
+            self._wheel[(self._cursor + ticks) % self.slots].append(timer)
+            self._count += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._turn, name="quicknet-timers", daemon=True)
+                self._thread.start()
+            elif self._count == 1:
+                self._cond.notify()
+        return timer
+
+    def _advance(self) -> list:
+        with self._cond:
+            self._cursor = (self._cursor + 1) % self.slots
+            slot = self._wheel[self._cursor]
+            due, kept = [], []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    kept.append(timer)
+                else:
+                    due.append(timer)
+            self._count -= len(slot) - len(kept)
+            self._wheel[self._cursor] = kept
+        return due
+
+    def _turn(self):
+        next_tick = monotonic() + self.tick
+        while self.running:
+            with self._cond:
+                while not self._count and self.running:
+                    self._cond.wait()
+                    next_tick = monotonic() + self.tick
+                delay = next_tick - monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            next_tick += self.tick
+            for timer in self._advance():
+                try:
+                    timer.func(*timer.args)
+                except Exception:
+                    log.exception("Timer callback {func} raised an exception.".format(func=timer.func))
+        log.debug("Timer wheel has stopped.")
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+
+    def _forked(self):
+        # Only the forking thread survives a fork, and the lock may have been held by one that didn't. Pending timers
+        # are kept, the child's copies of whatever set them still need them. Stopped wheels stay stopped.
+        self._cond = Condition()
+        self._thread = None
+        if self.running and self._count:
+            self._thread = Thread(target=self._turn, name="quicknet-timers", daemon=True)
+            self._thread.start()
+
+
+def _after_fork():
+    for timer_wheel in list(_wheels):
+        timer_wheel._forked()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+wheel = TimerWheel()
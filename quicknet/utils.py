@@ -1,7 +1,13 @@
-from inspect import getfullargspec
+from inspect import Parameter, signature
+from reprlib import Repr
+import socket
+import ssl
 
-__all__ = ["QuickNetError", "NotRunningError", "DataOverflowError",
-           "UnSterilizable", "BadSterilization", "check_annotations"]
+__all__ = ["QuickNetError", "NotRunningError", "DataOverflowError", "BackpressureError", "ProtocolError",
+           "SharingLockedError", "RemoteError",
+           "UnSterilizable", "BadSterilization", "compile_annotations", "check_annotations",
+           "no_delay", "make_ssl_context", "describe"]
+_short = Repr()
 
 
 class QuickNetError(Exception):
@@ -16,6 +22,22 @@ class DataOverflowError(QuickNetError):
     pass
 
 
+class BackpressureError(QuickNetError):
+    pass
+
+
+class ProtocolError(QuickNetError):
+    pass
+
+
+class SharingLockedError(QuickNetError):
+    pass
+
+
+class RemoteError(QuickNetError):
+    pass
+
+
 class UnSterilizable(QuickNetError):
     pass
 
@@ -24,14 +46,77 @@ class BadSterilization(QuickNetError):
     pass
 
 
-def check_annotations(func, args, kwargs) -> bool:
-    specs = getfullargspec(func)
-    for arg, name in zip(args, specs.args):
-        if name in specs.annotations:
-            if type(arg) != specs.annotations[name]:
+def compile_annotations(func):
+    # Reads the signature once, the returned validator only compares types. Annotations that aren't classes
+    # (strings, typing constructs) aren't checked.
+    positional, keywords = [], {}
+    rest = extra = None
+    for param in signature(func).parameters.values():
+        expected = param.annotation
+        if expected is Parameter.empty or not isinstance(expected, type):
+            expected = None
+        if param.kind == Parameter.VAR_POSITIONAL:
+            rest = expected
+        elif param.kind == Parameter.VAR_KEYWORD:
+            extra = expected
+        else:
+            if param.kind != Parameter.KEYWORD_ONLY:
+                positional.append(expected)
+            if param.kind != Parameter.POSITIONAL_ONLY:
+                keywords[param.name] = expected
+
+    def validate(args: tuple, kwargs: dict) -> bool:
+        for i, arg in enumerate(args):
+            expected = positional[i] if i < len(positional) else rest
+            if expected is not None and type(arg) != expected:
                 return False
-    for name, val in kwargs.items():
-        if name in specs:
-            if type(val) != specs[name]:
+        for name, val in kwargs.items():
+            expected = keywords[name] if name in keywords else extra
+            if expected is not None and type(val) != expected:
                 return False
-    return True
+        return True
+    return validate
+
+
+def check_annotations(func, args, kwargs) -> bool:
+    return compile_annotations(func)(args, kwargs)
+
+
+def describe(obj: any) -> str:
+    # A short description of a bad message, for BAD_CALL replies. Echoing the message itself could be huge, or
+    # impossible to serialize again.
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return "{n} bytes that couldn't be decoded".format(n=len(obj))
+    try:
+        return _short.repr(obj)
+    except ValueError:
+        return "<{typ} too big to show>".format(typ=type(obj).__name__)
+
+
+def no_delay(sock: socket.socket):
+    # Frames are written whole, Nagle would only hold small ones (a session ticket, a reply) back for an ACK.
+    if sock.family in (socket.AF_INET, socket.AF_INET6) and sock.type == socket.SOCK_STREAM:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def make_ssl_context(ssl_data: dict=None, server_side: bool=False) -> ssl.SSLContext:
+    # One context is shared by every connection, it holds the session cache and ticket keys that resumption needs.
+    if ssl_data is None:
+        ssl_data = {}
+    if ssl_data.get('context') is not None:
+        return ssl_data['context']
+    if server_side:
+        context = ssl.SSLContext(ssl_data.get('ssl_version', ssl.PROTOCOL_TLS_SERVER))
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = ssl_data.get('tickets', 2)
+    else:
+        context = ssl.SSLContext(ssl_data.get('ssl_version', ssl.PROTOCOL_TLS_CLIENT))
+        context.check_hostname = ssl_data.get('check_hostname', False)
+    context.verify_mode = ssl_data.get('cert_reqs', ssl.CERT_NONE)
+    if ssl_data.get('certfile') is not None:
+        context.load_cert_chain(ssl_data['certfile'], ssl_data.get('keyfile'))
+    if ssl_data.get('ca_certs') is not None:
+        context.load_verify_locations(ssl_data['ca_certs'])
+    if ssl_data.get('ciphers') is not None:
+        context.set_ciphers(ssl_data['ciphers'])
+    return context
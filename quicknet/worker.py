@@ -1,39 +1,151 @@
 import logging as log
-from threading import Thread
+from concurrent.futures import Future
+from threading import Thread, Lock, RLock
+from time import monotonic, sleep
 import socket
+import ssl
 import zlib
 
-from quicknet import utils, sterilizer
+from quicknet import protocol, utils
+from quicknet.outbox import Outbox, send_some
+from quicknet.pending import PendingRequests
+from quicknet.stream import CHUNK_SIZE, STREAM_COMMANDS, WINDOW, Stream, Streams
+from quicknet.sync import SharedState
+from quicknet.timer import wheel
 
-__all__ = ["ClientWorker"]
+__all__ = ["BaseWorker", "ClientWorker"]
 
 
-class ClientWorker(Thread):
+def _handler_of(info) -> str:
+    # The handler an event or a CALL is for, handler limits apply to both.
+    if type(info) == tuple and info:
+        name = info[0]
+    elif type(info) == list and len(info) > 1 and info[0] == 'CALL':
+        name = info[1]
+    else:
+        return None
+    return name if type(name) is str else None
 
-    def __init__(self, id: str, conn: socket.socket, manager):
-        super().__init__(name=id)
 
+class BaseWorker:
+    # One connection, whatever engine runs it. There can be tens of thousands of these, so there's no __dict__ and
+    # everything a quiet connection doesn't need (info, shared, pending requests, streams) is made on first use.
+
+    __slots__ = ('name', 'conn', 'addr', 'server', 'closed', 'greeted', '_info', '_shared', '_lock_sharing',
+                 '_subscription', '_sync_version', '_sync_pending', '_sync_lock', '_parser', '_codec', '_send_lock',
+                 '_batch', '_batch_pending', '_outbox', '_reqs', '_streams', '_last_read', '_buckets',
+                 '_held', '__weakref__')
+
+    # Server store commands and their lengths, request id included. GET, SET and DEL are the client's shared data.
+    STORE_REQUESTS = {'SGET': 4, 'SSET': 6, 'SDEL': 4, 'INCR': 5, 'CAS': 7}
+
+    def __init__(self, conn: socket.socket, manager):
+        self.name = None                 # type: str
         self.conn = conn
         self.addr = conn.getpeername()
         self.server = manager
         self.closed = False
-        self.info = {}
-        self.shared = {}
-        self._lock_sharing = [False]
-        self._buffer = bytearray()
-        log.debug("Finished ClientWorker initialization.")
+        self.greeted = False
+        self._info = None                # type: dict
+        self._shared = None              # type: SharedState
+        self._lock_sharing = False
+        self._subscription = None        # type: frozenset
+        self._sync_version = 0
+        self._sync_pending = False
+        self._sync_lock = Lock()
+        self._parser = protocol.FrameParser()
+        self._codec = protocol.Codec(binary=manager.binary, metrics=manager.metrics, **manager.compression)
+        # Reentrant, a kill from inside a write (overflow='disconnect') still flushes the batch.
+        self._send_lock = RLock()
+        self._batch = protocol.Batch() if manager.batch_interval else None
+        self._batch_pending = False
+        self._outbox = Outbox(manager.high_water, manager.low_water, self._on_congested, self._on_drained)
+        self._reqs = None                # type: PendingRequests
+        self._streams = None             # type: Streams
+        self._last_read = monotonic()    # type: float
+        self._buckets = None             # type: dict
+        self._held = None                # type: list
 
     def __repr__(self):
         return "<{addr}:{conn} [{closed}]>".format(addr=self.addr, conn=self.conn,
                                                    closed="Closed" if self.closed else "Open")
 
+    @property
+    def info(self) -> dict:
+        if self._info is None:
+            with self._send_lock:
+                if self._info is None:
+                    self._info = {}
+        return self._info
+
+    @info.setter
+    def info(self, val: dict):
+        self._info = val
+
+    @property
+    def shared(self) -> SharedState:
+        if self._shared is None:
+            with self._send_lock:
+                if self._shared is None:
+                    self._shared = SharedState(on_change=self._shared_changed)
+        return self._shared
+
     @property
     def lock_sharing(self):
-        return self._lock_sharing[0]
+        return self._lock_sharing
 
     @lock_sharing.setter
     def lock_sharing(self, val: bool):
-        self._lock_sharing[0] = val
+        self._lock_sharing = val
+
+    def _pending(self) -> PendingRequests:
+        if self._reqs is None:
+            with self._send_lock:
+                if self._reqs is None:
+                    self._reqs = self._make_pending()
+        return self._reqs
+
+    def _make_pending(self) -> PendingRequests:
+        return PendingRequests()
+
+    def _transfers(self) -> Streams:
+        if self._streams is None:
+            with self._send_lock:
+                if self._streams is None:
+                    self._streams = Streams(self._stream_send, self._open_stream)
+        return self._streams
+
+    def _stream_send(self, obj: any):
+        # Chunks come from sender threads and credit from handler threads.
+        self.send_obj(obj)
+
+    @property
+    def congested(self) -> bool:
+        return self._outbox.congested
+
+    @property
+    def queued(self) -> int:
+        return self._outbox.size
+
+    @property
+    def batching(self) -> bool:
+        return self._batch is not None and self._codec.peer_batch
+
+    def _admit(self) -> bool:
+        if self.congested and self.server.overflow == 'drop':
+            log.debug("%s is too far behind, dropping message.", self)
+            return False
+        return True
+
+    def _on_congested(self):
+        self.server.emit(self, 'BACKPRESSURE', self)
+        if self.server.overflow == 'disconnect' and not self.closed:
+            log.info("{this} couldn't keep up, disconnecting it.".format(this=self))
+            self._outbox.clear()
+            self.kill()
+
+    def _on_drained(self):
+        self.server.emit(self, 'DRAINED', self)
 
     def send(self, data: bytes or str):
         data = data if type(data) is bytes else data.encode()
@@ -41,87 +153,504 @@ class ClientWorker(Thread):
             log.warning("Can't send data, Worker not connected to client.")
             raise utils.NotRunningError("Worker is not connected to client.")
 
-        deflator = zlib.compressobj()
-        deflated_data = deflator.compress(data) + deflator.flush(zlib.Z_SYNC_FLUSH)
+        with self._send_lock:
+            if not self._admit():
+                return
+            self._flush_batch()
+            self._write(self._codec.encode(data))
+        log.debug("Data sent to client, %s bytes", len(data))
 
-        while len(deflated_data) > self.server.DEFAULT_READ_SIZE:
-            to_send = deflated_data[:self.server.DEFAULT_READ_SIZE]
-            self.conn.sendall(to_send)
-            deflated_data = deflated_data[self.server.DEFAULT_READ_SIZE:]
+    def send_obj(self, obj: any):
+        if self.closed:
+            log.warning("Can't send data, Worker not connected to client.")
+            raise utils.NotRunningError("Worker is not connected to client.")
 
-        self.conn.sendall(deflated_data)
-        log.debug("Data sent to client, {len} bytes".format(len=len(data)))
+        flags, data = self._codec.serialize(obj)
+        # Events wait for the next tick when batching, everything else goes out right away (after the batch).
+        if type(obj) == tuple and self.batching:
+            self.queue(flags, data)
+            return
+        with self._send_lock:
+            if not self._admit():
+                return
+            self._flush_batch()
+            self._write(self._codec.encode(data, flags))
+        log.debug("Data sent to client, %s bytes", len(data))
 
-    def run(self):
-        log.info("Worker loop started, looking for data.")
-        while not self.closed:
+    def push(self, frame: bytes):
+        # Frames from Codec.encode_standalone don't touch this connection's deflate stream, they can be shared.
+        if self.closed:
+            raise utils.NotRunningError("Worker is not connected to client.")
+
+        with self._send_lock:
+            if self._admit():
+                self._flush_batch()
+                self._write(self._codec.sent(frame))
+
+    def queue(self, flags: int, data: bytes):
+        # Adds a serialized event to the batch, which is sent on the next tick or once it's batch_bytes long.
+        if self.closed:
+            raise utils.NotRunningError("Worker is not connected to client.")
+
+        with self._send_lock:
+            if not self._admit():
+                return
+            if not self._batch_pending:
+                self._batch_pending = True
+                self._flush_later()
+            size = self._batch.add(flags, data)
+            if size >= self.server.batch_bytes or len(self._batch) >= protocol.MAX_BATCH_ENTRIES:
+                self._flush_batch()
+
+    def _flush_later(self):
+        self.server.ticker.call_later(self.server.batch_interval, self.flush)
+
+    def _flush_batch(self):
+        if self._batch:
+            self._write(self._codec.encode(self._batch.take(), protocol.FLAG_BATCH))
+
+    def flush(self):
+        with self._send_lock:
+            self._batch_pending = False
+            if not self.closed:
+                try:
+                    self._flush_batch()
+                except utils.NotRunningError:
+                    pass
+
+    def hello(self):
+        self.send_obj(['HELLO', self._codec.capabilities()])
+
+    def resume(self, previous):
+        if previous._info:
+            self._info = previous._info.copy()
+        if previous._shared:
+            dict.update(self.shared, previous._shared)
+        self._subscription = previous._subscription
+        if self._subscription is not None:
+            self.sync(full=True)
+
+    def _call_later(self, delay: float, func, *args):
+        return wheel.call_later(delay, func, *args)
+
+    def watch(self):
+        # Starts the connection's idle timer, it moves itself along instead of being reset on every read.
+        if self.server.heartbeat is not None:
+            self._call_later(self.server.heartbeat.check(monotonic(), self._last_read)[1], self._check_idle)
+
+    def _check_idle(self):
+        if self.closed:
+            return
+        action, delay = self.server.heartbeat.check(monotonic(), self._last_read, self._stalled_since())
+        if action in ('read', 'write'):
+            self._reap(action)
+            return
+        if action == 'ping' and self._codec.peer_ping:
             try:
-                data = self.conn.recv(self.server.buffer_size if self.server.buffer_size else 2048)
-            except (ConnectionResetError, OSError, ConnectionAbortedError):
-                log.info("Client Disconnected (addr {addr})".format(addr=self.addr))
-                self.kill()
-                continue
+                self.send_obj(['PING'])
+            except utils.NotRunningError:
+                return
+        self._call_later(delay, self._check_idle)
+
+    def _stalled_since(self) -> float:
+        return self._outbox.stalled_since()
+
+    def _reap(self, side: str):
+        log.info("{this} timed out {doing}, dropping it.".format(
+            this=self, doing="without sending anything" if side == 'read' else "with writes stuck"))
+        self.server.metrics.counter('reaped_total', help="Connections dropped by an idle timeout.", side=side).inc()
+        # Nobody is reading on the other end, queued data would only keep the socket (and a writer thread) around.
+        self._abort()
+        try:
+            self.kill()
+        except utils.NotRunningError:
+            pass
+
+    def _abort(self):
+        self._outbox.clear()
+
+    def _subscribed(self, key) -> bool:
+        return self._subscription is True or key in self._subscription
+
+    def _shared_changed(self):
+        if self._subscription is None or self._sync_pending:
+            return
+        self._sync_pending = True
+        self._call_later(self.server.sync_interval, self.sync)
+
+    def sync(self, full: bool=False):
+        # Changes to shared are pushed at most once every sync_interval, as one versioned delta.
+        with self._sync_lock:
+            self._sync_pending = False
+            dirty = self.shared.take()
+            if self._subscription is None or self.closed:
+                return
+            if full:
+                changes = {key: val for key, val in self.shared.copy().items() if self._subscribed(key)}
+                removed = []
+            else:
+                snapshot = self.shared.copy()
+                dirty = [key for key in dirty if self._subscribed(key)]
+                if not dirty:
+                    return
+                changes = {key: snapshot[key] for key in dirty if key in snapshot}
+                removed = [key for key in dirty if key not in snapshot]
+            self._sync_version += 1
             try:
-                self._buffer.extend(data)
-                if len(data) < 4 or data[-4:] != b'\x00\x00\xff\xff':
+                self.send_obj(['SYNC', self._sync_version, changes, removed, full])
+            except utils.NotRunningError:
+                pass
+
+    def _write(self, data: bytes):
+        raise NotImplementedError
+
+    def feed(self, data: bytes) -> float:
+        self._parser.feed(data)
+        return self.process()
+
+    def process(self) -> float:
+        # Returns how long to stop reading when a rate limit wants this connection delayed, None otherwise.
+        self._last_read = monotonic()
+        if self._held:
+            wait = self._dispatch(self._held, 0)
+            if wait:
+                return wait
+        limits = self.server.limits
+        try:
+            for flags, payload in self._parser.frames():
+                # The client's own limit is checked on the frame header, over the limit nothing gets decoded.
+                if limits is not None and limits.rate is not None:
+                    wait = self._limited()
+                    if wait is None:
+                        if self.closed:
+                            return None
+                        continue
+                    if wait:
+                        self._parser.push_back(payload)
+                        return wait
+                try:
+                    messages = self._codec.messages(flags, payload)
+                except (zlib.error, utils.BadSterilization):
+                    log.info("Client sent us a malformed call.")
+                    self.bad_call(bytes(payload))
+                    continue
+                log.debug("Received data from client, %s bytes.", len(payload))
+                # The frame header paid for the first message, the rest of a batch pays one by one.
+                wait = self._dispatch(messages, 1)
+                if wait:
+                    return wait
+        except (utils.ProtocolError, utils.DataOverflowError) as e:
+            log.info("Client sent us an invalid frame ({e}), dropping connection.".format(e=e))
+            if not self.closed:
+                self.kill()
+        return None
+
+    def _dispatch(self, messages: list, paid: int) -> float:
+        # Every message is checked against the limits before it's unpacked, handler limits right after (the handler
+        # name is inside the message). Messages that have to wait are held, still packed, until the next process().
+        limits = self.server.limits
+        rate = limits is not None and limits.rate is not None
+        handlers = limits.handlers if limits is not None else None
+        for i, (flags, data) in enumerate(messages):
+            if rate and i >= paid:
+                wait = self._limited()
+                if wait is None:
+                    if self.closed:
+                        break
                     continue
-                inflator = zlib.decompressobj()
-                inflated_data = inflator.decompress(self._buffer) + inflator.flush(zlib.Z_SYNC_FLUSH)
-                self._buffer = bytearray()
-                info = sterilizer.clean(inflated_data.decode())
-            except zlib.error:
+                if wait:
+                    self._held = messages[i:]
+                    return wait
+            try:
+                info = self._codec.unpack(flags, data)
+            except (UnicodeDecodeError, utils.BadSterilization):
                 log.info("Client sent us a malformed call.")
-                self.emit("BAD_CALL", data)
+                self.bad_call(data)
+                continue
+            if handlers:
+                name = _handler_of(info)
+                if name in handlers:
+                    wait = self._limited(name)
+                    if wait is None:
+                        if self.closed:
+                            break
+                        continue
+                    if wait:
+                        # It's checked against the client's limit again once it's let through.
+                        if rate:
+                            self._buckets[None].charge(-1)
+                        self._held = messages[i:]
+                        return wait
+            self.handle(info)
+        self._held = None
+        return None
+
+    def _limited(self, handler: str=None) -> float:
+        # 0 when the message can go, None when it was dropped and otherwise how long to wait before trying again.
+        if self._buckets is None:
+            self._buckets = {}
+        bucket = self._buckets.get(handler)
+        if bucket is None:
+            bucket = self._buckets[handler] = self.server.limits.bucket(handler)
+        first = not bucket.limited
+        wait = bucket.take()
+        if not wait:
+            return 0
+        limits = self.server.limits
+        limits.limited.inc()
+        action = limits.action
+        if action == 'delay':
+            # A client that keeps pushing goes over again after every pause.
+            log.debug("%s is over its rate limit, not reading for %.3fs.", self, wait)
+            return wait
+        if first:
+            log.info("{this} went over its rate limit{on}, {action}.".format(
+                this=self, on="" if handler is None else " for " + handler, action=action))
+        if action == 'disconnect':
+            if not self.closed:
+                self.kill()
+        elif action == 'event' and first:
+            self.server.emit(self, 'RATE_LIMITED', self, handler)
+        return None
+
+    def handle(self, info):
+        if not self.greeted:
+            self.greeted = True
+            hello = type(info) == list and len(info) > 2 and info[0] == 'HELLO'
+            self.server.greet(self, info[2] if hello else None)
+
+        if type(info) == tuple:
+            if len(info) < 3 or len(info) > 3:
+                log.info("Client sent us either to much or too little information.")
+                self.bad_call(info)
+            elif info[0] in self.server.EVENTS:
+                log.info("Client sent event ({e}) only triggerable server side.".format(e=info[0]))
+                self.bad_call(info)
             else:
-                log.debug("Received data from client, {len} bytes.".format(len=len(data)))
-                if type(info) == tuple:
-                    if len(info) < 3 or len(info) > 3:
-                        log.info("Client sent us either to much or too little information.")
-                        self.emit("BAD_CALL", info)
-                    elif info[0] in self.server.EVENTS:
-                        log.info("Client sent event ({e}) only triggerable server side.".format(e=info[0]))
-                        self.emit("BAD_CALL", info)
+                handler, args, kwargs = info
+                self.server.emit(self, handler, *args, **kwargs)
+        elif type(info) == list and info and info[0] == 'HELLO':
+            self._codec.agree(info[1] if len(info) > 1 else [])
+            log.debug("Client can read {caps}.".format(caps=info[1:]))
+        elif type(info) == list and info and info[0] in ('PING', 'PONG'):
+            # Reading it was the point, a PONG needs nothing else.
+            if info[0] == 'PING':
+                self.send_obj(['PONG'])
+        elif type(info) == list:
+            self.server.emit(self, "SERVER_REQUEST", info)
+            try:
+                command = info[0]
+                if command in self.STORE_REQUESTS:
+                    if len(info) == self.STORE_REQUESTS[command]:
+                        self._store_request(info)
+                    else:
+                        log.info("Client sent a store request of the wrong length.")
+                        self.bad_call(info)
+                elif command == 'GET':
+                    log.debug("Client asked for value of %s.", info[1])
+                    self.send_obj(['FOUND', info[1], self.shared.get(info[1])] + info[2:3])
+                elif command == 'GET_MANY':
+                    self.send_obj(['FOUND_MANY', {key: self.shared.get(key) for key in info[1]}, info[2]])
+                elif command == 'SET':
+                    if not self.lock_sharing:
+                        self.shared[info[1]] = info[2]
+                        self.send_obj(['CHANGED', info[1], info[2]] + info[3:4])
+                        log.debug("Client set shared data %s to %s", info[1], info[2])
+                    elif len(info) > 3:
+                        self.send_obj(['DENIED', info[1], info[3]])
+                elif command == 'SET_MANY':
+                    if not self.lock_sharing:
+                        self.shared.update(info[1])
+                        self.send_obj(['CHANGED_MANY', list(info[1]), info[2]])
                     else:
-                        handler, args, kwargs = info
-                        self.server.emit(self, handler, *args, **kwargs)
-                elif type(info) == list:
-                    self.server.emit(self, "SERVER_REQUEST", info)
-                    try:
-                        if info[0] == 'GET':
-                            log.debug("Client asked for value of {key}.".format(key=info[1]))
-                            resp = sterilizer.dirty(['FOUND', info[1], self.shared.get(info[1])])
-                            self.send(resp)
-                        elif info[0] == 'SET':
-                            if not self.lock_sharing:
-                                self.shared[info[1]] = info[2]
-                                resp = sterilizer.dirty(['CHANGED', info[1], info[2]])
-                                self.send(resp)
-                                log.debug("Client set shared data {key} to {val}".format(key=info[1], val=info[2]))
-                        elif info[0] == 'DEL':
-                            if info[1] in self.shared and not self.lock_sharing:
-                                del self.shared[info[1]]
-                                resp = sterilizer.dirty(['REMOVED', info[1]])
-                                self.send(resp)
-                                log.debug("Client deleted shared data {key}".format(key=info[1]))
-                        else:
-                            log.info("Client sent us invalid information")
-                            self.emit("BAD_CALL", info)
-                    except IndexError:
-                        log.info("Client sent us either to much or too little information.")
-                        self.emit("BAD_CALL", info)
+                        self.send_obj(['DENIED', list(info[1]), info[2]])
+                elif command == 'DEL':
+                    if self.lock_sharing:
+                        if len(info) > 2:
+                            self.send_obj(['DENIED', info[1], info[2]])
+                    elif info[1] in self.shared:
+                        del self.shared[info[1]]
+                        self.send_obj(['REMOVED', info[1]] + info[2:3])
+                        log.debug("Client deleted shared data %s", info[1])
+                    elif len(info) > 2:
+                        self.send_obj(['REMOVED', info[1], info[2]])
+                elif command == 'SUBSCRIBE':
+                    self._subscription = True if info[1] is None else frozenset(info[1])
+                    self.sync(full=True)
+                    self.send_obj(['SUBSCRIBED', info[1], info[2]])
+                elif command in STREAM_COMMANDS:
+                    self._transfers().handle(info)
+                elif command == 'CALL':
+                    self.server.answer(self, info, self.send_obj)
+                elif command == 'RESULT':
+                    self._pending().resolve(info[2], info[1])
+                elif command == 'ERROR':
+                    self._pending().fail(info[2], utils.RemoteError(info[1]))
                 else:
-                    log.info("Client sent us unrecognized information")
-                    self.emit("BAD_CALL", info)
+                    log.info("Client sent us invalid information")
+                    self.bad_call(info)
+            except (IndexError, TypeError, ValueError, AttributeError):
+                log.info("Client sent us either to much or too little information.")
+                self.bad_call(info)
+        else:
+            log.info("Client sent us unrecognized information")
+            self.bad_call(info)
+
+    def _store_request(self, info: list):
+        command, key, rid = info[0], info[1], info[-1]
+        store, access = self.server.store, self.server.store_access
+        if access == 'none' or (command != 'SGET' and access != 'write'):
+            log.info("Client tried to {command} {key} in the store, which isn't allowed.".format(
+                command=command, key=key))
+            self.send_obj(['DENIED', key, rid])
+        elif command == 'SGET':
+            self.send_obj(['FOUND', key, store.get(key, namespace=info[2]), rid])
+        elif command == 'SSET':
+            store.set(key, info[2], info[4], namespace=info[3])
+            self.send_obj(['CHANGED', key, info[2], rid])
+        elif command == 'SDEL':
+            store.delete(key, namespace=info[2])
+            self.send_obj(['REMOVED', key, rid])
+        elif command == 'INCR':
+            try:
+                self.send_obj(['CHANGED', key, store.incr(key, info[2], namespace=info[3]), rid])
+            except TypeError as e:
+                self.send_obj(['ERROR', "TypeError: {e}".format(e=e), rid])
+        elif command == 'CAS':
+            self.send_obj(['RESULT', store.compare_and_set(key, info[2], info[3], info[5], namespace=info[4]), rid])
 
     def emit(self, handler, *args, **kwargs):
-        cmd = sterilizer.dirty((handler, args, kwargs))
-        self.send(cmd)
+        self.send_obj((handler, args, kwargs))
+
+    def request(self, handler: str, *args, timeout: float=2, **kwargs) -> Future:
+        return self._pending().issue(self.send_obj, ['CALL', handler, args, kwargs, timeout], timeout)
+
+    def stream(self, handler: str, source, *args, chunk_size: int=CHUNK_SIZE, window: int=WINDOW,
+               **kwargs) -> Future:
+        # Sends bytes, a file or an iterable of bytes in chunks, the client's handler gets a Stream to read them
+        # from. The future resolves to the number of bytes sent.
+        return self._transfers().open(handler, source, args, kwargs, chunk_size, window)
+
+    def _open_stream(self, incoming: Stream, handler: str, args: tuple, kwargs: dict):
+        if handler in self.server.EVENTS:
+            log.info("Client streamed to event ({e}) only triggerable server side.".format(e=handler))
+            incoming.close()
+            return
+        # Nobody would ever read it, the sender is told right away instead of waiting for credit forever.
+        if not self.server.spawn(self, handler, incoming, *args, **kwargs):
+            incoming.close()
+
+    def bad_call(self, info):
+        self.send_obj(("BAD_CALL", (utils.describe(info),), {}))
 
     def kill(self):
         if self.closed:
             log.warning("ClientWorker not connected to client, hence it can't die.")
             raise utils.NotRunningError("Connection not made, can't kill non-existent connection.")
-        self.conn.close()
+        if self._batch is not None:
+            self.flush()
+        self._close()
         self.closed = True
+        self.server.clients.release(self)
+        if self._reqs is not None:
+            self._reqs.fail_all(utils.NotRunningError("Client disconnected before answering"))
+        if self._streams is not None:
+            self._streams.close(utils.NotRunningError("Client disconnected during the stream"))
         self.server.emit(self, "CLIENT_DISCONNECT", self)
         log.info("{this} has stopped".format(this=self))
+
+    def _close(self):
+        self.conn.close()
+
+
+class ClientWorker(BaseWorker):
+    # The thread engine: a reader thread and a writer thread for every connection.
+
+    __slots__ = '_reader', '_writer'
+
+    def __init__(self, id: str, conn: socket.socket, manager):
+        BaseWorker.__init__(self, conn, manager)
+        self.name = id
+        self._reader = Thread(target=self.run, name=id)
+        self._writer = Thread(target=self._drain, name=id + "-writer", daemon=True)
+        log.debug("Finished ClientWorker initialization.")
+
+    def is_alive(self) -> bool:
+        return self._reader.is_alive()
+
+    def join(self, timeout: float=None):
+        self._reader.join(timeout)
+
+    def start(self):
+        self._reader.start()
+        if not isinstance(self.conn, ssl.SSLSocket):
+            self._writer.start()
+
+    def _handshake(self) -> bool:
+        # TLS handshakes run here, on the connection's own thread. Nothing is written until it's done.
+        self.conn.settimeout(self.server.handshake_timeout)
+        try:
+            self.conn.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            log.info("TLS handshake with {addr} failed ({e}).".format(addr=self.addr, e=e))
+            return False
+        self.conn.settimeout(None)
+        self._writer.start()
+        return True
+
+    def _write(self, data: bytes):
+        # Handler threads only queue frames, the writer thread is the one that blocks on a slow client.
+        self._outbox.put(data)
+
+    def _drain(self):
+        try:
+            while True:
+                buffers = self._outbox.wait()
+                if not buffers:
+                    return
+                self._outbox.consume(send_some(self.conn, buffers))
+        except OSError:
+            log.info("Couldn't write to {addr}, dropping queued data.".format(addr=self.addr))
+            self._outbox.clear()
+        finally:
+            if self.closed:
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.conn.close()
+
+    def _close(self):
+        # Whatever was queued before the kill still goes out, the writer closes the socket once it's done.
+        self.closed = True
+        flushing = self._outbox and self._writer.is_alive()
+        try:
+            # close() alone doesn't wake the reader thread (or tell the client) while recv is blocked.
+            self.conn.shutdown(socket.SHUT_RD if flushing else socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._outbox.close()
+        if not flushing:
+            self.conn.close()
+
+    def run(self):
+        if isinstance(self.conn, ssl.SSLSocket) and not self._handshake():
+            if not self.closed:
+                self.kill()
+            return
+        log.info("Worker loop started, looking for data.")
+        while not self.closed:
+            try:
+                received = self._parser.recv_into(self.conn, self.server.buffer_size or 2048)
+            except (ConnectionResetError, OSError, ConnectionAbortedError):
+                received = 0
+            if not received:
+                log.info("Client Disconnected (addr {addr})".format(addr=self.addr))
+                if not self.closed:
+                    self.kill()
+                continue
+            # Over a rate limit with action 'delay', the client waits for us to read again.
+            wait = self.process()
+            while wait and not self.closed:
+                sleep(wait)
+                wait = self.process()
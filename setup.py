@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='quick-connect',
     version='1.3.5',
-    packages=['quicknet'],
+    packages=['quicknet', 'quicknet.bench'],
     package_data={'': ['server_example.py', 'client_example.py']},
     include_package_data=True,
     url='https://github.com/Zwork101/quick-net',